@@ -0,0 +1,404 @@
+"""アカウント全体の集計
+
+明細は必要な列だけを取得し、pandasでまとめて集計する（行毎のPythonループを使わない）。
+アーカイブした工事は、アーカイブ時に作成した集計（report_archive_total）を通常の明細と
+UNION ALLで合わせてSQLで集計する（アーカイブした明細は展開しない）。
+"""
+import datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import (
+    Integer,
+    case,
+    cast,
+    func,
+    select,
+    union_all,
+)
+
+from app_utils import to_columnar
+from schemas import ItemType
+from tables import (
+    ReportArchiveTotal,
+    ReportDetail,
+    ReportHead,
+)
+
+
+# 稼働集計の対象（名前が人・物を表す種別）
+UTILIZATION_TYPES = (ItemType.STAFF, ItemType.CAR, ItemType.MACHINE)
+
+# ダッシュボードの並び替えに指定できる項目
+DASHBOARD_SORT_KEYS = ('name', 'total', 'first_date', 'last_date', 'days')
+
+
+def parse_month(txt):
+    """YYYY-MM を月初日に変換する
+
+    Args:
+        txt (str): 年月 ex.) 2024-01
+    """
+    return datetime.datetime.strptime(txt, '%Y-%m')
+
+
+def parse_date(txt):
+    """YYYY-MM-DD を日付に変換する
+
+    Args:
+        txt (str): 日付 ex.) 2024-01-31
+    """
+    return datetime.datetime.strptime(txt, '%Y-%m-%d')
+
+
+def next_month(date):
+    return (date.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+
+def _account_details(account_id, date_from=None, date_to=None, types=None):
+    """通常の明細と、アーカイブした明細の集計（report_archive_total）を合わせた副問い合わせ
+
+    Args:
+        account_id (int): アカウント(Account.id)
+        date_from (datetime, optional): 開始日
+        date_to (datetime, optional): 終了日（この日を含まない）
+        types (list, optional): 種別(ItemTypeの値)。省略時は全ての種別
+
+    Returns:
+        Subquery: 列は report_head_id, work_date, type, name, dest, quant, quant_kg, unweighed, total
+            unweighed はkgに換算できない明細の数量、total は費用（数量 × 単価）
+    """
+
+    def where(stmt, table):
+        # 絞り込みは UNION ALL の前にそれぞれのテーブルのインデックスで行う
+        stmt = stmt.join(
+            ReportHead, table.report_head_id == ReportHead.id
+        ).where(
+            ReportHead.account_id == account_id
+        )
+        if date_from is not None:
+            stmt = stmt.where(table.work_date >= date_from)
+        if date_to is not None:
+            stmt = stmt.where(table.work_date < date_to)
+        if types is not None:
+            stmt = stmt.where(table.type.in_(types))
+        return stmt
+
+    details = where(select(
+        ReportDetail.report_head_id,
+        ReportDetail.work_date,
+        ReportDetail.type,
+        ReportDetail.name,
+        ReportDetail.dest,
+        ReportDetail.quant,
+        ReportDetail.quant_kg,
+        case((ReportDetail.quant_kg.is_(None), ReportDetail.quant)).label('unweighed'),
+        (ReportDetail.quant * ReportDetail.cost).label('total'),
+    ), ReportDetail)
+    archived = where(select(
+        ReportArchiveTotal.report_head_id,
+        ReportArchiveTotal.work_date,
+        ReportArchiveTotal.type,
+        ReportArchiveTotal.name,
+        ReportArchiveTotal.dest,
+        ReportArchiveTotal.quant,
+        ReportArchiveTotal.quant_kg,
+        ReportArchiveTotal.unweighed,
+        ReportArchiveTotal.total,
+    ), ReportArchiveTotal)
+
+    return union_all(details, archived).subquery('details')
+
+
+def monthly_pivot(session, account_id, month_from, month_to):
+    """月 × 種別(ItemType) × 工事 の費用・数量を集計する。
+
+    Args:
+        session (Session): DBセッション
+        account_id (int): アカウント(Account.id)
+        month_from (datetime): 集計開始月（月初日）
+        month_to (datetime): 集計終了月（月初日、この月を含む）
+
+    Returns:
+        dict:
+            months: 集計対象の月の一覧
+            types: 種別名（インデックスがItemTypeの値）
+            worksites: 工事の一覧 [{'id', 'name'}]
+            details: 月・種別・工事毎の数量と費用（列形式、month/worksiteは months/worksites のインデックス）
+            total_by_type: 月 × 種別 の費用合計（months × types の2次元配列）
+    """
+
+    # 月は yyyymm の整数で取得し、全列を整数のままnumpy配列にする
+    details = _account_details(account_id, month_from, next_month(month_to))
+    stmt = select(
+        cast(func.strftime('%Y%m', details.c.work_date), Integer).label('month'),
+        details.c.type,
+        details.c.report_head_id,
+        func.coalesce(details.c.quant, 0),
+        func.coalesce(details.c.total, 0),
+    )
+    # 行数が多いため、SQLAlchemyのRowを作らずにDBAPIのカーソルから直接取得する
+    rows = session.connection().execute(stmt).cursor.fetchall()
+    df = pd.DataFrame(
+        np.array(rows, dtype=np.int64).reshape(-1, 5),
+        columns=['month', 'type', 'report_head_id', 'quant', 'total'],
+    )
+
+    months = list()
+    m = month_from
+    while m <= month_to:
+        months.append(m)
+        m = next_month(m)
+    month_keys = np.array([int(m.strftime('%Y%m')) for m in months], dtype=np.int64)
+    months = [m.strftime('%Y-%m') for m in months]
+    types = [e.name for e in sorted(ItemType, key=lambda e: e.value)]
+
+    if df.empty:
+        return dict(
+            months=months,
+            types=types,
+            worksites=[],
+            details=to_columnar([], ['month', 'type', 'worksite', 'quant', 'total']),
+            total_by_type=[[0] * len(types) for _ in months],
+        )
+
+    df['month'] = np.searchsorted(month_keys, df['month'].to_numpy())
+    grouped = df.groupby(['month', 'type', 'report_head_id'], sort=True)[['quant', 'total']].sum().reset_index()
+
+    worksite_codes, worksite_ids = pd.factorize(grouped['report_head_id'], sort=True)
+    worksite_ids = worksite_ids.tolist()
+    names = dict(session.execute(
+        select(ReportHead.id, ReportHead.worksite_name).where(
+            ReportHead.account_id == account_id).where(
+            ReportHead.id.in_(worksite_ids))
+    ).all())
+
+    total_by_type = np.zeros((len(months), len(types)), dtype=np.int64)
+    np.add.at(total_by_type, (df['month'].to_numpy(), df['type'].to_numpy()), df['total'].to_numpy())
+
+    # to_columnar と同じ形式。件数が多いため列毎にまとめて変換する
+    details = dict(
+        length=len(grouped),
+        columns=dict(
+            month=grouped['month'].tolist(),
+            type=grouped['type'].tolist(),
+            worksite=worksite_codes.tolist(),
+            quant=grouped['quant'].tolist(),
+            total=grouped['total'].tolist(),
+        ),
+        dictionaries=dict(),
+    )
+
+    return dict(
+        months=months,
+        types=types,
+        worksites=[{'id': i, 'name': names.get(i)} for i in worksite_ids],
+        details=details,
+        total_by_type=total_by_type.tolist(),
+    )
+
+
+def worksite_dashboard(session, account_id, sort='last_date', desc=True, limit=50, offset=0):
+    """アカウントの全工事の合計費用・種別毎の費用・工事期間・稼働日数を集計する。
+    工事毎の集計・並び替え・ページングは1回のGROUP BYクエリで行う。
+
+    Args:
+        session (Session): DBセッション
+        account_id (int): アカウント(Account.id)
+        sort (str): 並び替えの項目（DASHBOARD_SORT_KEYS）
+        desc (bool): 降順にする場合True
+        limit (int): 1ページの件数
+        offset (int): 開始位置
+
+    Returns:
+        dict:
+            total: 工事の総数
+            types: 種別名（インデックスがItemTypeの値）
+            worksites: 工事毎の集計
+                [{'id', 'name', 'customer', 'completed', 'total', 'costs', 'first_date', 'last_date', 'days'}]
+                costs は types と同じ並びの種別毎の費用
+    """
+
+    types = sorted(ItemType, key=lambda e: e.value)
+    # 工事毎に集計してから工事に結合する（工事の明細は全て report_detail か全てアーカイブのどちらか）
+    details = _account_details(account_id)
+    summary = select(
+        details.c.report_head_id,
+        func.sum(details.c.total).label('total'),
+        func.min(details.c.work_date).label('first_date'),
+        func.max(details.c.work_date).label('last_date'),
+        func.count(func.distinct(details.c.work_date)).label('days'),
+        *[func.sum(case((details.c.type == e.value, details.c.total))).label(f'cost_{e.value}') for e in types],
+    ).group_by(
+        details.c.report_head_id
+    ).subquery('summary')
+    total = func.coalesce(summary.c.total, 0)
+    first_date = summary.c.first_date
+    last_date = summary.c.last_date
+    days = func.coalesce(summary.c.days, 0)
+    costs = [func.coalesce(summary.c[f'cost_{e.value}'], 0) for e in types]
+    sort_columns = dict(
+        name=ReportHead.worksite_name,
+        total=total,
+        first_date=first_date,
+        last_date=last_date,
+        days=days,
+    )
+    order = sort_columns[sort].desc() if desc else sort_columns[sort].asc()
+
+    stmt = select(
+        ReportHead.id,
+        ReportHead.worksite_name,
+        ReportHead.customer_name,
+        ReportHead.completed_date,
+        total,
+        first_date,
+        last_date,
+        days,
+        # ページング前の件数（ウィンドウ関数はGROUP BYの後に評価される）
+        func.count().over(),
+        *costs,
+    ).outerjoin(
+        summary, summary.c.report_head_id == ReportHead.id
+    ).where(
+        ReportHead.account_id == account_id
+    ).order_by(
+        order, ReportHead.id
+    ).limit(limit).offset(offset)
+
+    worksites = list()
+    count = 0
+    for work_id, name, customer, completed, total_cost, first, last, work_days, count, *costs in session.execute(stmt):
+        worksites.append({
+            'id': work_id,
+            'name': name,
+            'customer': customer,
+            'completed': completed is not None,
+            'total': total_cost,
+            'costs': costs,
+            'first_date': first.strftime('%Y-%m-%d') if first is not None else None,
+            'last_date': last.strftime('%Y-%m-%d') if last is not None else None,
+            'days': work_days,
+        })
+    if not worksites and offset > 0:
+        count = session.scalar(
+            select(func.count()).select_from(ReportHead).where(ReportHead.account_id == account_id))
+
+    return dict(
+        total=count,
+        types=[e.name for e in types],
+        worksites=worksites,
+    )
+
+
+def resource_utilization(session, account_id, date_from, date_to, types=UTILIZATION_TYPES):
+    """人員・車両・重機毎の稼働日数と、工事毎の内訳を集計する。
+
+    Args:
+        session (Session): DBセッション
+        account_id (int): アカウント(Account.id)
+        date_from (datetime): 集計開始日
+        date_to (datetime): 集計終了日（この日を含む）
+        types (list): 集計する種別(ItemType)
+
+    Returns:
+        dict:
+            worksites: 内訳に出現する工事 {id: name}
+            resources: 種別・名前毎の集計
+                [{'type', 'name', 'days', 'quant', 'total', 'worksites': [{'id', 'days', 'quant', 'total'}]}]
+                days は作業日の数（同じ日に複数の工事で稼働しても1日）
+    """
+
+    details = _account_details(
+        account_id, date_from, date_to + datetime.timedelta(days=1), [e.value for e in types])
+    days = func.count(func.distinct(details.c.work_date))
+    quant = func.coalesce(func.sum(details.c.quant), 0)
+    total = func.coalesce(func.sum(details.c.total), 0)
+
+    resources = dict()
+    for type, name, work_days, total_quant, total_cost in session.execute(
+            select(details.c.type, details.c.name, days, quant, total).group_by(
+                details.c.type, details.c.name
+            ).order_by(details.c.type, details.c.name)):
+        resources[(type, name)] = {
+            'type': type,
+            'name': name,
+            'days': work_days,
+            'quant': total_quant,
+            'total': total_cost,
+            'worksites': [],
+        }
+
+    worksites = dict()
+    for type, name, work_id, work_name, work_days, total_quant, total_cost in session.execute(
+            select(details.c.type, details.c.name, ReportHead.id, ReportHead.worksite_name,
+                   days, quant, total).join(
+                ReportHead, details.c.report_head_id == ReportHead.id
+            ).group_by(
+                details.c.type, details.c.name, ReportHead.id
+            ).order_by(details.c.type, details.c.name, days.desc(), ReportHead.id)):
+        worksites[work_id] = work_name
+        resources[(type, name)]['worksites'].append({
+            'id': work_id,
+            'days': work_days,
+            'quant': total_quant,
+            'total': total_cost,
+        })
+
+    return dict(
+        worksites=worksites,
+        resources=list(resources.values()),
+    )
+
+
+def waste_tonnage(session, account_id, date_from, date_to):
+    """処分先・品名毎の廃材の重量(kg換算)と費用を集計する。
+
+    Args:
+        session (Session): DBセッション
+        account_id (int): アカウント(Account.id)
+        date_from (datetime): 集計開始日
+        date_to (datetime): 集計終了日（この日を含む）
+
+    Returns:
+        dict:
+            total_kg: 重量の合計
+            total: 費用の合計
+            details: [{'dest', 'item', 'kg', 't', 'total', 'unweighed'}]
+                unweighed は単位がなし（重量に換算できない）明細の数量
+    """
+
+    details = _account_details(
+        account_id, date_from, date_to + datetime.timedelta(days=1), [ItemType.TRASH.value])
+    kg = func.coalesce(func.sum(details.c.quant_kg), 0)
+    total = func.coalesce(func.sum(details.c.total), 0)
+    unweighed = func.coalesce(func.sum(details.c.unweighed), 0)
+
+    stmt = select(
+        details.c.dest,
+        details.c.name,
+        kg,
+        total,
+        unweighed,
+    ).group_by(
+        details.c.dest, details.c.name
+    ).order_by(
+        details.c.dest, kg.desc()
+    )
+
+    details = list()
+    for dest, item, total_kg, total_cost, total_unweighed in session.execute(stmt):
+        details.append({
+            'dest': dest,
+            'item': item,
+            'kg': total_kg,
+            't': total_kg / 1000,
+            'total': total_cost,
+            'unweighed': total_unweighed,
+        })
+
+    return dict(
+        total_kg=sum(d['kg'] for d in details),
+        total=sum(d['total'] for d in details),
+        details=details,
+    )
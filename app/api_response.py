@@ -0,0 +1,108 @@
+"""JSON / MessagePack のコンテンツネゴシエーション
+
+- レスポンス: リクエストの Accept に application/msgpack があれば MessagePack で返す。既定は JSON(orjson)。
+- リクエスト: Content-Type が application/msgpack のボディを、JSONと同じくPydanticモデルに渡す。
+
+app.router.route_class = MsgpackRoute とし、レスポンスには APIResponse を使うこと。
+"""
+from contextvars import ContextVar
+from typing import Callable
+
+import msgpack
+import orjson
+from fastapi import (
+    Request,
+    Response,
+)
+from fastapi.responses import ORJSONResponse
+from fastapi.routing import APIRoute
+
+
+MSGPACK_MEDIA_TYPE = 'application/msgpack'
+MSGPACK_MEDIA_TYPES = (MSGPACK_MEDIA_TYPE, 'application/x-msgpack', 'application/vnd.msgpack')
+
+# リクエスト毎のレスポンス形式（MsgpackRouteで設定し、APIResponseで参照する）
+accept_msgpack: ContextVar[bool] = ContextVar('accept_msgpack', default=False)
+
+
+# 事前JSON化したデータの元データ（MessagePackで返す場合に使う）
+_fragment_sources = dict()
+
+
+def precompute_json(obj):
+    """固定データを事前にJSON化する。
+    orjsonでのエンコード時にはそのまま埋め込まれる（orjson.Fragment）。
+
+    Args:
+        obj (object): JSON化するデータ
+    """
+    fragment = orjson.Fragment(orjson.dumps(obj))
+    _fragment_sources[id(fragment)] = (fragment, obj)
+    return fragment
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, orjson.Fragment) and id(obj) in _fragment_sources:
+        return _fragment_sources[id(obj)][1]
+    raise TypeError(f'Object of type {type(obj).__name__} is not msgpack serializable')
+
+
+def packb(content):
+    return msgpack.packb(content, default=_msgpack_default)
+
+
+def is_msgpack(content_type):
+    if content_type is None:
+        return False
+    return content_type.split(';')[0].strip().lower() in MSGPACK_MEDIA_TYPES
+
+
+def accepts_msgpack(accept):
+    if accept is None:
+        return False
+    return any(is_msgpack(a) for a in accept.split(','))
+
+
+class APIResponse(ORJSONResponse):
+    """JSON(orjson)のレスポンス。Acceptでmsgpackが要求されている場合はMessagePackで返す。"""
+
+    def __init__(self, content=None, status_code=200, headers=None, media_type=None, background=None):
+        if media_type is None and accept_msgpack.get():
+            media_type = MSGPACK_MEDIA_TYPE
+        super().__init__(content, status_code, headers, media_type, background)
+
+    def render(self, content) -> bytes:
+        if self.media_type == MSGPACK_MEDIA_TYPE:
+            return packb(content)
+        return super().render(content)
+
+
+class MsgpackRequest(Request):
+    """ボディがMessagePackのリクエスト。json()でデコード済みのデータを返す。"""
+
+    async def json(self):
+        if not hasattr(self, '_json'):
+            self._json = msgpack.unpackb(await self.body())
+        return self._json
+
+
+class MsgpackRoute(APIRoute):
+    def get_route_handler(self) -> Callable:
+        original_route_handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            token = accept_msgpack.set(accepts_msgpack(request.headers.get('accept')))
+            try:
+                if is_msgpack(request.headers.get('content-type')):
+                    # FastAPIはContent-TypeがJSONの場合のみjson()でボディを読むため、JSONとして扱わせる
+                    scope = dict(request.scope)
+                    scope['headers'] = [
+                        (k, b'application/json') if k == b'content-type' else (k, v)
+                        for k, v in request.scope['headers']
+                    ]
+                    request = MsgpackRequest(scope, request.receive)
+                return await original_route_handler(request)
+            finally:
+                accept_msgpack.reset(token)
+
+        return route_handler
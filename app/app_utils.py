@@ -29,6 +29,7 @@ from jose import JWTError, jwt
 from jose.exceptions import ExpiredSignatureError
 from fastapi.security import OAuth2PasswordBearer
 
+from api_response import precompute_json
 from db_common import get_engine
 from tables import (
     User,
@@ -41,6 +42,8 @@ from schemas import(
     Token,
     TokenData,
     SUser,
+    ItemType,
+    KG_PER_UNIT,
     UNIT_TYPE,
 )
 from tables import (
@@ -90,9 +93,96 @@ def ensure_str(txt, default=None):
         return txt
 
 
+# == マスタのカラム定義
+# 固定部分は起動時に一度だけJSON化し、レスポンスのエンコード時にそのまま埋め込む
+COL_DEFINITION_ID = precompute_json({
+    'colname': 'id',
+    'type': 'integer',
+    'readonly': True
+})
+COL_DEFINITION_COST = precompute_json({
+    'colname': '費用',
+    'type': 'integer',
+    'readonly': False
+})
+COL_DEFINITION_UNIT_TYPE = precompute_json({
+    'colname': '単位',
+    'type': 'select',
+    'selections': UNIT_TYPE,
+    'readonly': False
+})
+COL_DEFINITIONS_NAME_ONLY = precompute_json({
+    'id': {
+        'colname': 'id',
+        'type': 'integer',
+        'readonly': True
+    },
+    'name': {
+        'colname': '名前',
+        'type': 'string',
+        'readonly': False
+    }
+})
+COL_DEFINITIONS_NAME_COST = precompute_json({
+    'id': {
+        'colname': 'id',
+        'type': 'integer',
+        'readonly': True
+    },
+    'name': {
+        'colname': '名前',
+        'type': 'string',
+        'readonly': False
+    },
+    'cost': {
+        'colname': '費用',
+        'type': 'integer',
+        'readonly': False
+    },
+})
+COL_DEFINITIONS_WORK = precompute_json({
+    'id': {
+        'colname': 'id',
+        'type': 'integer',
+        'readonly': True
+    },
+    'worksite_name': {
+        'colname': '工事名',
+        'type': 'string',
+        'readonly': False
+    },
+    'customer': {
+        'colname': '受注先',
+        'type': 'string',
+        'readonly': False
+    },
+    'address': {
+        'colname': '住所',
+        'type': 'string',
+        'readonly': False
+    },
+    'memo': {
+        'colname': 'メモ',
+        'type': 'string',
+        'readonly': False
+    },
+    'complete': {
+        'colname': '完了',
+        'type': 'boolean',
+        'readonly': False
+    },
+    'completed_date': {
+        'colname': '完了日',
+        'type': 'date',
+        'readonly': False
+    },
+})
+
+
 def get_master_data(db_data, master_type, account_id = None, **kwargs):
     """マスタデータのクエリオブジェクトを
     クライアントに返す形式のデータに変換する。
+    col_definitions の固定部分は事前にJSON化済みのもの（orjson.Fragment）を返す。
 
     Args:
         db_data (queryobject): dbから取得したクエリオブジェクト
@@ -108,7 +198,7 @@ def get_master_data(db_data, master_type, account_id = None, **kwargs):
     col_values = list()
     if master_type == 'trash':
         
-        with Session(get_engine()) as session:
+        with Session(get_engine(account_id)) as session:
             dest = list()
             item = list()
 
@@ -129,11 +219,7 @@ def get_master_data(db_data, master_type, account_id = None, **kwargs):
                     }
                 )
         col_definitions = {
-            'id': {
-                'colname': 'id',
-                'type': 'integer',
-                'readonly': True
-            },
+            'id': COL_DEFINITION_ID,
             'dest_id': {
                 'colname': '処分先',
                 'type': 'select',
@@ -146,17 +232,8 @@ def get_master_data(db_data, master_type, account_id = None, **kwargs):
                 'selections': item,
                 'readonly': False
             },
-            'cost': {
-                'colname': '費用',
-                'type': 'integer',
-                'readonly': False
-            },
-            'unit_type': {
-                'colname': '単位',
-                'type': 'select',
-                'selections': UNIT_TYPE,
-                'readonly': False
-            },
+            'cost': COL_DEFINITION_COST,
+            'unit_type': COL_DEFINITION_UNIT_TYPE,
         }
 
         for d in db_data:
@@ -177,43 +254,7 @@ def get_master_data(db_data, master_type, account_id = None, **kwargs):
             )
 
     elif master_type == 'work':
-        col_definitions = {
-            'id': {
-                'colname': 'id',
-                'type': 'integer',
-                'readonly': True
-            },
-            'worksite_name': {
-                'colname': '工事名',
-                'type': 'string',
-                'readonly': False
-            },
-            'customer': {
-                'colname': '受注先',
-                'type': 'string',
-                'readonly': False
-            },
-            'address': {
-                'colname': '住所',
-                'type': 'string',
-                'readonly': False
-            },
-            'memo': {
-                'colname': 'メモ',
-                'type': 'string',
-                'readonly': False
-            },
-            'complete': {
-                'colname': '完了',
-                'type': 'boolean',
-                'readonly': False
-            },
-            'completed_date': {
-                'colname': '完了日',
-                'type': 'date',
-                'readonly': False
-            },
-        }
+        col_definitions = COL_DEFINITIONS_WORK
 
         for d in db_data:
             col_values.append(
@@ -229,23 +270,7 @@ def get_master_data(db_data, master_type, account_id = None, **kwargs):
             )
 
     else:
-        col_definitions = {
-            'id': {
-                'colname': 'id',
-                'type': 'integer',
-                'readonly': True
-            },
-            'name': {
-                'colname': '名前',
-                'type': 'string',
-                'readonly': False
-            },
-            'cost': {
-                'colname': '費用',
-                'type': 'integer',
-                'readonly': False
-            },
-        }
+        col_definitions = COL_DEFINITIONS_NAME_COST
 
         for d in db_data:
             col_values.append(
@@ -276,18 +301,7 @@ def get_name_only_master_data(data):
         return None
 
     res = dict()
-    res['col_definitions'] = {
-        'id': {
-            'colname': 'id',
-            'type': 'integer',
-            'readonly': True
-        },
-        'name': {
-            'colname': '名前',
-            'type': 'string',
-            'readonly': False
-        }
-    }
+    res['col_definitions'] = COL_DEFINITIONS_NAME_ONLY
 
     col_values = list()
     for d in data:
@@ -302,6 +316,82 @@ def get_name_only_master_data(data):
     return res
 
 
+LAYOUT_COLUMNAR = 'columnar'
+
+
+def to_columnar(rows, keys, dictionary_keys=()):
+    """行のリストを列毎の配列に変換する（?layout=columnar 用）。
+    キー名の繰り返しがなくなるため、行数が多いほどレスポンスが小さくなる。
+    dictionary_keys に指定した列は、値の一覧(dictionaries)とそのインデックスに置き換える。
+
+    Args:
+        rows (iterable): 行のタプル ex.) [('2024-01-01', 1, 3, 30000), ...]
+        keys (list): 各列の名前 ex.) ['date', 'type', 'quant', 'total']
+        dictionary_keys (list, optional): 辞書エンコードする列名
+    """
+
+    columns = [list() for _ in keys]
+    encoders = [dict() if k in dictionary_keys else None for k in keys]
+    length = 0
+    for row in rows:
+        length += 1
+        for col, encoder, v in zip(columns, encoders, row):
+            if encoder is not None:
+                v = encoder.setdefault(v, len(encoder))
+            col.append(v)
+
+    return dict(
+        length=length,
+        columns=dict(zip(keys, columns)),
+        dictionaries={k: list(e) for k, e in zip(keys, encoders) if e is not None},
+    )
+
+
+def quant_to_kg(quant, unit_type):
+    """廃材の数量をkgに換算する。単位が重量でない場合はNone
+
+    Args:
+        quant (int): 数量
+        unit_type (int): 単位(UNIT_TYPEのid)
+    """
+
+    rate = KG_PER_UNIT.get(unit_type)
+    if rate is None or quant is None:
+        return None
+    return quant * rate
+
+
+def report_detail_rows(head_id, work_date, detail):
+    """1日分の明細を、一括INSERT用の辞書のリストに変換する
+
+    Args:
+        head_id (int): 工事(ReportHead.id)
+        work_date (datetime): 作業日
+        detail (Detail): 明細
+    """
+
+    rows = list()
+    for type, items in (
+        (ItemType.STAFF, detail.staffs),
+        (ItemType.CAR, detail.cars),
+        (ItemType.MACHINE, detail.machines),
+        (ItemType.LEASE, detail.leases),
+        (ItemType.TRANSPORT, detail.transports),
+        (ItemType.VALUABLE, detail.valuables),
+        (ItemType.OTHER, detail.others),
+    ):
+        rows.extend(
+            dict(report_head_id=head_id, work_date=work_date, type=type.value, name=d.name, cost=d.cost, quant=d.quant)
+            for d in items
+        )
+    rows.extend(
+        dict(report_head_id=head_id, work_date=work_date, type=ItemType.TRASH.value, name=d.item, cost=d.cost, quant=d.quant,
+             dest=d.dest, unit_type=d.unit_type, quant_kg=quant_to_kg(d.quant, d.unit_type))
+        for d in detail.trashes
+    )
+    return rows
+
+
 def utc_now_dtime():
     return datetime.datetime.now(datetime.timezone.utc)
 
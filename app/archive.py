@@ -0,0 +1,364 @@
+"""完了した工事の明細のアーカイブ
+
+完了日から ARCHIVE_AFTER_DAYS 日以上経った工事の明細を、report_detail から
+report_archive（工事・作業日毎に1行、明細はMessagePackにまとめる）に移す。
+report_detail とそのインデックスには、集計や入力で使う工事の明細だけが残る。
+
+- 日報・期間・カレンダー・集計・全文検索は、アーカイブした工事も同じ形式で返す（archived_details）
+- アカウント全体の集計(analytics.py)は、アーカイブ時に作成した集計（report_archive_total）を合わせて集計する
+- 完了を取り消した工事や、日報を登録した工事は report_detail に戻す（restore_worksite）
+
+使い方:
+    python archive.py                 # 完了から ARCHIVE_AFTER_DAYS 日以上経った工事をアーカイブする
+    python archive.py --days 180
+    python archive.py --restore 12    # 工事ID 12 の明細を戻す（シャーディング時は --account も指定する）
+"""
+import argparse
+import datetime
+import os
+
+import msgpack
+from sqlalchemy import (
+    case,
+    delete,
+    func,
+    insert,
+    select,
+)
+from sqlalchemy.orm import Session
+
+from db_common import (
+    get_engine,
+    shard_account_ids,
+)
+from schemas import ItemType
+from search import (
+    add_search_rows,
+    delete_search_rows,
+)
+from sync import unlogged_details
+from tables import (
+    ReportArchive,
+    ReportArchiveTotal,
+    ReportDetail,
+    ReportHead,
+)
+
+
+# 完了日からアーカイブするまでの日数
+ARCHIVE_AFTER_DAYS = int(os.getenv('archive_after_days', '365'))
+
+# まとめる明細の列（この順の配列で保存する）
+ARCHIVE_COLUMNS = ('id', 'type', 'name', 'dest', 'cost', 'quant', 'memo', 'unit_type', 'quant_kg', 'reg_dtime')
+
+# sqliteのDateTime列の保存形式（全文検索の索引の work_date もこの形式）
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# 集計（report_archive_total）をまとめる単位
+TOTAL_KEYS = ('report_head_id', 'work_date', 'type', 'name', 'dest')
+
+
+def pack_details(rows):
+    """明細(ARCHIVE_COLUMNSの順の値)をまとめる"""
+
+    return msgpack.packb([list(r) for r in rows])
+
+
+def unpack_details(data):
+    """pack_details でまとめた明細を {列名: 値} のリストに戻す"""
+
+    return [dict(zip(ARCHIVE_COLUMNS, r)) for r in msgpack.unpackb(data)]
+
+
+def archive_worksite(session, head):
+    """工事の明細を作業日毎にまとめてアーカイブに移す。コミットは呼び出し元で行う
+
+    Args:
+        session (Session): DBセッション
+        head (ReportHead): 工事
+
+    Returns:
+        int: 移した明細の数
+    """
+
+    rows = session.execute(
+        select(
+            ReportDetail.work_date,
+            *[getattr(ReportDetail, c) for c in ARCHIVE_COLUMNS],
+        ).where(
+            ReportDetail.report_head_id == head.id
+        ).order_by(
+            ReportDetail.work_date, ReportDetail.id
+        )).all()
+
+    days = dict()
+    search_rows = list()
+    for work_date, *values in rows:
+        d = dict(zip(ARCHIVE_COLUMNS, values))
+        d['reg_dtime'] = d['reg_dtime'].strftime(DATETIME_FORMAT) if d['reg_dtime'] is not None else None
+        days.setdefault(work_date, []).append([d[c] for c in ARCHIVE_COLUMNS])
+        search_rows.append({
+            'id': d['id'],
+            'work_date': work_date.strftime(DATETIME_FORMAT),
+            'name': d['name'],
+            'dest': d['dest'],
+            'memo': d['memo'],
+        })
+
+    if days:
+        session.execute(
+            insert(ReportArchive),
+            [dict(report_head_id=head.id, work_date=date, details=pack_details(v)) for date, v in days.items()])
+        # アカウント全体の集計用に、明細を消す前にSQLで集計しておく
+        session.execute(
+            insert(ReportArchiveTotal).from_select(
+                list(TOTAL_KEYS) + ['quant', 'quant_kg', 'unweighed', 'total'],
+                select(
+                    *[getattr(ReportDetail, c) for c in TOTAL_KEYS],
+                    func.sum(ReportDetail.quant),
+                    func.sum(ReportDetail.quant_kg),
+                    func.sum(case((ReportDetail.quant_kg.is_(None), ReportDetail.quant))),
+                    func.sum(ReportDetail.quant * ReportDetail.cost),
+                ).where(
+                    ReportDetail.report_head_id == head.id
+                ).group_by(
+                    *[getattr(ReportDetail, c) for c in TOTAL_KEYS]
+                )))
+    with unlogged_details(session, head.id):
+        session.execute(delete(ReportDetail).where(ReportDetail.report_head_id == head.id))
+    # 明細の削除時にトリガーで索引からも消えるため、アーカイブした明細を登録し直す
+    add_search_rows(session, head.id, search_rows)
+    head.archived_date = datetime.datetime.now()
+
+    return len(rows)
+
+
+def restore_worksite(session, head):
+    """アーカイブした工事の明細を report_detail に戻す（明細IDも元のまま）。コミットは呼び出し元で行う
+
+    Args:
+        session (Session): DBセッション
+        head (ReportHead): 工事
+
+    Returns:
+        int: 戻した明細の数
+    """
+
+    rows = list()
+    for work_date, data in session.execute(
+            select(
+                ReportArchive.work_date,
+                ReportArchive.details,
+            ).where(
+                ReportArchive.report_head_id == head.id
+            )):
+        for d in unpack_details(data):
+            if d['reg_dtime'] is not None:
+                d['reg_dtime'] = datetime.datetime.strptime(d['reg_dtime'], DATETIME_FORMAT)
+            d['report_head_id'] = head.id
+            d['work_date'] = work_date
+            rows.append(d)
+
+    # 挿入時のトリガーで索引に登録されるため、アーカイブ時に登録した分は先に消す
+    delete_search_rows(session, [d['id'] for d in rows])
+    with unlogged_details(session, head.id):
+        if rows:
+            session.execute(insert(ReportDetail), rows)
+    session.execute(delete(ReportArchive).where(ReportArchive.report_head_id == head.id))
+    session.execute(delete(ReportArchiveTotal).where(ReportArchiveTotal.report_head_id == head.id))
+    head.archived_date = None
+
+    return len(rows)
+
+
+def archived_details(session, head_id, date_from=None, date_to=None):
+    """アーカイブした明細を ReportDetail.to_dict_nohead と同じ形式で取得する（作業日・ID順）
+
+    Args:
+        session (Session): DBセッション
+        head_id (int): 工事(ReportHead.id)
+        date_from (datetime, optional): 開始日
+        date_to (datetime, optional): 終了日（この日を含まない）
+    """
+
+    stmt = select(
+        ReportArchive.work_date,
+        ReportArchive.details,
+    ).where(
+        ReportArchive.report_head_id == head_id
+    ).order_by(
+        ReportArchive.work_date
+    )
+    if date_from is not None:
+        stmt = stmt.where(ReportArchive.work_date >= date_from)
+    if date_to is not None:
+        stmt = stmt.where(ReportArchive.work_date < date_to)
+
+    details = list()
+    for work_date, data in session.execute(stmt):
+        for d in unpack_details(data):
+            del d['reg_dtime']
+            d['work_date'] = work_date.strftime('%Y-%m-%d')
+            if d['memo'] is None:
+                d['memo'] = ""
+            details.append(d)
+    return details
+
+
+def archived_totals(session, head_id):
+    """アーカイブした明細の日毎・種別毎の数量と費用（/daily_report/{work_id}/summary と同じ集計）
+
+    Returns:
+        list: [(作業日(datetime), 種別, 数量, 費用)]
+    """
+
+    return session.execute(
+        select(
+            ReportArchiveTotal.work_date,
+            ReportArchiveTotal.type,
+            # 廃材はkgに換算した数量を集計する
+            func.sum(case(
+                (ReportArchiveTotal.type == ItemType.TRASH.value, ReportArchiveTotal.quant_kg),
+                else_=ReportArchiveTotal.quant)),
+            func.sum(ReportArchiveTotal.total),
+        ).where(
+            ReportArchiveTotal.report_head_id == head_id
+        ).group_by(
+            ReportArchiveTotal.work_date, ReportArchiveTotal.type
+        )).all()
+
+
+def archive_total_rows(conn):
+    """アーカイブした明細から集計（report_archive_total の行）を作成する（集計を作成する前のアーカイブの移行用）
+
+    Args:
+        conn (Connection): DB接続
+
+    Returns:
+        list: [{TOTAL_KEYSの列, 'quant', 'quant_kg', 'unweighed', 'total'}]
+    """
+
+    def add(a, b):
+        # SQLのSUMと同じく、NULLは含めない
+        if b is None:
+            return a
+        return b if a is None else a + b
+
+    totals = dict()
+    for head_id, work_date, data in conn.execute(
+            select(ReportArchive.report_head_id, ReportArchive.work_date, ReportArchive.details)):
+        for d in unpack_details(data):
+            key = (head_id, work_date, d['type'], d['name'], d['dest'])
+            t = totals.setdefault(key, dict(zip(TOTAL_KEYS, key), quant=None, quant_kg=None, unweighed=None, total=None))
+            t['quant'] = add(t['quant'], d['quant'])
+            t['quant_kg'] = add(t['quant_kg'], d['quant_kg'])
+            if d['quant_kg'] is None:
+                t['unweighed'] = add(t['unweighed'], d['quant'])
+            if d['quant'] is not None and d['cost'] is not None:
+                t['total'] = add(t['total'], d['quant'] * d['cost'])
+    return list(totals.values())
+
+
+def archived_types(session, keys):
+    """アーカイブした明細の種別を取得する（全文検索の結果用）
+
+    Args:
+        session (Session): DBセッション
+        keys (list): [(工事ID, 作業日(DBの値の文字列), 明細ID)]
+
+    Returns:
+        dict: {明細ID: 種別}
+    """
+
+    if not keys:
+        return dict()
+    ids = {detail_id for _, _, detail_id in keys}
+    head_ids = {head_id for head_id, _, _ in keys}
+    dates = {datetime.datetime.strptime(work_date[:10], '%Y-%m-%d') for _, work_date, _ in keys}
+
+    types = dict()
+    for data, in session.execute(
+            select(
+                ReportArchive.details
+            ).where(
+                ReportArchive.report_head_id.in_(head_ids)
+            ).where(
+                ReportArchive.work_date.in_(dates)
+            )):
+        for d in unpack_details(data):
+            if d['id'] in ids:
+                types[d['id']] = d['type']
+    return types
+
+
+def archive_completed(engine=None, days=ARCHIVE_AFTER_DAYS, now=None):
+    """完了日から days 日以上経った工事をアーカイブする。書き込みを長く止めないよう、工事毎にコミットする
+
+    Args:
+        engine (Engine, optional): 対象のDB。省略時は get_engine()
+        days (int): 完了日からの日数
+        now (datetime, optional): 基準日時。省略時は現在日時
+
+    Returns:
+        dict: {工事ID: 移した明細の数}
+    """
+
+    if engine is None:
+        engine = get_engine()
+    if now is None:
+        now = datetime.datetime.now()
+
+    with Session(engine) as session:
+        work_ids = session.scalars(
+            select(
+                ReportHead.id
+            ).where(
+                ReportHead.completed_date < now - datetime.timedelta(days=days)
+            ).where(
+                ReportHead.archived_date.is_(None)
+            ).order_by(
+                ReportHead.id
+            )).all()
+
+    archived = dict()
+    for work_id in work_ids:
+        with Session(engine) as session:
+            head = session.get(ReportHead, work_id)
+            # 取得後に完了を取り消された場合は対象外
+            if head.completed_date is None or head.archived_date is not None:
+                continue
+            archived[work_id] = archive_worksite(session, head)
+            session.commit()
+    return archived
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS, help='完了日からアーカイブするまでの日数')
+    parser.add_argument('--restore', type=int, default=None, metavar='WORK_ID', help='アーカイブから戻す工事ID')
+    parser.add_argument('--account', type=int, default=None, metavar='ACCOUNT_ID',
+                        help='シャーディング時: --restore の工事のアカウント(Account.id)')
+    args = parser.parse_args(argv)
+
+    if args.restore is not None:
+        with Session(get_engine(args.account)) as session:
+            head = session.get(ReportHead, args.restore)
+            if head is None or head.archived_date is None:
+                parser.error(f'アーカイブした工事ではありません: {args.restore}')
+            count = restore_worksite(session, head)
+            session.commit()
+        print(f'restored: work_id={args.restore} details={count}')
+        return
+
+    # シャーディング時はアカウント毎のDBを順に処理する
+    engines = [get_engine(account_id) for account_id in shard_account_ids()] or [get_engine()]
+    worksites = details = 0
+    for engine in engines:
+        archived = archive_completed(engine, days=args.days)
+        worksites += len(archived)
+        details += sum(archived.values())
+    print(f'archived: worksites={worksites} details={details}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""複数のGETをまとめて実行する（POST /batch）
+
+画面の初期表示などで続けて呼ぶGETを1回の通信にまとめる。各GETはアプリ内で
+（HTTP・nginxを通さずに）同じリクエストのcookieで実行し、並行して処理する。
+トークンはまとめたリクエストで1回だけデコードし、scope['state'] でサブリクエストに渡す
+（権限の確認は各GETのルートで行う）。
+各GETは別のスレッドで並行に実行されるため、DBのセッションは共有せず、各ルートが
+アカウントのエンジン（コネクションプール）からそれぞれ開く。
+"""
+import asyncio
+import logging
+from urllib.parse import (
+    quote,
+    unquote,
+    urlencode,
+    urlsplit,
+)
+
+import orjson
+
+
+logger = logging.getLogger(__name__)
+
+# 1回にまとめられるGETの数
+MAX_BATCH_REQUESTS = 20
+# まとめて実行できないパス（ストリーミング・入れ子）
+BATCH_EXCLUDED_PATHS = ('/batch', '/events')
+# 工事名のルートなど、リダイレクトをたどる回数
+MAX_BATCH_REDIRECTS = 3
+# サブリクエストの scope['state'] に入れる、デコード済みのトークン (cookieのトークン, デコードした値) の名前
+BATCH_TOKEN_STATE = 'batch_token'
+
+# サブリクエストに引き継がないヘッダ
+_DROP_HEADERS = (b'content-type', b'content-length', b'accept', b'accept-encoding', b'transfer-encoding')
+# URLエンコードする際にそのまま残す文字（エンコード済みの %XX も残す）
+_PATH_SAFE = "/%:@!$&'()*+,;=-._~"
+_QUERY_SAFE = _PATH_SAFE + '?'
+
+
+def _split_path(path):
+    """パス（?クエリを含んでもよい）を、URLエンコードしたパスとクエリ文字列に分ける
+
+    Args:
+        path (str): パス ex.) /daily_report/%E5%B7%A5%E4%BA%8B/summary?layout=columnar
+    """
+
+    url = urlsplit(path)
+    return quote(url.path, safe=_PATH_SAFE), quote(url.query, safe=_QUERY_SAFE)
+
+
+def is_batchable(path):
+    """まとめて実行できるパスか（?クエリを含んでもよい）"""
+
+    if not path.startswith('/') or path.startswith('//'):
+        return False
+    path = unquote(_split_path(path)[0])
+    return not any(path == p or path.startswith(p + '/') for p in BATCH_EXCLUDED_PATHS)
+
+
+async def _get(app, scope, raw_path, query_string, state):
+    sub_scope = dict(
+        scope,
+        method='GET',
+        # ルーティングはデコードしたパス、raw_path はリクエストラインと同じエンコードしたパス
+        path=unquote(raw_path),
+        raw_path=raw_path.encode('ascii'),
+        query_string=query_string.encode('ascii'),
+        headers=[(k, v) for k, v in scope['headers'] if k not in _DROP_HEADERS] + [(b'accept', b'application/json')],
+        # サブリクエスト毎に別の辞書にし、まとめたリクエストや他のGETの state を変更しない
+        state=dict(scope.get('state') or dict(), **(state or dict())),
+    )
+    sub_scope.pop('route', None)
+    sub_scope.pop('endpoint', None)
+    sub_scope.pop('path_params', None)
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    response = dict(status=500, headers=[], body=b'')
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = message.get('headers', [])
+        elif message['type'] == 'http.response.body':
+            response['body'] += message.get('body', b'')
+
+    try:
+        await app(sub_scope, receive, send)
+    except Exception:
+        # 500のレスポンスは送信済み。他のGETの結果は返す
+        logger.exception('batch: GET %s failed', raw_path)
+    return response
+
+
+async def run_get(app, scope, path, params=None, state=None):
+    """アプリ内でGETを実行する
+
+    Args:
+        app (ASGIApp): アプリ（Request.app）
+        scope (dict): まとめたリクエストのscope（cookie などのヘッダを引き継ぐ）
+        path (str): パス ex.) /master/staff 。URLエンコードしたパスや ?クエリ を含んでもよい
+        params (dict, optional): クエリパラメータ。リストは同じ名前で繰り返す（path のクエリの後に付ける）
+        state (dict, optional): サブリクエストの scope['state'] に加える値 ex.) {BATCH_TOKEN_STATE: (トークン, デコードした値)}
+
+    Returns:
+        dict:
+            status: ステータスコード
+            body: JSONのレスポンスはデコードした値、それ以外は文字列、ボディがなければNone
+            cookies: レスポンスの Set-Cookie の値のリスト
+    """
+
+    raw_path, query_string = _split_path(path)
+    if params:
+        query_string = '&'.join(q for q in (query_string, urlencode(params, doseq=True)) if q)
+    cookies = list()
+    for _ in range(MAX_BATCH_REDIRECTS + 1):
+        response = await _get(app, scope, raw_path, query_string, state)
+        headers = response['headers']
+        cookies.extend(v.decode('latin-1') for k, v in headers if k.lower() == b'set-cookie')
+        location = next((v.decode('latin-1') for k, v in headers if k.lower() == b'location'), None)
+        if not 300 <= response['status'] < 400 or location is None:
+            break
+        url = urlsplit(location)
+        if url.netloc or not is_batchable(url.path):
+            break
+        raw_path, query_string = _split_path(location)
+
+    body = response['body']
+    content_type = next((v.decode('latin-1') for k, v in response['headers'] if k.lower() == b'content-type'), '')
+    if not body:
+        body = None
+    elif content_type.startswith('application/json'):
+        body = orjson.loads(body)
+    else:
+        body = body.decode('utf-8', errors='replace')
+
+    return dict(status=response['status'], body=body, cookies=cookies)
+
+
+async def run_batch(request, calls, state=None):
+    """GETをまとめて並行に実行する
+
+    Args:
+        request (Request): まとめたリクエスト
+        calls (list): [(パス, クエリパラメータ)]
+        state (dict, optional): 各サブリクエストの scope['state'] に加える値
+
+    Returns:
+        list: calls と同じ順の run_get の結果
+    """
+
+    return await asyncio.gather(*[run_get(request.app, request.scope, path, params, state) for path, params in calls])
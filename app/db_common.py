@@ -1,10 +1,246 @@
+import glob
+import logging
 import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
 
 from sqlalchemy import (
     create_engine,
 )
 
 
-def get_engine():
-    db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db.sqlite')
-    return create_engine(f"sqlite:////{db_path}?charset=utf8", echo=False)
+logger = logging.getLogger(__name__)
+
+
+# 負荷試験などで別DBを使う場合は環境変数で指定する
+DB_PATH = os.getenv('db_path', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db.sqlite'))
+
+# シャーディング: 指定した場合、アカウント毎のデータを {SHARD_DIR}/account_{Account.id}.sqlite に保存する
+# アカウント・ユーザ（tables.GLOBAL_TABLES）は DB_PATH の共通DBに保存する
+SHARD_DIR = os.getenv('shard_dir')
+# 同時に開いておくアカウントDBのエンジン（コネクションプール）の数。超えた場合は最も使われていないものを閉じる
+SHARD_MAX_ENGINES = int(os.getenv('shard_max_engines', '32'))
+
+# 集計など読み取りのみのエンドポイントが使うスナップショット（オンラインバックアップ）の許容する古さ（秒）
+# 0の場合はスナップショットを使わない
+REPLICA_MAX_STALENESS = float(os.getenv('replica_max_staleness', '0'))
+# スナップショットを作り直す間隔（秒）。バックグラウンドのスレッドで作り直す
+REPLICA_REFRESH_INTERVAL = float(os.getenv('replica_refresh_interval', str(REPLICA_MAX_STALENESS / 2)))
+# この秒数読まれていないDBは、スナップショットの作り直しをやめる
+REPLICA_IDLE_SECONDS = 600
+
+# 共通DB（シャーディングしない場合は全てのデータ）のエンジン。プロセスで1つを使い回す
+_engine = None
+_engine_lock = threading.Lock()
+
+# _shard_lock はエンジンの辞書（LRU）の操作だけに使い、テーブルの作成中は保持しない
+_shard_engines = OrderedDict()
+_shard_lock = threading.Lock()
+# アカウントID → アカウントのDBを開く・テーブルを作成する間のロック（同じアカウントだけを待たせる）
+_shard_open_locks = dict()
+# テーブルを作成済み（create_shard_tables を実行済み）のアカウントID
+_shard_created = set()
+
+# DBのパス → {'engine': スナップショットのエンジン, 'ino': ファイルのinode, 'taken_at': 作成時刻, 'used_at': 最後に読んだ時刻}
+_replicas = OrderedDict()
+_replica_lock = threading.Lock()
+_replica_wakeup = threading.Event()
+_replica_refresher = None
+
+
+def create_sqlite_engine(path, readonly=False):
+    if readonly:
+        return create_engine(f"sqlite:///file:{path}?mode=ro&uri=true", echo=False)
+    return create_engine(f"sqlite:////{path}?charset=utf8", echo=False)
+
+
+def get_engine(account_id=None):
+    """DBのエンジンを取得する
+
+    Args:
+        account_id (int, optional): アカウント(Account.id)。シャーディング時はアカウントのDBを返す。
+            アカウント・ユーザを読み書きする場合は指定しない（共通DB）
+    """
+
+    global _engine
+
+    if SHARD_DIR is None or account_id is None:
+        # リクエスト毎にエンジン（コネクションプール）を作らず、接続を使い回す
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_sqlite_engine(DB_PATH)
+            return _engine
+    return get_shard_engine(account_id)
+
+
+def shard_path(account_id):
+    return os.path.join(SHARD_DIR, f'account_{int(account_id)}.sqlite')
+
+
+def get_shard_engine(account_id):
+    """アカウントのDBのエンジンを取得する。開いていなければ開き、テーブルがなければ作成する
+
+    Args:
+        account_id (int): アカウント(Account.id)
+    """
+
+    account_id = int(account_id)
+    with _shard_lock:
+        engine = _shard_engines.get(account_id)
+        if engine is not None:
+            _shard_engines.move_to_end(account_id)
+            return engine
+        open_lock = _shard_open_locks.setdefault(account_id, threading.Lock())
+
+    from tables import create_shard_tables
+
+    # テーブルの作成（DDL・移行）は時間がかかるため、全体のロックの外で、DB毎に1回だけ行う
+    with open_lock:
+        with _shard_lock:
+            # 待っている間に他のスレッドが開いた場合
+            engine = _shard_engines.get(account_id)
+            if engine is not None:
+                _shard_engines.move_to_end(account_id)
+                return engine
+
+        engine = create_sqlite_engine(shard_path(account_id))
+        if account_id not in _shard_created:
+            os.makedirs(SHARD_DIR, exist_ok=True)
+            create_shard_tables(engine)
+            _shard_created.add(account_id)
+
+        with _shard_lock:
+            _shard_engines[account_id] = engine
+            while len(_shard_engines) > SHARD_MAX_ENGINES:
+                # 使用中の接続はそのまま使え、返却時に閉じられる
+                _, old = _shard_engines.popitem(last=False)
+                old.dispose()
+    return engine
+
+
+def shard_account_ids():
+    """DBが作成済みのアカウント(Account.id)の一覧。シャーディングしていない場合は空"""
+
+    if SHARD_DIR is None:
+        return []
+    ids = list()
+    for path in glob.glob(os.path.join(SHARD_DIR, 'account_*.sqlite')):
+        m = re.fullmatch(r'account_(\d+)\.sqlite', os.path.basename(path))
+        if m:
+            ids.append(int(m.group(1)))
+    return sorted(ids)
+
+
+def get_read_engine(account_id=None, written_at=None):
+    """集計など読み取りのみの処理用のエンジンを取得する
+
+    スナップショットはバックグラウンドのスレッドが作り直すため、この関数ではバックアップを行わない。
+    スナップショットを使わない設定の場合や、まだ作成していない・REPLICA_MAX_STALENESS 秒より古い場合、
+    written_at 以降に作成したスナップショットがない場合は get_engine と同じ
+
+    Args:
+        account_id (int, optional): アカウント(Account.id)。get_engine と同じ
+        written_at (float, optional): クライアントが最後に書き込んだ時刻(time.time())。書き込んだ内容を読む場合に指定する
+    """
+
+    engine = get_engine(account_id)
+    if REPLICA_MAX_STALENESS <= 0:
+        return engine
+
+    path = DB_PATH if SHARD_DIR is None or account_id is None else shard_path(account_id)
+    now = time.time()
+    with _replica_lock:
+        _start_replica_refresher()
+        replica = _replicas.get(path)
+        if replica is None:
+            # 初めて読むDBは、スナップショットができるまでDBから読む
+            replica = _replicas[path] = dict(engine=None, ino=None, taken_at=0.0, used_at=now)
+            _replica_wakeup.set()
+        replica['used_at'] = now
+        _replicas.move_to_end(path)
+        while len(_replicas) > SHARD_MAX_ENGINES + 1:
+            _, old = _replicas.popitem(last=False)
+            if old['engine'] is not None:
+                old['engine'].dispose()
+        replica_engine, taken_at = replica['engine'], replica['taken_at']
+
+    if replica_engine is None or now - taken_at > REPLICA_MAX_STALENESS:
+        return engine
+    if written_at is not None and written_at >= taken_at:
+        return engine
+    return replica_engine
+
+
+def _start_replica_refresher():
+    """スナップショットを作り直すスレッドを開始する。_replica_lock を取得して呼ぶこと"""
+
+    global _replica_refresher
+    if _replica_refresher is None or not _replica_refresher.is_alive():
+        _replica_refresher = threading.Thread(target=_refresh_replicas, name='replica-refresher', daemon=True)
+        _replica_refresher.start()
+
+
+def _refresh_replicas():
+    while True:
+        _replica_wakeup.clear()
+        with _replica_lock:
+            replicas = [(path, r['taken_at'], r['used_at']) for path, r in _replicas.items()]
+        now = time.time()
+        for path, taken_at, used_at in replicas:
+            if now - used_at > REPLICA_IDLE_SECONDS:
+                # しばらく読まれていないDBは作り直しをやめる
+                with _replica_lock:
+                    r = _replicas.get(path)
+                    if r is not None and r['used_at'] == used_at:
+                        del _replicas[path]
+                        if r['engine'] is not None:
+                            r['engine'].dispose()
+                continue
+            if now - taken_at >= REPLICA_REFRESH_INTERVAL:
+                try:
+                    _refresh_replica(path)
+                except Exception:
+                    logger.exception('replica: refresh %s failed', path)
+        _replica_wakeup.wait(REPLICA_REFRESH_INTERVAL / 2)
+
+
+def _refresh_replica(path):
+    """スナップショットを作り直し、新しいファイルのエンジンに切り替える（リクエストは置き換えるまで前のスナップショットを読む）"""
+
+    replica_path = f'{path}.replica'
+    try:
+        st = os.stat(replica_path)
+    except FileNotFoundError:
+        st = None
+    # 複数プロセスで同じスナップショットを使うため、作成時刻はファイルの更新時刻とする。
+    # 他のプロセスが作り直したばかりの場合はそのファイルを使う
+    if st is None or time.time() - st.st_mtime >= REPLICA_REFRESH_INTERVAL:
+        started_at = time.time()
+        tmp_path = f'{replica_path}.{os.getpid()}.tmp'
+        src = sqlite3.connect(path)
+        dst = sqlite3.connect(tmp_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        # バックアップ中にコミットされた書き込みは含まれないことがあるため、開始時刻を作成時刻にする
+        os.utime(tmp_path, (started_at, started_at))
+        # 置き換え前のファイルは、開いている接続が閉じるまで読める
+        os.replace(tmp_path, replica_path)
+        st = os.stat(replica_path)
+
+    with _replica_lock:
+        replica = _replicas.get(path)
+        if replica is None:
+            return
+        if replica['ino'] != st.st_ino:
+            old = replica['engine']
+            replica['engine'] = create_sqlite_engine(replica_path, readonly=True)
+            replica['ino'] = st.st_ino
+            if old is not None:
+                old.dispose()
+        replica['taken_at'] = st.st_mtime
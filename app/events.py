@@ -0,0 +1,119 @@
+"""画面の自動更新用のイベント配信（Server-Sent Events）
+
+マスタ・日報の書き込みをコミットした後に publish したイベントを、同じアカウントで
+GET /events を開いている画面に送る。画面は変更された部分だけを取得し直す。
+
+待機中の接続はキュー1つとコルーチン1つのみで、スレッドやDB接続は使わない。
+イベントはプロセス内で配信する（uvicornのワーカーは1つの前提）。
+
+イベント:
+    master: {'master': マスタ種別}                     マスタの登録・削除
+    report: {'work_id': 工事ID, 'dates': [作業日]}     日報の登録
+    work:   {'work_id': 工事ID}                        工事の完了・完了の取り消し
+"""
+import asyncio
+import os
+import threading
+
+import orjson
+
+
+# 接続毎に溜められるイベントの数。超えた場合は reload を送り、画面全体を取得し直させる
+EVENT_QUEUE_SIZE = int(os.getenv('event_queue_size', '64'))
+# 接続を保つためのコメントを送る間隔（秒）。nginxの proxy_read_timeout(60秒) より短くする
+EVENT_HEARTBEAT = float(os.getenv('event_heartbeat', '20'))
+
+EVENT_MASTER = 'master'
+EVENT_REPORT = 'report'
+EVENT_WORK = 'work'
+EVENT_RELOAD = 'reload'
+
+# アカウント(Account.id) → {接続}
+_subscribers = dict()
+_lock = threading.Lock()
+
+
+class _Subscriber:
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.overflow = False
+
+    def put(self, message):
+        # イベントループのスレッドで呼ぶ
+        if self.overflow:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # 読み切れない接続には個別のイベントをやめ、最後に reload を1つ送る
+            self.overflow = True
+
+
+def format_event(event, data):
+    """Server-Sent Events の1件の形式にする"""
+
+    return b'event: ' + event.encode() + b'\ndata: ' + orjson.dumps(data) + b'\n\n'
+
+
+def publish(account_id, event, **data):
+    """アカウントの画面にイベントを送る。コミットした後に呼ぶこと（どのスレッドからでもよい）
+
+    Args:
+        account_id (int): アカウント(Account.id)
+        event (str): イベント名（EVENT_MASTER など）
+        data: イベントの内容
+    """
+
+    with _lock:
+        subscribers = list(_subscribers.get(account_id, ()))
+    if not subscribers:
+        return
+
+    # 全ての接続に同じバイト列を送る
+    message = format_event(event, data)
+    for s in subscribers:
+        s.loop.call_soon_threadsafe(s.put, message)
+
+
+def subscriber_count():
+    """接続中の画面の数"""
+
+    with _lock:
+        return sum(len(s) for s in _subscribers.values())
+
+
+async def subscribe(account_id, is_disconnected):
+    """アカウントのイベントを Server-Sent Events の形式で返す（StreamingResponse 用）
+
+    Args:
+        account_id (int): アカウント(Account.id)
+        is_disconnected (callable): 切断されたか（Request.is_disconnected）
+    """
+
+    s = _Subscriber()
+    with _lock:
+        _subscribers.setdefault(account_id, set()).add(s)
+    try:
+        # 切断後に再接続するまでの時間（ミリ秒）
+        yield b'retry: 3000\n\n'
+        while True:
+            try:
+                message = await asyncio.wait_for(s.queue.get(), timeout=EVENT_HEARTBEAT)
+            except asyncio.TimeoutError:
+                if await is_disconnected():
+                    break
+                yield b': ping\n\n'
+                continue
+            yield message
+            if s.overflow and s.queue.empty():
+                s.overflow = False
+                yield format_event(EVENT_RELOAD, {})
+    finally:
+        with _lock:
+            subscribers = _subscribers.get(account_id)
+            if subscribers is not None:
+                subscribers.discard(s)
+                if not subscribers:
+                    del _subscribers[account_id]
@@ -3,7 +3,9 @@ import hashlib
 import logging
 import os
 import re
+import time
 from typing import (
+    List,
     Union,
 )
 
@@ -11,6 +13,7 @@ from fastapi import (
     Depends,
     FastAPI,
     HTTPException,
+    Query,
     Request,
     Response,
     status,
@@ -21,8 +24,9 @@ from fastapi_csrf_protect import CsrfProtect
 from fastapi_csrf_protect.exceptions import CsrfProtectError
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import (
-    JSONResponse,
     HTMLResponse,
+    RedirectResponse,
+    StreamingResponse,
 )
 from fastapi.security import (
     OAuth2PasswordBearer,
@@ -32,21 +36,89 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from functools import wraps
 from jose.exceptions import JWTError
+import orjson
 from sqlalchemy import (
+    case,
+    delete,
     func,
+    insert,
+    literal,
     select,
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import (
     NoResultFound,
 )
 from sqlalchemy.orm import Session
-from sqlalchemy.sql import exists
 
-from db_common import get_engine
+from analytics import (
+    DASHBOARD_SORT_KEYS,
+    UTILIZATION_TYPES,
+    monthly_pivot,
+    next_month,
+    parse_date,
+    parse_month,
+    resource_utilization,
+    waste_tonnage,
+    worksite_dashboard,
+)
+from archive import (
+    archived_details,
+    archived_totals,
+    restore_worksite,
+)
+from api_response import (
+    APIResponse,
+    MsgpackRoute,
+)
+from batch import (
+    BATCH_TOKEN_STATE,
+    MAX_BATCH_REQUESTS,
+    is_batchable,
+    run_batch,
+)
+from events import (
+    EVENT_MASTER,
+    EVENT_REPORT,
+    EVENT_WORK,
+    publish,
+    subscribe,
+    subscriber_count,
+)
+from db_common import (
+    REPLICA_MAX_STALENESS,
+    get_engine,
+    get_read_engine,
+)
+from search import (
+    LOOKUP_MAX_LIMIT,
+    LOOKUP_SOURCES,
+    SEARCH_MAX_LIMIT,
+    WORKSITE_STATUS,
+    lookup,
+    search_reports,
+)
+from single_flight import (
+    single_flight,
+    stats as single_flight_stats,
+)
+from sync import (
+    OP_DELETE,
+    OP_UPSERT,
+    SYNC_MAX_LIMIT,
+    SYNC_WRITABLE,
+    apply_changes,
+    changes_since,
+)
+from write_queue import (
+    run_write,
+    stats as write_queue_stats,
+)
 from tables import (
+    GLOBAL_TABLES,
     Account,
+    association_table,
     CarMaster,
-    CustomerMaster,
     DestMaster,
     ItemMaster,
     LeaseMaster,
@@ -59,6 +131,7 @@ from tables import (
 )
 from schemas import (
     AccountModel,
+    BatchRequest,
     CompleteReport,
     CsrfSettings,
     DeleteTarget,
@@ -66,10 +139,13 @@ from schemas import (
     MasterParams,
     MAP_MASTER,
     NewUser,
+    BatchReport,
     Report,
+    SyncRequest,
     Token,
     UNIT_TYPE,
     UserInvitation,
+    UserInvitations,
 )
 from app_utils import (
     authenticate_user,
@@ -83,6 +159,9 @@ from app_utils import (
     save_uploaded_file,
     get_hashed_file_name,
     get_account_logo,
+    LAYOUT_COLUMNAR,
+    report_detail_rows,
+    to_columnar,
 )
 
 
@@ -100,7 +179,9 @@ from app_utils import (
 https://www.stackhawk.com/blog/csrf-protection-in-fastapi/
 https://github.com/aekasitt/fastapi-csrf-protect
 """
-app = FastAPI()
+app = FastAPI(default_response_class=APIResponse)
+# Accept / Content-Type が application/msgpack の場合はMessagePackで送受信する
+app.router.route_class = MsgpackRoute
 app.mount(path="/static", app=StaticFiles(directory=os.path.join(os.path.dirname(__file__), "static")), name="static")
 app.mount(path="/userdata", app=StaticFiles(directory=os.path.join(os.path.dirname(__file__), "userdata")), name="userdata")
 templates = Jinja2Templates(directory=os.path.join(os.path.dirname(__file__), "templates"))
@@ -118,6 +199,40 @@ LOGO_FILE_EXT = '.png'
 MIN_PASS_LEN = 10
 token_exp = float(os.getenv('token_exp', 3600))
 cookie_max_age = os.getenv('token_exp', 3600)
+# プロセス全体の稼働状況（/write_queue/stats など）を取得できるアカウント（Account.account_id のカンマ区切り）
+STATS_ACCOUNTS = [a.strip() for a in os.getenv('stats_accounts', '').split(',') if a.strip()]
+
+MASTER_MENU = {
+    'staff': {
+        'menu_name': '人員'
+    },
+    'car': {
+        'menu_name': '車両'
+    },
+    'lease': {
+        'menu_name': 'リース'
+    },
+    'machine': {
+        'menu_name': '重機'
+    },
+    'trash': {
+        'menu_name': '廃材処分費'
+    },
+    'customer': {
+        'menu_name': '受注先'
+    },
+    'dest': {
+        'menu_name': '廃材処分先'
+    },
+    'item': {
+        'menu_name': '廃材品目'
+    },
+    'work': {
+        'menu_name': '工事進捗'
+    },
+}
+# 固定なので起動時に一度だけJSON化しておく
+MASTER_MENU_JSON = orjson.dumps(MASTER_MENU).decode()
 
 TOKEN_KEY_FILE = os.path.join(os.path.dirname(__file__), "token.key")
 if os.path.isfile(TOKEN_KEY_FILE):
@@ -150,12 +265,12 @@ def get_csrf_config():
 @app.exception_handler(RequestValidationError)
 async def handler(request: Request, exc: RequestValidationError):
     print(exc)
-    return JSONResponse(content={}, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    return APIResponse(content={}, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
 
 @app.exception_handler(CsrfProtectError)
 def csrf_protect_exception_handler(request: Request, exc: CsrfProtectError):
-  return JSONResponse(status_code=exc.status_code, content={"detail": exc.message})
+  return APIResponse(status_code=exc.status_code, content={"detail": exc.message})
 
 
 def auth_required(func):
@@ -163,8 +278,7 @@ def auth_required(func):
     def wrapper(*args, **kwargs):
 
         try:
-            decoded_token = get_decoded_token(
-                kwargs['request'].cookies['token'], key=token_key)
+            decoded_token = get_request_token(kwargs['request'])
         except JWTError as e:
             return templates.TemplateResponse(
                 "invalid.html", {
@@ -183,6 +297,58 @@ def auth_required(func):
     return wrapper
 
 
+def get_request_token(request: Request):
+    """リクエストのcookieのトークンをデコードする
+
+    /batch のサブリクエストは、まとめたリクエストでデコードしたトークンを使う（同じトークンの場合のみ）
+    """
+
+    token = request.cookies['token']
+    batch_token = request.scope.get('state', dict()).get(BATCH_TOKEN_STATE)
+    if batch_token is not None and batch_token[0] == token:
+        return batch_token[1]
+    return get_decoded_token(token, key=token_key)
+
+
+def get_account_token(request: Request, account_uuid: int):
+    """リクエストのトークンをデコードし、パスのアカウントのトークンか確認する。違う場合・トークンがない場合は403
+
+    Args:
+        request (Request): リクエスト
+        account_uuid (int): パスで指定したアカウント(Account.id)
+    """
+
+    try:
+        token = get_request_token(request) if request.cookies.get('token') else None
+    except JWTError:
+        token = None
+    if token is None or token.get('account_uuid') != account_uuid:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="このアカウントは操作できません",
+        )
+    return token
+
+
+def get_stats_token(request: Request):
+    """稼働状況のルート用。全アカウント分の値を返すため、STATS_ACCOUNTS のアカウントでなければ403
+
+    Args:
+        request (Request): リクエスト
+    """
+
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+    with Session(get_engine()) as session:
+        account_id = session.scalar(select(Account.account_id).where(Account.id == token['account_uuid']))
+    if account_id not in STATS_ACCOUNTS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="稼働状況を取得する権限がありません",
+        )
+    return token
+
+
 def is_valid_password(password):
     # パスワードは8文字以上、大文字・小文字・数字・特殊文字を含む
     if re.fullmatch(
@@ -203,8 +369,9 @@ def top_page(request: Request):
 
 @app.get("/csrftoken/")
 async def get_csrf_token(csrf_protect:CsrfProtect = Depends()):
-	response = JSONResponse(status_code=200, content={'csrf_token':'cookie'})
-	csrf_protect.set_csrf_cookie(response)
+	csrf_token, signed_token = csrf_protect.generate_csrf_tokens()
+	response = APIResponse(status_code=200, content={'csrf_token': csrf_token})
+	csrf_protect.set_csrf_cookie(signed_token, response)
 	return response
 
 
@@ -214,7 +381,7 @@ async def login_for_access_token_with_account(
     form_data: OAuth2PasswordRequestForm = Depends(),
     account_id: Union[str, None] = None,
     csrf_protect: CsrfProtect = Depends(),
-) -> JSONResponse:
+) -> APIResponse:
 
     await csrf_protect.validate_csrf(request)
     user = authenticate_user(form_data.username, form_data.password)
@@ -260,7 +427,7 @@ async def login_for_access_token_with_account(
         user_uuid=user_uuid, account_uuid=account_uuid, token_key=token_key, exp_seconds=token_exp
     )
     token = Token(access_token=access_token, token_type="bearer")
-    response = JSONResponse(content=dict(user_name=user_name, account_name=account_name))
+    response = APIResponse(content=dict(user_name=user_name, account_name=account_name))
     response.set_cookie(key="token", value=access_token, samesite='strict')
     response.set_cookie(key="account_uuid", value=account_uuid, samesite='strict')
     csrf_protect.unset_csrf_cookie(response)
@@ -273,7 +440,7 @@ async def login_for_access_token(
     request: Request,
     csrf_protect: CsrfProtect = Depends(),
     form_data: OAuth2PasswordRequestForm = Depends(),
-) -> JSONResponse:
+) -> APIResponse:
     
     await csrf_protect.validate_csrf(request)
 
@@ -288,7 +455,7 @@ async def login_for_access_token(
         user_uuid=user['id'], token_key=token_key, exp_seconds=token_exp
     )
     token = Token(access_token=access_token, token_type="bearer")
-    response = JSONResponse(content=dict(user_name=user['fullname']))
+    response = APIResponse(content=dict(user_name=user['fullname']))
     response.set_cookie(key="token", value=access_token, samesite='strict')
     # response.set_cookie(key="user_name", value=user['fullname'], samesite='strict')
     csrf_protect.unset_csrf_cookie(response)
@@ -340,7 +507,7 @@ async def get_user_info(request: Request, user_id: str):
         except NoResultFound:
             return Response(status_code=404)
 
-    return JSONResponse(status_code=200, content=dict(user=user.to_dict_nopass()))
+    return APIResponse(status_code=200, content=dict(user=user.to_dict_nopass()))
 
 
 @app.post("/user/create")
@@ -357,39 +524,33 @@ async def create_user(request: Request, new_user: NewUser, csrf_protect: CsrfPro
     if fullname is None or fullname == "":
         fullname = USER_DEFAULT_FULLNAME
 
-    with Session(get_engine()) as session:
+    # hashed_pwd = hashlib.sha256(pwd.encode()).hexdigest()
+    hashed_pwd = get_password_hash(new_user.password)
 
-        # 登録済みチェック
-        if session.query(exists().where(User.user_id == new_user.username)).scalar():
-            raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail="そのユーザ名はすでに使用されています",
-            )
+    def write(session):
+        # 登録済みの場合は登録せず、IDも返らない（確認と登録を1文で行う）
+        return session.scalar(
+            sqlite_insert(User).values(
+                user_id=new_user.username,
+                user_pwd=hashed_pwd,
+                fullname=fullname,
+            ).on_conflict_do_nothing().returning(User.id))
 
-        # hashed_pwd = hashlib.sha256(pwd.encode()).hexdigest()
-        hashed_pwd = get_password_hash(new_user.password)
-        user = User(
-            user_id=new_user.username,
-            user_pwd=hashed_pwd,
-            fullname=fullname,
+    user_id = await run_write(write)
+    if user_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="そのユーザ名はすでに使用されています",
         )
 
-        try:
-            session.add_all([user])
-            session.commit()
-        except Exception as e:
-            print(type(e))
-            session.rollback()
-            raise e
-
-    return JSONResponse(status_code=201, content=dict(detail='succeeded'))
+    return APIResponse(status_code=201, content=dict(detail='succeeded'))
 
 
 @app.post("/sign_out")
 async def sign_out(request: Request, response: Response, csrf_protect: CsrfProtect = Depends()):
 
     await csrf_protect.validate_csrf(request)
-    token = get_decoded_token(request.cookies['token'], key=token_key)
+    token = get_request_token(request)
 
     if token is None:
         Response(status_code=403)
@@ -399,7 +560,7 @@ async def sign_out(request: Request, response: Response, csrf_protect: CsrfProte
     response.delete_cookie(key="account_id")
 
     # return RedirectResponse('/home', 303)
-    return JSONResponse(content={'dummy': 'dummy'})
+    return APIResponse(content={'dummy': 'dummy'})
 
 
 @app.get("/home", response_class=HTMLResponse)
@@ -501,6 +662,24 @@ def account_setting_page(request: Request, account_uuid: int, csrf_protect: Csrf
     return response
 
 
+def insert_account_users(account_uuid, user_ids):
+    """アカウントにユーザを追加するINSERT文。存在しないユーザと登録済みのユーザは追加しない
+
+    Args:
+        account_uuid (int): アカウント(Account.id)
+        user_ids (list): ユーザ(User.id)
+    """
+
+    return sqlite_insert(association_table).from_select(
+        ['account_id', 'user_id'],
+        select(
+            literal(account_uuid), User.id
+        ).where(
+            User.id.in_(user_ids)
+        )
+    ).on_conflict_do_nothing()
+
+
 @app.post("/account/{account_id}")
 # @auth_required # うまく動かないので後回し
 async def add_account(request: Request, account_id: str, account: AccountModel, csrf_protect: CsrfProtect = Depends()):
@@ -518,27 +697,28 @@ async def add_account(request: Request, account_id: str, account: AccountModel,
             detail=f"パスワードは8文字以上、大文字・小文字・数字・記号を含むようにしてください",
         )
 
-    with Session(get_engine()) as session:
-        # 登録済みチェック
-        if session.query(exists().where(Account.account_id == account_id)).scalar():
-            return JSONResponse(status_code=409, content=dict(detail='すでに使用されているIDです'))
+    def write(session):
+        # 登録済みの場合は登録せず、IDも返らない
+        account_uuid = session.scalar(
+            sqlite_insert(Account).values(
+                account_id=account_id,
+                account_pwd=hashlib.sha256(account.pwd.encode()).hexdigest(),
+                fullname=account.name
+            ).on_conflict_do_nothing().returning(Account.id))
+        if account_uuid is None:
+            return None
 
-        data = Account(
-            account_id=account_id,
-            account_pwd=hashlib.sha256(account.pwd.encode()).hexdigest(),
-            fullname=account.name
-        )
-        session.add(data)
-        # 登録者を初期ユーザとして登録
-        stmt = select(User).where(User.id == token['sub'])
-        try:
-            user = session.scalars(stmt).one()
-        except NoResultFound:
-            return Response(status_code=403)
-        data.users = [user]
-        session.commit()
+        # 登録者を初期ユーザとして登録。登録できなければアカウントの登録も取り消す
+        added = session.scalar(
+            insert_account_users(account_uuid, [int(token['sub'])]).returning(association_table.c.user_id))
+        if added is None:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
+        return account_uuid
 
-    return JSONResponse(status_code=200, content={'dummy': 'dummy'})
+    if await run_write(write) is None:
+        return APIResponse(status_code=409, content=dict(detail='すでに使用されているIDです'))
+
+    return APIResponse(status_code=200, content={'dummy': 'dummy'})
 
 
 @app.get("/account/{account_uuid}/account_logo")
@@ -573,38 +753,69 @@ def get_account_users(request: Request, account_uuid: int):
 async def add_user_to_account(request: Request, account_uuid: int, user_in: UserInvitation, csrf_protect: CsrfProtect = Depends()):
 
     await csrf_protect.validate_csrf(request)
-    token = get_decoded_token(
-        request.cookies['token'], key=token_key, algorithms=ALGORITHM)
+    # 他のアカウントにユーザを追加させない（書き込みをキューに入れる前に確認する）
+    get_account_token(request, account_uuid)
+
+    def write(session):
+        added = session.scalar(
+            insert_account_users(account_uuid, [user_in.uuid]).returning(association_table.c.user_id))
+        if added is None:
+            # 登録されなかった場合のみ、理由を確認する
+            if session.get(User, user_in.uuid) is None or session.get(Account, account_uuid) is None:
+                return 404
+            return 409
+        return 200
+
+    result = await run_write(write)
+    if result == 404:
+        return Response(status_code=404)
+    if result == 409:
+        return APIResponse(status_code=409, content=dict(detail='登録済み'))
 
-    if token is None:
-        Response(status_code=403)
-    token = validate_token(token, ['account_uuid'])
+    return APIResponse(status_code=200, content={'dummy': 'dummy'})
 
-    with Session(get_engine()) as session:
-        user = session.scalars(
-            select(
-                User
-            ).where(
-                User.id == user_in.uuid
-            )
-        ).one()
 
-        account = session.scalars(
-            select(
-                Account
-            ).where(
-                Account.id == account_uuid
-            )
-        ).one()
+# 一度に追加できるユーザの数
+MAX_BULK_USERS = 100
 
-        for account_user in account.users:
-            if account_user == user:
-                return JSONResponse(status_code=409, content=dict(detail='登録済み'))
 
-        account.users.append(user)
-        session.commit()
+@app.post("/account/{account_uuid}/users/add")
+async def add_users_to_account(request: Request, account_uuid: int, users_in: UserInvitations, csrf_protect: CsrfProtect = Depends()):
+    """複数のユーザをまとめてアカウントに追加する
+
+    added は追加したユーザ、registered は登録済みのユーザ、not_found は存在しないユーザのID
+    """
+
+    await csrf_protect.validate_csrf(request)
+    # 他のアカウントにユーザを追加させない（書き込みをキューに入れる前に確認する）
+    get_account_token(request, account_uuid)
+
+    uuids = list(dict.fromkeys(users_in.uuids))
+    if len(uuids) == 0 or len(uuids) > MAX_BULK_USERS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"ユーザは1～{MAX_BULK_USERS}人で指定してください",
+        )
+
+    def write(session):
+        if session.get(Account, account_uuid) is None:
+            return None
+
+        added = set(session.scalars(
+            insert_account_users(account_uuid, uuids).returning(association_table.c.user_id)))
+        existing = set(session.scalars(select(User.id).where(User.id.in_(uuids))))
+        return added, existing
+
+    result = await run_write(write)
+    if result is None:
+        return Response(status_code=404)
+    added, existing = result
 
-    return JSONResponse(status_code=200, content={'dummy': 'dummy'})
+    return APIResponse(status_code=200, content=dict(
+        added=[u for u in uuids if u in added],
+        registered=[u for u in uuids if u in existing and u not in added],
+        not_found=[u for u in uuids if u not in existing],
+    ))
 
 
 @app.post("/account/{account_uuid}/profimage")
@@ -628,11 +839,12 @@ async def upload_account_logo(account_uuid: int,
     save_path = os.path.join(LOGO_DIR, 'account', file_name)
     save_uploaded_file(file, save_path + LOGO_FILE_EXT)
 
-    with Session(get_engine()) as session:
+    def write(session):
         stmt = select(Account).where(Account.id == account_uuid)
         d = session.scalars(stmt).one()
         d.logo_name = file_name
-        session.commit()
+
+    await run_write(write)
 
     return {"filename": file.filename}
 
@@ -654,41 +866,12 @@ def master_top_page(request: Request, csrf_protect: CsrfProtect = Depends()):
             status_code=403
         )
 
-    param = dict()
-    param['menu'] = {
-        'staff': {
-            'menu_name': '人員'
-        },
-        'car': {
-            'menu_name': '車両'
-        },
-        'lease': {
-            'menu_name': 'リース'
-        },
-        'machine': {
-            'menu_name': '重機'
-        },
-        'trash': {
-            'menu_name': '廃材処分費'
-        },
-        'customer': {
-            'menu_name': '受注先'
-        },
-        'dest': {
-            'menu_name': '廃材処分先'
-        },
-        'item': {
-            'menu_name': '廃材品目'
-        },
-        'work': {
-            'menu_name': '工事進捗'
-        },
-    }
     csrf_token, signed_token = csrf_protect.generate_csrf_tokens()
     response = templates.TemplateResponse(
         "master_top.html", {
             "request": request,
-            "menu": param['menu'],
+            "menu": MASTER_MENU,
+            "menu_json": MASTER_MENU_JSON,
             "csrf_token": csrf_token,
         }
     )
@@ -699,21 +882,37 @@ def master_top_page(request: Request, csrf_protect: CsrfProtect = Depends()):
 # == Master 品目＆費用 のもの以外は追加処理が必要
 
 
+def get_master_account_id(master_type, account_id):
+    """マスタ種別のDBのアカウント（get_engine の引数）。アカウント・ユーザは共通DBのためNone"""
+
+    if MAP_MASTER[master_type].__tablename__ in GLOBAL_TABLES:
+        return None
+    return account_id
+
+
 @app.get("/master/{master_type}")
 @auth_required
-def get_master(request: Request, master_type):
+def get_master(request: Request, master_type, layout: Union[str, None] = None):
 
-    token = get_decoded_token(request.cookies['token'], key=token_key)
+    token = get_request_token(request)
     token = validate_token(token)
 
-    with Session(get_engine()) as session:
+    with Session(get_engine(get_master_account_id(master_type, token['account_uuid']))) as session:
         stmt = select(MAP_MASTER[master_type]).where(
             MAP_MASTER[master_type].account_id == token['account_uuid'])
         db_data = session.scalars(stmt)
         data = get_master_data(db_data, master_type,
                                account_id=token['account_uuid'])
 
-    return JSONResponse(content=data)
+    if layout == LAYOUT_COLUMNAR:
+        col_values = data['col_values']
+        keys = list(col_values[0]) if len(col_values) > 0 else []
+        data['col_values'] = to_columnar(
+            (tuple(d.values()) for d in col_values), keys,
+            dictionary_keys=['dest_id', 'item_id', 'unit_type'],
+        )
+
+    return APIResponse(content=data)
 
 
 @app.post("/master/{master_type}")
@@ -725,23 +924,25 @@ async def add_master(request: Request, params: MasterParams, master_type, csrf_p
     """
 
     await csrf_protect.validate_csrf(request)
-    token = get_decoded_token(request.cookies['token'], key=token_key)
+    token = get_request_token(request)
     token = validate_token(token, ['account_uuid'])
 
     register_data = params.params
     register_data['account_id'] = token['account_uuid']
-    new = MAP_MASTER[master_type](
-        **register_data
-    )
-    with Session(get_engine()) as session:
-        if master_type not in ['trash']:
-            if session.query(exists().where(MAP_MASTER[master_type].name == register_data['name']).where(MAP_MASTER[master_type].account_id == token['account_uuid'])).scalar():
-                return JSONResponse(status_code=409, content=dict(detail='登録済みです。'))
-        session.add(new)
-        session.commit()
-        new_id = new.id
 
-    return JSONResponse(status_code=200, content={'new_id': new_id})
+    model = MAP_MASTER[master_type]
+
+    def write(session):
+        # 同じ名前（廃材処分費は処分先・品名・単位）が登録済みの場合は登録せず、IDも返らない
+        return session.scalar(
+            sqlite_insert(model).values(**register_data).on_conflict_do_nothing().returning(model.id))
+
+    new_id = await run_write(write, get_master_account_id(master_type, token['account_uuid']))
+    if new_id is None:
+        return APIResponse(status_code=409, content=dict(detail='登録済みです。'))
+    publish(token['account_uuid'], EVENT_MASTER, master=master_type)
+
+    return mark_written(APIResponse(status_code=200, content={'new_id': new_id}))
 
 
 @app.delete("/master/{master_type}")
@@ -749,31 +950,35 @@ async def add_master(request: Request, params: MasterParams, master_type, csrf_p
 async def delete_master(request: Request, target: DeleteTarget, master_type, csrf_protect: CsrfProtect = Depends()):
 
     await csrf_protect.validate_csrf(request)
-    token = get_decoded_token(request.cookies['token'], key=token_key)
+    token = get_request_token(request)
     token = validate_token(token, ['account_uuid'])
 
     stmt = select(MAP_MASTER[master_type]).where(
         MAP_MASTER[master_type].id == target.id)
-    with Session(get_engine()) as session:
+    def write(session):
         try:
             data = session.scalars(stmt).one()
         except NoResultFound:
-            return Response(status_code=404)
+            return False
 
         session.delete(data)
-        session.commit()
+        return True
+
+    if not await run_write(write, get_master_account_id(master_type, token['account_uuid'])):
+        return Response(status_code=404)
+    publish(token['account_uuid'], EVENT_MASTER, master=master_type)
 
-    return JSONResponse(status_code=200, content={'dummy': 'dummy'})
+    return mark_written(APIResponse(status_code=200, content={'dummy': 'dummy'}))
 
 
 @app.post("/master/work/complete")
 async def add_master(request: Request, report: CompleteReport, csrf_protect: CsrfProtect = Depends()):
 
     await csrf_protect.validate_csrf(request)
-    token = get_decoded_token(request.cookies['token'], key=token_key)
+    token = get_request_token(request)
     token = validate_token(token, ['account_uuid'])
     
-    with Session(get_engine()) as session:
+    def write(session):
         try:
             data = session.scalars(
                 select(
@@ -785,28 +990,35 @@ async def add_master(request: Request, report: CompleteReport, csrf_protect: Csr
                 )
             ).one()
         except NoResultFound:
-            return Response(status_code=404)
-        
+            return False
+
         data.completed_date = datetime.datetime.strptime(report.completed_date, '%Y-%m-%d') if report.completed_date else None
-        session.commit()
+        if data.completed_date is None and data.archived_date is not None:
+            # 完了を取り消した工事は、明細をアーカイブから戻す
+            restore_worksite(session, data)
+        return True
 
-    return Response(status_code=status.HTTP_200_OK)
+    if not await run_write(write, token['account_uuid']):
+        return Response(status_code=404)
+    publish(token['account_uuid'], EVENT_WORK, work_id=report.id)
+
+    return mark_written(Response(status_code=status.HTTP_200_OK))
 
 
 @app.get("/master/trash/{dest_id}/{item_id}")
 async def on_get(request: Request, dest_id: int, item_id: int):
 
-    token = get_decoded_token(request.cookies['token'], key=token_key)
+    token = get_request_token(request)
     token = validate_token(token, ['account_uuid'])
 
     stmt = select(TrashMaster
         ).where(TrashMaster.dest_id == dest_id
         ).where(TrashMaster.item_id == item_id)
-    with Session(get_engine()) as session:
+    with Session(get_engine(token['account_uuid'])) as session:
         try:
             d = session.scalars(stmt).one()
         except NoResultFound:
-            return JSONResponse(
+            return APIResponse(
                 content=dict(detail='Not registed'), status_code=204,
             )
         res = {
@@ -814,14 +1026,14 @@ async def on_get(request: Request, dest_id: int, item_id: int):
             'unit_type': d.unit_type,
         }
 
-    return JSONResponse(res, 200)
+    return APIResponse(res, 200)
 
 
 # report
 @app.get("/daily_report/top", response_class=HTMLResponse)
 async def daily_report_top_page(request: Request, csrf_protect: CsrfProtect = Depends()):
 
-    token = get_decoded_token(request.cookies['token'], key=token_key)
+    token = get_request_token(request)
     token = validate_token(token, ['account_uuid'])
 
     if token is None:
@@ -834,7 +1046,7 @@ async def daily_report_top_page(request: Request, csrf_protect: CsrfProtect = De
         )
 
     param = dict()
-    with Session(get_engine()) as session:
+    with Session(get_engine(token['account_uuid'])) as session:
 
         staffs = session.scalars(select(StaffMaster).where(
                 StaffMaster.account_id == token['account_uuid']))
@@ -848,17 +1060,7 @@ async def daily_report_top_page(request: Request, csrf_protect: CsrfProtect = De
                 DestMaster.account_id == token['account_uuid']))
         items = session.scalars(select(ItemMaster).where(
                 ItemMaster.account_id == token['account_uuid']))
-        customers = session.scalars(select(CustomerMaster).where(
-                CustomerMaster.account_id == token['account_uuid']))
-        worksite_names = session.scalars(
-            select(
-                ReportHead
-            ).where(
-                ReportHead.completed_date == None
-            ).where(
-                ReportHead.account_id == token['account_uuid']
-            )
-        )
+        # 工事名・受注先は件数が多くなるため、画面から /lookup で検索する
 
         param['staffs'] = list(x.to_dict() for x in staffs)
         param['cars'] = list(x.to_dict() for x in cars)
@@ -866,8 +1068,6 @@ async def daily_report_top_page(request: Request, csrf_protect: CsrfProtect = De
         param['leases'] = list(x.to_dict() for x in leases)
         param['dests'] = list(x.to_dict() for x in dests)
         param['items'] = list(x.to_dict() for x in items)
-        param['customers'] = list(x.to_dict()['name'] for x in customers)
-        param['worksite_names'] = list(x.to_dict()['worksite_name'] for x in worksite_names)
         param['unit_type'] = UNIT_TYPE
 
         param['request'] = request
@@ -882,16 +1082,184 @@ async def daily_report_top_page(request: Request, csrf_protect: CsrfProtect = De
     return response
 
 
+def find_work_id(session, account_id, work_name):
+    """工事名から工事(ReportHead.id)を取得する。なければNone
+
+    Args:
+        session (Session): DBセッション
+        account_id (int): アカウント(Account.id)
+        work_name (str): 工事名
+    """
+
+    return session.scalars(
+        select(
+            ReportHead.id
+        ).where(
+            ReportHead.account_id == account_id
+        ).where(
+            ReportHead.worksite_name == work_name
+        ).order_by(
+            ReportHead.id
+        )
+    ).first()
+
+
+def find_or_create_work(session, account_id, work_name, head):
+    """工事名から工事(ReportHead.id)を取得する。なければ登録する（run_write の中で呼ぶ）
+
+    Args:
+        session (Session): DBセッション
+        account_id (int): アカウント(Account.id)
+        work_name (str): 工事名
+        head (dict): 登録する場合の顧客名(customer)・住所(address)・備考(memo)
+
+    Returns:
+        tuple: (工事ID, 登録したか)
+    """
+
+    work_id = find_work_id(session, account_id, work_name)
+    if work_id is not None:
+        return work_id, False
+
+    new_head = ReportHead(
+        customer_name=head['customer'],
+        worksite_name=work_name,
+        address=head['address'],
+        memo=head['memo'],
+        account_id=account_id,
+    )
+    session.add(new_head)
+    session.flush()
+    return new_head.id, True
+
+
+def get_report_head(session, account_id, work_id):
+    """工事を主キーで取得する。なければ404"""
+
+    head = session.get(ReportHead, work_id)
+    if head is None or head.account_id != account_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="工事が見つかりません",
+        )
+    return head
+
+
+def redirect_to(request: Request, path: str):
+    """工事名のルートから工事IDのルートへリダイレクトする（307: POSTのボディもそのまま送り直される）"""
+
+    url = path if not request.url.query else f'{path}?{request.url.query}'
+    return RedirectResponse(url, status_code=status.HTTP_307_TEMPORARY_REDIRECT)
+
+
+# 保存した時刻のcookie。集計はスナップショット(get_read_engine)から読むため、
+# 保存直後は保存した内容が入ったスナップショットができるまで書き込み用のDBから読む
+LAST_WRITE_COOKIE = 'last_write'
+
+
+def mark_written(response):
+    """レスポンスに保存した時刻のcookieを設定する（スナップショットを使う場合のみ）"""
+
+    if REPLICA_MAX_STALENESS > 0:
+        response.set_cookie(
+            key=LAST_WRITE_COOKIE, value=str(time.time()),
+            max_age=int(REPLICA_MAX_STALENESS) + 1, samesite='strict')
+    return response
+
+
+def get_written_at(request: Request):
+    """リクエストのcookieから保存した時刻を取得する。なければNone"""
+
+    try:
+        return float(request.cookies[LAST_WRITE_COOKIE])
+    except (KeyError, ValueError):
+        return None
+
+
 @app.get("/daily_report/{work_name}/work_date/{work_date}")
 async def get_daily_report(request: Request, work_name: str, work_date: str):
+    """工事名で指定する旧ルート。/daily_report/{work_id}/day/{work_date} にリダイレクトする"""
 
-    token = get_decoded_token(request.cookies['token'], key=token_key)
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    with Session(get_engine(token['account_uuid'])) as session:
+        work_id = find_work_id(session, token['account_uuid'], work_name)
+    if work_id is None:
+        # 204を返す時は、contentに値を入れると"Too much data for declared Content-Length"エラーになる
+        # これはHTTPの仕様だが、JSONResponseはcontentを空にするとエラーになるため、使用できない
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+    return redirect_to(request, f'/daily_report/{work_id}/day/{work_date}')
+
+
+@app.get("/daily_report/{work_id}/day/{work_date}")
+async def get_daily_report_with_workid(request: Request, work_id: int, work_date: str):
+
+    token = get_request_token(request)
     token = validate_token(token, ['account_uuid'])
     date = datetime.datetime.strptime(work_date, '%Y-%m-%d')
 
     content = dict()
-    with Session(get_engine()) as session:
+    with Session(get_engine(token['account_uuid'])) as session:
 
+        head = get_report_head(session, token['account_uuid'], work_id)
+        content['head'] = head.to_dict()
+        details = session.scalars(
+            select(
+                ReportDetail
+            ).where(
+                ReportDetail.report_head_id == head.id
+            ).where(
+                ReportDetail.work_date == date
+            ))
+        l = [d.to_dict() for d in details]
+        if head.archived_date is not None:
+            l.extend(dict(d, report_head=content['head']) for d in archived_details(
+                session, head.id, date, date + datetime.timedelta(days=1)))
+        for d in l:
+            content.setdefault(ItemType.value_of(d['type']).name, []).append(d)
+
+        content['detail'] = l
+
+    return APIResponse(content=content)
+
+
+# 一度に取得できる日数
+MAX_RANGE_DAYS = 62
+
+
+@app.get("/daily_report/{work_id}/range")
+async def get_daily_report_range(
+    request: Request,
+    work_id: int,
+    date_from: str = Query(alias='from'),
+    date_to: str = Query(alias='to'),
+):
+    """工事の複数日分の日報をまとめて取得する
+
+    from, to は YYYY-MM-DD（toの日を含む）。daysは日付毎・種別名毎の明細で、日報のない日は含まない
+    """
+
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    try:
+        start = parse_date(date_from)
+        end = parse_date(date_to)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="from, to はYYYY-MM-DD形式で指定してください",
+        )
+    if start > end or (end - start).days >= MAX_RANGE_DAYS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"from はto以前、期間は{MAX_RANGE_DAYS}日以内で指定してください",
+        )
+
+    content = dict()
+    with Session(get_engine(token['account_uuid'])) as session:
         try:
             head = session.scalars(
                 select(
@@ -899,140 +1267,328 @@ async def get_daily_report(request: Request, work_name: str, work_date: str):
                 ).where(
                     ReportHead.account_id == token['account_uuid']
                 ).where(
-                    ReportHead.worksite_name == work_name
+                    ReportHead.id == work_id
                 )
             ).one()
-            content['head'] = head.to_dict()
-            details = session.scalars(
-                select(
-                    ReportDetail
-                ).where(
-                    ReportDetail.report_head == head
-                ).where(
-                    ReportDetail.work_date == date
-                ))
-            l = list()
-            for d in details:
-                l.append(d.to_dict())
-
-            content['detail'] = l
         except NoResultFound:
-            # return JSONResponse(
-            #     content=None, status_code=204,
-            # )
-            # 204を返す時は、contentに値を入れると"Too much data for declared Content-Length"エラーになる
-            # これはHTTPの仕様だが、JSONResponseはcontentを空にするとエラーになるため、使用できない
-            return Response(status_code=status.HTTP_204_NO_CONTENT)
-
-        # date = datetime.datetime.strptime(work_date, '%Y-%m-%d')
-        detail = session.scalars(select(ReportDetail).where(
-            ReportDetail.report_head_id == head.id).where(
-            ReportDetail.work_date == date
-        ))
-        for d in detail:
-            if ItemType.value_of(d.type).name in content:
-                content[ItemType.value_of(d.type).name].append(d.to_dict())
-            else:
-                content[ItemType.value_of(d.type).name] = [d.to_dict()]
-
-    return JSONResponse(content=content)
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="工事が見つかりません",
+            )
+        content['head'] = head.to_dict()
+
+        # (report_head_id, work_date) のインデックスで期間分を1回で取得する
+        details = session.scalars(
+            select(
+                ReportDetail
+            ).where(
+                ReportDetail.report_head_id == head.id
+            ).where(
+                ReportDetail.work_date >= start
+            ).where(
+                ReportDetail.work_date < end + datetime.timedelta(days=1)
+            ).order_by(
+                ReportDetail.work_date, ReportDetail.id
+            ))
+
+        details = [d.to_dict_nohead() for d in details]
+        if head.archived_date is not None:
+            details.extend(archived_details(session, head.id, start, end + datetime.timedelta(days=1)))
+
+        days = dict()
+        for d in details:
+            day = days.setdefault(d['work_date'], dict())
+            day.setdefault(ItemType.value_of(d['type']).name, []).append(d)
+        content['days'] = days
+
+    return APIResponse(content=content)
 
 
 @app.post("/daily_report/{work_name}/work_date/{work_date}")
 async def register_daily_report(request: Request, work_name: str, work_date: str, report: Report, csrf_protect: CsrfProtect = Depends()):
+    """工事名で指定する旧ルート。工事がなければ登録し、/daily_report/{work_id}/day/{work_date} にリダイレクトする"""
 
     await csrf_protect.validate_csrf(request)
-    token = get_decoded_token(request.cookies['token'], key=token_key)
+    token = get_request_token(request)
     token = validate_token(token, ['account_uuid'])
 
-    with Session(get_engine()) as session:
+    with Session(get_engine(token['account_uuid'])) as session:
+        work_id = find_work_id(session, token['account_uuid'], work_name)
+    if work_id is None:
+        # なければ登録（同時に登録された場合に備えて、書き込みの中でも確認する）
+        work_id, created = await run_write(
+            lambda session: find_or_create_work(session, token['account_uuid'], work_name, report.head), token['account_uuid'])
+        if created:
+            publish(token['account_uuid'], EVENT_MASTER, master='work')
 
-        try:
-            head = session.scalars(
-                select(
-                    ReportHead
-                ).where(
-                    ReportHead.account_id == token['account_uuid']
-                ).where(
-                    ReportHead.worksite_name == work_name
-                )
-            ).one()
+    return redirect_to(request, f'/daily_report/{work_id}/day/{work_date}')
 
-        except NoResultFound:
-            # なければ登録
-            head = ReportHead(
-                customer_name=report.head['customer'],
-                worksite_name=work_name,
-                address=report.head['address'],
-                memo=report.head['memo'],
-                account_id=token['account_uuid'],
+
+@app.post("/daily_report/{work_id}/day/{work_date}")
+async def register_daily_report_with_workid(request: Request, work_id: int, work_date: str, report: Report, csrf_protect: CsrfProtect = Depends()):
+
+    await csrf_protect.validate_csrf(request)
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    date = datetime.datetime.strptime(work_date, '%Y-%m-%d')
+
+    def write(session):
+        head = get_report_head(session, token['account_uuid'], work_id)
+        if head.archived_date is not None:
+            restore_worksite(session, head)
+
+        # 複数日分の登録（/daily_report/{work_id}/batch）と同じく、日の明細をまとめて置き換える
+        session.execute(
+            delete(ReportDetail).where(
+                ReportDetail.report_head_id == work_id
+            ).where(
+                ReportDetail.work_date == date
+            ))
+        rows = report_detail_rows(work_id, date, report.detail)
+        if rows:
+            session.execute(insert(ReportDetail), rows)
+
+    await run_write(write, token['account_uuid'])
+    publish(token['account_uuid'], EVENT_REPORT, work_id=work_id, dates=[work_date])
+
+    return mark_written(APIResponse(content={'detail': 'ok', 'work_id': work_id}))
+
+@app.get("/daily_report/{work_id}/calendar")
+async def get_daily_report_calendar(request: Request, work_id: int, month: str):
+    """月内の日報のある日と日毎の合計
+
+    month は YYYY-MM。
+    days は日報のある日のビットマップ（1日がビット0）、totals は日毎の合計（0始まりで1日から月末まで）
+    """
+
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    try:
+        start = parse_month(month)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="month はYYYY-MM形式で指定してください",
+        )
+    end = next_month(start)
+
+    with Session(get_engine(token['account_uuid'])) as session:
+        head = session.execute(
+            select(
+                ReportHead.archived_date
+            ).where(
+                ReportHead.account_id == token['account_uuid']
+            ).where(
+                ReportHead.id == work_id
+            )).first()
+        if head is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="工事が見つかりません",
             )
-            session.add(head)
 
-        date = datetime.datetime.strptime(work_date, '%Y-%m-%d')
-        detail_exists = True
-        try:
-            details = session.scalars(
+        # (report_head_id, work_date, quant, cost) のインデックスのみで集計する
+        days = session.execute(
+            select(
+                ReportDetail.work_date,
+                func.sum(ReportDetail.quant * ReportDetail.cost),
+            ).where(
+                ReportDetail.report_head_id == work_id
+            ).where(
+                ReportDetail.work_date >= start
+            ).where(
+                ReportDetail.work_date < end
+            ).group_by(
+                ReportDetail.work_date
+            )).all()
+
+        bitmap = 0
+        totals = [0] * (end - start).days
+        for date, total in days:
+            bitmap |= 1 << (date.day - 1)
+            totals[date.day - 1] = total or 0
+        if head.archived_date is not None:
+            for d in archived_details(session, work_id, start, end):
+                day = int(d['work_date'][8:10]) - 1
+                bitmap |= 1 << day
+                totals[day] += (d['quant'] or 0) * (d['cost'] or 0)
+
+    return APIResponse(content={'month': start.strftime('%Y-%m'), 'days': bitmap, 'totals': totals})
+
+
+@app.post("/daily_report/{work_id}/work_date/{work_date}/copy_from/{src_date}")
+async def copy_daily_report(
+    request: Request,
+    work_id: int,
+    work_date: str,
+    src_date: str,
+    type: Union[List[int], None] = Query(default=None),
+    csrf_protect: CsrfProtect = Depends(),
+):
+    """別の日の明細を複写する（前日と同じ人員・車両など）
+
+    type でItemTypeの値を指定した場合はその種別のみ複写する。
+    複写先の日の同じ種別の明細は置き換える
+    """
+
+    await csrf_protect.validate_csrf(request)
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    try:
+        date = parse_date(work_date)
+        src = parse_date(src_date)
+        types = [t.value for t in ItemType] if type is None else [ItemType(t).value for t in type]
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="日付はYYYY-MM-DD形式、type はItemTypeの値で指定してください",
+        )
+    if date == src:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="複写元と複写先が同じ日です",
+        )
+
+    def write(session):
+        head = get_report_head(session, token['account_uuid'], work_id)
+        if head.archived_date is not None:
+            restore_worksite(session, head)
+
+        session.execute(
+            delete(ReportDetail).where(
+                ReportDetail.report_head_id == work_id
+            ).where(
+                ReportDetail.work_date == date
+            ).where(
+                ReportDetail.type.in_(types)
+            ))
+
+        # 明細をアプリに読み込まず、INSERT ... SELECT で複写する
+        columns = ['report_head_id', 'type', 'name', 'dest', 'cost', 'quant', 'memo', 'unit_type', 'quant_kg']
+        return session.execute(
+            insert(ReportDetail).from_select(
+                columns + ['work_date'],
                 select(
-                    ReportDetail
+                    *[getattr(ReportDetail, c) for c in columns],
+                    literal(date, ReportDetail.work_date.type),
+                ).where(
+                    ReportDetail.report_head_id == work_id
                 ).where(
-                    ReportDetail.report_head == head
+                    ReportDetail.work_date == src
                 ).where(
-                    ReportDetail.work_date == date
+                    ReportDetail.type.in_(types)
+                ).order_by(
+                    ReportDetail.id
                 )
-            )
-        except NoResultFound:
-            detail_exists = False
-
-        staff = report.detail.staffs
-        car = report.detail.cars
-        lease = report.detail.leases
-        machine = report.detail.machines
-        transport = report.detail.transports
-        valuable = report.detail.valuables
-        other = report.detail.others
-        trash = report.detail.trashes
-
-        # TODO とったやつまとめて消したい
-        if detail_exists:
-            for d in details:
-                session.delete(d)
-
-        new_details = list()
-        new_details.extend(
-            [ReportDetail(report_head=head, work_date=date, type=ItemType.STAFF.value, name=d.name, cost=d.cost, quant=d.quant) for d in staff]
-        )
-        new_details.extend(
-            [ReportDetail(report_head=head, work_date=date, type=ItemType.CAR.value, name=d.name, cost=d.cost, quant=d.quant) for d in car]
-        )
-        new_details.extend(
-            [ReportDetail(report_head=head, work_date=date, type=ItemType.MACHINE.value, name=d.name, cost=d.cost, quant=d.quant) for d in machine]
-        )
-        new_details.extend(
-            [ReportDetail(report_head=head, work_date=date, type=ItemType.LEASE.value, name=d.name, cost=d.cost, quant=d.quant) for d in lease]
-        )
-        new_details.extend(
-            [ReportDetail(report_head=head, work_date=date, type=ItemType.TRANSPORT.value, name=d.name, cost=d.cost, quant=d.quant) for d in transport]
-        )
-        new_details.extend(
-            [ReportDetail(report_head=head, work_date=date, type=ItemType.TRASH.value, name=d.item, cost=d.cost, quant=d.quant, dest=d.dest, unit_type=d.unit_type) for d in trash]
-        )
-        new_details.extend(
-            [ReportDetail(report_head=head, work_date=date, type=ItemType.VALUABLE.value, name=d.name, cost=d.cost, quant=d.quant) for d in valuable]
-        )
-        new_details.extend(
-            [ReportDetail(report_head=head, work_date=date, type=ItemType.OTHER.value, name=d.name, cost=d.cost, quant=d.quant) for d in other]
+            )).rowcount
+
+    copied = await run_write(write, token['account_uuid'])
+    publish(token['account_uuid'], EVENT_REPORT, work_id=work_id, dates=[work_date])
+
+    return mark_written(APIResponse(content={'detail': 'ok', 'count': copied}))
+
+
+def parse_batch_dates(report: BatchReport):
+    """複数日分の日報の作業日を確認し、日付のリストにする。不正な場合は400"""
+
+    if len(report.days) == 0 or len(report.days) > MAX_RANGE_DAYS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"日報は1～{MAX_RANGE_DAYS}日分で指定してください",
         )
+    dates = list()
+    for day in report.days:
+        try:
+            date = parse_date(day.work_date)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"作業日はYYYY-MM-DD形式で指定してください: {day.work_date}",
+            )
+        if date in dates:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"作業日が重複しています: {day.work_date}",
+            )
+        dates.append(date)
+    return dates
+
+
+# 工事名のルートと同じ形のため、工事IDは数字のみの場合に限る（先に定義する）
+@app.post("/daily_report/{work_id:int}/batch")
+async def register_daily_report_batch_with_workid(request: Request, work_id: int, report: BatchReport, csrf_protect: CsrfProtect = Depends()):
+    """複数日分の日報をまとめて登録する
+
+    全ての日の入力を確認してから、1トランザクションで各日の明細を置き換える
+    """
+
+    await csrf_protect.validate_csrf(request)
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    dates = parse_batch_dates(report)
+
+    def write(session):
+        head = get_report_head(session, token['account_uuid'], work_id)
+        if head.archived_date is not None:
+            restore_worksite(session, head)
+
+        results = list()
+        rows = list()
+        for date, day in zip(dates, report.days):
+            day_rows = report_detail_rows(work_id, date, day.detail)
+            rows.extend(day_rows)
+            results.append({'work_date': day.work_date, 'detail': 'ok', 'count': len(day_rows)})
+
+        session.execute(
+            delete(ReportDetail).where(
+                ReportDetail.report_head_id == work_id
+            ).where(
+                ReportDetail.work_date.in_(dates)
+            ))
+        if rows:
+            session.execute(insert(ReportDetail), rows)
+        return results
+
+    results = await run_write(write, token['account_uuid'])
+    publish(token['account_uuid'], EVENT_REPORT, work_id=work_id, dates=[day.work_date for day in report.days])
+
+    return mark_written(APIResponse(content={'detail': 'ok', 'days': results}))
+
+
+@app.post("/daily_report/{work_name}/batch")
+async def register_daily_report_batch(request: Request, work_name: str, report: BatchReport, csrf_protect: CsrfProtect = Depends()):
+    """工事名で指定する旧ルート。工事がなければ登録し、/daily_report/{work_id}/batch にリダイレクトする
+
+    数字のみの工事名は工事IDのルートになるため、このルートでは指定できない
+    """
+
+    await csrf_protect.validate_csrf(request)
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
 
-        session.add_all(new_details)
-        session.commit()
+    # 入力が不正な場合は工事を登録しない
+    parse_batch_dates(report)
+
+    with Session(get_engine(token['account_uuid'])) as session:
+        work_id = find_work_id(session, token['account_uuid'], work_name)
+    if work_id is None:
+        # なければ登録（同時に登録された場合に備えて、書き込みの中でも確認する）
+        work_id, created = await run_write(
+            lambda session: find_or_create_work(session, token['account_uuid'], work_name, report.head), token['account_uuid'])
+        if created:
+            publish(token['account_uuid'], EVENT_MASTER, master='work')
+
+    return redirect_to(request, f'/daily_report/{work_id}/batch')
 
-    return JSONResponse(content={'detail': 'ok'})
 
 @app.get("/daily_report/summary", response_class=HTMLResponse)
 async def summary_top_page(request: Request, csrf_protect: CsrfProtect = Depends()):
 
-    token = get_decoded_token(request.cookies['token'], key=token_key)
+    token = get_request_token(request)
     token = validate_token(token, ['account_uuid'])
 
     if token is None:
@@ -1044,17 +1600,36 @@ async def summary_top_page(request: Request, csrf_protect: CsrfProtect = Depends
             status_code=403
         )
 
-    content = dict()
-    with Session(get_engine()) as session:
-        head = session.scalars(select(ReportHead).where(
-            ReportHead.account_id == token['account_uuid']))
-
-        worksite_names = list({'id': x.id, 'name': x.worksite_name} for x in head)
+    # 工事は画面から /lookup で検索する
     csrf_token, signed_token = csrf_protect.generate_csrf_tokens()
     response = templates.TemplateResponse(
         "daily_report_summary.html", {
             "request": request,
-            "worksite_names": worksite_names,
+            "csrf_token": csrf_token
+        }
+    )
+    csrf_protect.set_csrf_cookie(signed_token, response)
+    return response
+
+
+@app.get("/daily_report/dashboard", response_class=HTMLResponse)
+async def dashboard_page(request: Request, csrf_protect: CsrfProtect = Depends()):
+
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    if token is None:
+        return templates.TemplateResponse(
+            "invalid.html", {
+                "request": request
+            },
+            status_code=403
+        )
+
+    csrf_token, signed_token = csrf_protect.generate_csrf_tokens()
+    response = templates.TemplateResponse(
+        "daily_report_dashboard.html", {
+            "request": request,
             "csrf_token": csrf_token
         }
     )
@@ -1063,24 +1638,51 @@ async def summary_top_page(request: Request, csrf_protect: CsrfProtect = Depends
 
 
 @app.get("/daily_report/{work_name}/summary/{work_id}")
-async def get_summary_with_workid(request: Request, work_name: str, work_id: int):
+async def get_summary(request: Request, work_name: str, work_id: int):
+    """旧ルート。/daily_report/{work_id}/summary にリダイレクトする"""
+
+    return redirect_to(request, f'/daily_report/{work_id}/summary')
+
+
+@app.get("/daily_report/{work_id}/summary")
+async def get_summary_with_workid(request: Request, work_id: int, layout: Union[str, None] = None):
+    """工事の日毎・種別毎の集計
 
-    token = get_decoded_token(request.cookies['token'], key=token_key)
+    layout=columnar の場合、detailsを列毎の配列で返す（date, typeは辞書エンコード）。
+    /analytics/* と同じく、スナップショット(get_read_engine)から読む。
+    """
+
+    token = get_request_token(request)
     token = validate_token(token, ['account_uuid'])
 
+    written_at = get_written_at(request)
+    # 共有リンクから同時に開かれた場合は、1回の集計の結果を共有する
+    content = await single_flight(
+        'daily_report/summary', token['account_uuid'], (work_id, layout),
+        lambda: get_read_engine(token['account_uuid'], written_at),
+        lambda engine: summarize_worksite(engine, token['account_uuid'], work_id, layout))
+
+    return APIResponse(content=content)
+
+
+def summarize_worksite(engine, account_id, work_id, layout=None):
+    """工事の日毎・種別毎の集計（/daily_report/{work_id}/summary）"""
+
     content = dict()
-    with Session(get_engine()) as session:
+    with Session(engine) as session:
 
-        head = session.scalars(select(ReportHead).where(
-                ReportHead.account_id == token['account_uuid']).where(
-                ReportHead.id == work_id)).one()
+        head = get_report_head(session, account_id, work_id)
         content['head'] = head.to_dict()
 
         details = session.execute(
             select(
                 ReportDetail.work_date,
                 ReportDetail.type,
-                func.sum(ReportDetail.quant).label("total_quant"),
+                # 廃材はkgに換算した数量を集計する（単位がなしのものは含めない）
+                func.sum(case(
+                    (ReportDetail.type == ItemType.TRASH.value, ReportDetail.quant_kg),
+                    else_=ReportDetail.quant,
+                )).label("total_quant"),
                 func.sum(ReportDetail.quant*ReportDetail.cost).label("total_cost"),
             ).where(
                 ReportDetail.report_head == head
@@ -1089,7 +1691,18 @@ async def get_summary_with_workid(request: Request, work_name: str, work_id: int
                 ReportDetail.work_date,
             ).order_by(
                 ReportDetail.work_date,
-            ))
+            )).all()
+        if head.archived_date is not None:
+            details = sorted(details + archived_totals(session, head.id), key=lambda d: d[0])
+
+        if layout == LAYOUT_COLUMNAR:
+            content['details'] = to_columnar(
+                ((datetime.datetime.strftime(date, '%Y-%m-%d'), type, total_quant, total_cost)
+                 for date, type, total_quant, total_cost in details),
+                ['date', 'type', 'quant', 'total'],
+                dictionary_keys=['date', 'type'],
+            )
+            return content
 
         d = list()
         for date, type, total_quant, total_cost in details:
@@ -1103,4 +1716,358 @@ async def get_summary_with_workid(request: Request, work_name: str, work_id: int
         content['details'] = d
         logger.debug(d)
 
-    return JSONResponse(content=content)
+    return content
+
+
+# analytics
+@app.get("/analytics/monthly")
+async def get_monthly_analytics(
+    request: Request,
+    month_from: str = Query(alias='from'),
+    month_to: str = Query(alias='to'),
+):
+    """アカウント全体の 月 × 種別 × 工事 の費用・数量
+
+    from, to は YYYY-MM（toの月を含む）
+    """
+
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    try:
+        start = parse_month(month_from)
+        end = parse_month(month_to)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="from, to はYYYY-MM形式で指定してください",
+        )
+    if start > end:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="from はto以前の月を指定してください",
+        )
+
+    written_at = get_written_at(request)
+
+    def compute(engine):
+        with Session(engine) as session:
+            return monthly_pivot(session, token['account_uuid'], start, end)
+
+    content = await single_flight(
+        'analytics/monthly', token['account_uuid'], (start, end),
+        lambda: get_read_engine(token['account_uuid'], written_at), compute)
+
+    return APIResponse(content=content)
+
+
+@app.get("/analytics/utilization")
+async def get_resource_utilization(
+    request: Request,
+    date_from: str = Query(alias='from'),
+    date_to: str = Query(alias='to'),
+    type: Union[List[int], None] = Query(default=None),
+):
+    """人員・車両・重機毎の稼働日数と工事毎の内訳
+
+    from, to は YYYY-MM-DD（toの日を含む）。type でItemTypeの値を指定した場合はその種別のみ集計する
+    """
+
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    try:
+        start = parse_date(date_from)
+        end = parse_date(date_to)
+        types = UTILIZATION_TYPES if type is None else [ItemType(t) for t in type]
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="from, to はYYYY-MM-DD形式、type はItemTypeの値で指定してください",
+        )
+
+    written_at = get_written_at(request)
+
+    def compute(engine):
+        with Session(engine) as session:
+            return resource_utilization(session, token['account_uuid'], start, end, types)
+
+    content = await single_flight(
+        'analytics/utilization', token['account_uuid'], (start, end, tuple(types)),
+        lambda: get_read_engine(token['account_uuid'], written_at), compute)
+
+    return APIResponse(content=content)
+
+
+@app.get("/analytics/waste")
+async def get_waste_tonnage(
+    request: Request,
+    date_from: str = Query(alias='from'),
+    date_to: str = Query(alias='to'),
+):
+    """処分先・品名毎の廃材の重量と費用
+
+    from, to は YYYY-MM-DD（toの日を含む）
+    """
+
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    try:
+        start = parse_date(date_from)
+        end = parse_date(date_to)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="from, to はYYYY-MM-DD形式で指定してください",
+        )
+
+    written_at = get_written_at(request)
+
+    def compute(engine):
+        with Session(engine) as session:
+            return waste_tonnage(session, token['account_uuid'], start, end)
+
+    content = await single_flight(
+        'analytics/waste', token['account_uuid'], (start, end),
+        lambda: get_read_engine(token['account_uuid'], written_at), compute)
+
+    return APIResponse(content=content)
+
+
+@app.get("/analytics/worksites")
+async def get_worksite_dashboard(
+    request: Request,
+    sort: str = 'last_date',
+    order: str = 'desc',
+    page: int = Query(default=1, ge=1),
+    per_page: int = Query(default=50, ge=1, le=500),
+):
+    """アカウントの全工事の集計（ダッシュボード）
+
+    sort は name, total, first_date, last_date, days のいずれか。order は asc または desc
+    """
+
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    if sort not in DASHBOARD_SORT_KEYS or order not in ('asc', 'desc'):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="sort, order の指定が不正です",
+        )
+
+    written_at = get_written_at(request)
+
+    def compute(engine):
+        with Session(engine) as session:
+            content = worksite_dashboard(
+                session, token['account_uuid'], sort=sort, desc=order == 'desc',
+                limit=per_page, offset=(page - 1) * per_page)
+        content['page'] = page
+        content['per_page'] = per_page
+        return content
+
+    content = await single_flight(
+        'analytics/worksites', token['account_uuid'], (sort, order, page, per_page),
+        lambda: get_read_engine(token['account_uuid'], written_at), compute)
+
+    return APIResponse(content=content)
+
+
+# lookup
+@app.get("/lookup/{kind}")
+def get_lookup(
+    request: Request,
+    kind: str,
+    q: Union[str, None] = None,
+    after: Union[int, None] = None,
+    limit: int = Query(default=20, ge=1, le=LOOKUP_MAX_LIMIT),
+    work_status: str = Query(default='open', alias='status'),
+):
+    """工事名・マスタ名の入力補完
+
+    kind は worksite, customer, staff, car, machine, lease, dest, item のいずれか。
+    q の語毎の前方一致で検索する。次のページは、レスポンスの next を after に指定して取得する。
+    status は工事の状態 open, completed, all（worksiteのみ）
+    """
+
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    if kind not in LOOKUP_SOURCES or work_status not in WORKSITE_STATUS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="kind, status の指定が不正です",
+        )
+
+    with Session(get_engine(token['account_uuid'])) as session:
+        content = lookup(session, kind, token['account_uuid'], q=q, after=after, limit=limit, status=work_status)
+
+    return APIResponse(content=content)
+
+
+@app.get("/search")
+def get_search(
+    request: Request,
+    q: str,
+    after: Union[str, None] = None,
+    limit: int = Query(default=20, ge=1, le=SEARCH_MAX_LIMIT),
+):
+    """明細（品名・処分先・備考）と工事（住所・備考）の全文検索
+
+    一致度順に返す。次のページは、レスポンスの next を after に指定して取得する
+    """
+
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    if q.strip() == '':
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="検索する文字を指定してください",
+        )
+
+    with Session(get_engine(token['account_uuid'])) as session:
+        try:
+            content = search_reports(session, token['account_uuid'], q, after=after, limit=limit)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="after の指定が不正です",
+            )
+
+    return APIResponse(content=content)
+
+
+@app.get("/single_flight/stats")
+def get_single_flight_stats(request: Request):
+    """集計の同時実行をまとめた状況（single_flight.py）。coalesce_ratio は実行中の結果を待った要求の割合"""
+
+    get_stats_token(request)
+
+    return APIResponse(content=single_flight_stats())
+
+
+@app.get("/write_queue/stats")
+def get_write_queue_stats(request: Request):
+    """単一ライターキュー（write_queue.py）の待ち数・グループコミットの状況"""
+
+    get_stats_token(request)
+
+    return APIResponse(content=write_queue_stats())
+
+
+@app.get("/sync")
+def get_sync(request: Request, since: int = 0, limit: int = Query(default=1000, ge=1, le=SYNC_MAX_LIMIT)):
+    """前回の同期（since）以降の工事・明細・マスタの変更（sync.changes_since）
+
+    more が True の場合は、返した seq を since にして続きを取得する
+    """
+
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    # 差分の取りこぼしがないよう、スナップショットではなく最新のDBを読む
+    with Session(get_engine(token['account_uuid'])) as session:
+        content = changes_since(session, token['account_uuid'], since=since, limit=limit)
+
+    return APIResponse(content=content)
+
+
+@app.post("/sync")
+async def post_sync(request: Request, req: SyncRequest, csrf_protect: CsrfProtect = Depends()):
+    """オフライン中の編集をまとめて適用する（sync.apply_changes）
+
+    base_seq（端末が最後に取得した seq）より後にサーバ側で変更された行・日は適用せず conflict を返す。
+    新規の工事の日報は、工事の登録結果のIDで次の同期で送ること
+    """
+
+    await csrf_protect.validate_csrf(request)
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    for change in req.changes:
+        if change.kind not in SYNC_WRITABLE or change.op not in (OP_UPSERT, OP_DELETE):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"同期できない変更です: {change.kind} {change.op}",
+            )
+
+    results = await run_write(
+        lambda session: apply_changes(session, token['account_uuid'], req), token['account_uuid'])
+
+    for kind in sorted({change.kind for change, r in zip(req.changes, results['changes']) if r['status'] == 'ok'}):
+        publish(token['account_uuid'], EVENT_MASTER, master=kind)
+    days = dict()
+    for r in results['days']:
+        if r['status'] == 'ok':
+            days.setdefault(r['work_id'], []).append(r['work_date'])
+    for work_id, dates in days.items():
+        publish(token['account_uuid'], EVENT_REPORT, work_id=work_id, dates=dates)
+
+    return mark_written(APIResponse(content=results))
+
+
+@app.get("/events")
+async def get_events(request: Request):
+    """マスタ・日報の変更のイベント（Server-Sent Events、events.py）
+
+    画面は EventSource で接続し、変更された部分だけを取得し直す
+    """
+
+    token = get_request_token(request)
+    token = validate_token(token, ['account_uuid'])
+
+    return StreamingResponse(
+        subscribe(token['account_uuid'], request.is_disconnected),
+        media_type='text/event-stream',
+        # nginxでバッファリングせずに送る
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@app.get("/events/stats")
+def get_events_stats(request: Request):
+    """イベント（/events）に接続中の画面の数"""
+
+    get_stats_token(request)
+
+    return APIResponse(content={'subscribers': subscriber_count()})
+
+
+@app.post("/batch")
+async def post_batch(request: Request, batch: BatchRequest):
+    """複数のGETをまとめて実行する（batch.py）
+
+    requests は [{'path': パス, 'params': クエリパラメータ}]。
+    responses は requests と同じ順の [{'status': ステータスコード, 'body': レスポンス}]。
+    読み取りのみのためCSRFトークンは不要。サブリクエストの Set-Cookie はこのレスポンスで返す。
+    トークンのデコードは1回のみ行い、各GETのルートはデコード済みの値で自分の権限の確認を行う
+    """
+
+    # トークンはここで1回だけデコードし、サブリクエストには scope['state'] で渡す
+    decoded_token = get_decoded_token(request.cookies['token'], key=token_key)
+    validate_token(decoded_token, ['account_uuid'])
+
+    if len(batch.requests) == 0 or len(batch.requests) > MAX_BATCH_REQUESTS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"まとめられるのは1～{MAX_BATCH_REQUESTS}件です",
+        )
+    for call in batch.requests:
+        if not is_batchable(call.path):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"まとめて実行できないパスです: {call.path}",
+            )
+
+    results = await run_batch(
+        request, [(call.path, call.params) for call in batch.requests],
+        state={BATCH_TOKEN_STATE: (request.cookies['token'], decoded_token)})
+
+    response = APIResponse(content={'responses': [dict(status=r['status'], body=r['body']) for r in results]})
+    for r in results:
+        for cookie in r['cookies']:
+            response.raw_headers.append((b'set-cookie', cookie.encode('latin-1')))
+    return response
@@ -0,0 +1,182 @@
+"""既存DBのスキーマ変更
+
+create_all は既存テーブルを変更しないため、列の追加やデータの移行はここに追加する。
+適用済みのバージョンは sqlite の PRAGMA user_version で管理する。
+
+使い方:
+    python migration.py
+"""
+from sqlalchemy import (
+    case,
+    insert,
+    inspect,
+    select,
+    text,
+    update,
+)
+
+from archive import (
+    archive_total_rows,
+    unpack_details,
+)
+from db_common import (
+    get_engine,
+    shard_account_ids,
+)
+from schemas import (
+    ItemType,
+    KG_PER_UNIT,
+)
+from search import (
+    create_lookup_index,
+    create_search_index,
+    create_search_triggers,
+)
+from sync import (
+    create_change_log,
+    create_change_log_triggers,
+    drop_change_log_triggers,
+)
+from tables import (
+    ChangeLog,
+    ReportArchive,
+    ReportArchiveTotal,
+    ReportDetail,
+)
+
+
+def add_column(conn, table, column, ddl):
+    """列がなければ追加する（新規DBはcreate_allで作成済み）"""
+
+    if column not in [c['name'] for c in inspect(conn).get_columns(table)]:
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+
+def migrate_1_quant_kg(conn):
+    """廃材の数量をkgに換算した列を追加し、既存の明細に設定する"""
+
+    add_column(conn, 'report_detail', 'quant_kg', 'INTEGER')
+    conn.execute(
+        update(ReportDetail).where(
+            ReportDetail.type == ItemType.TRASH.value
+        ).values(
+            quant_kg=ReportDetail.quant * case(KG_PER_UNIT, value=ReportDetail.unit_type)
+        )
+    )
+
+
+def migrate_2_drop_report_head_id_work_date(conn):
+    """(report_head_id, work_date) のインデックスを削除する（quant, costを含むインデックスに置き換え）"""
+
+    conn.execute(text('DROP INDEX IF EXISTS ix_report_detail_report_head_id_work_date'))
+
+
+def migrate_3_lookup_index(conn):
+    """工事名・マスタ名のFTS5索引を作成する"""
+
+    create_lookup_index(conn)
+
+
+def migrate_4_search_index(conn):
+    """明細・工事の全文検索の索引を作成する"""
+
+    create_search_index(conn)
+
+
+def migrate_5_archive(conn):
+    """明細のアーカイブ用のテーブルと、工事のアーカイブ日時の列を追加する"""
+
+    add_column(conn, 'report_head', 'archived_date', 'DATETIME')
+    ReportArchive.__table__.create(conn, checkfirst=True)
+
+
+def migrate_6_change_log(conn):
+    """差分同期用の変更履歴のテーブルとトリガーを作成する"""
+
+    ChangeLog.__table__.create(conn, checkfirst=True)
+    create_change_log(conn)
+
+
+def migrate_7_archive_total(conn):
+    """アーカイブした明細の集計のテーブルを作成し、作成済みのアーカイブから集計する"""
+
+    ReportArchiveTotal.__table__.create(conn, checkfirst=True)
+    rows = archive_total_rows(conn)
+    if rows:
+        conn.execute(insert(ReportArchiveTotal), rows)
+
+
+def migrate_8_detail_autoincrement(conn):
+    """明細のIDを AUTOINCREMENT にし、アーカイブした明細のIDを新しい明細に再利用しない
+
+    sqliteは既存のテーブルを変更できないため、作り直して行を戻す。
+    テーブルを削除するとトリガーも消える（削除時のトリガーは実行されない）ため、作り直す。
+    """
+
+    ddl = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'report_detail'")).scalar()
+    if 'AUTOINCREMENT' in ddl.upper():
+        # create_all で作成したDB
+        return
+
+    columns = ', '.join(c.name for c in ReportDetail.__table__.c)
+    conn.execute(text("CREATE TEMP TABLE report_detail_copy AS SELECT * FROM report_detail"))
+    conn.execute(text("DROP TABLE report_detail"))
+    ReportDetail.__table__.create(conn)
+    conn.execute(text(f"INSERT INTO report_detail ({columns}) SELECT {columns} FROM temp.report_detail_copy ORDER BY id"))
+    conn.execute(text("DROP TABLE temp.report_detail_copy"))
+    create_search_triggers(conn)
+    create_change_log_triggers(conn)
+
+    # アーカイブした明細のIDより後から採番する
+    archived_max = max(
+        (d['id'] for data in conn.scalars(select(ReportArchive.details)) for d in unpack_details(data)), default=0)
+    seq = max(conn.execute(text("SELECT max(id) FROM report_detail")).scalar() or 0, archived_max)
+    conn.execute(text("DELETE FROM sqlite_sequence WHERE name = 'report_detail'"))
+    conn.execute(text("INSERT INTO sqlite_sequence(name, seq) VALUES ('report_detail', :seq)"), dict(seq=seq))
+
+
+def migrate_9_change_log_pause(conn):
+    """明細の変更履歴のトリガーを、アーカイブ中の工事（unlogged_details）を記録しないものに作り直す"""
+
+    drop_change_log_triggers(conn, ReportDetail)
+    create_change_log_triggers(conn)
+
+
+# (バージョン, 処理) の順に適用する
+MIGRATIONS = [
+    (1, migrate_1_quant_kg),
+    (2, migrate_2_drop_report_head_id_work_date),
+    (3, migrate_3_lookup_index),
+    (4, migrate_4_search_index),
+    (5, migrate_5_archive),
+    (6, migrate_6_change_log),
+    (7, migrate_7_archive_total),
+    (8, migrate_8_detail_autoincrement),
+    (9, migrate_9_change_log_pause),
+]
+
+
+def migrate(engine=None):
+    """未適用のスキーマ変更を順に適用する
+
+    Args:
+        engine (Engine, optional): 対象のDB。省略時は get_engine()
+    """
+
+    if engine is None:
+        engine = get_engine()
+
+    with engine.begin() as conn:
+        version = conn.execute(text('PRAGMA user_version')).scalar()
+        for v, func in MIGRATIONS:
+            if v <= version:
+                continue
+            func(conn)
+            conn.execute(text(f'PRAGMA user_version = {v}'))
+
+
+if __name__ == '__main__':
+    migrate()
+    # シャーディング時はアカウント毎のDBも更新する
+    for account_id in shard_account_ids():
+        migrate(get_engine(account_id))
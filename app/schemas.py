@@ -66,6 +66,12 @@ UNIT_TYPE = [
     },
 ]
 
+# 重量の単位(UNIT_TYPEのid) → kgへの換算倍率。「なし」は重量ではないため含めない
+KG_PER_UNIT = {
+    1: 1,
+    2: 1000,
+}
+
 
 class CsrfSettings(BaseModel):
     # Use AWS Secrets Manager, or HashiCorp Vault
@@ -83,6 +89,10 @@ class UserInvitation(BaseModel):
     uuid: int
 
 
+class UserInvitations(BaseModel):
+    uuids: list[int]
+
+
 class NewUser(BaseModel):
     username: str
     password: str
@@ -189,6 +199,44 @@ class Report(BaseModel):
     detail: Detail
 
 
+class DayReport(BaseModel):
+    work_date: str
+    detail: Detail
+
+
+class BatchReport(BaseModel):
+    head: dict
+    days: list[DayReport]
+
+
+class SyncChange(BaseModel):
+    kind: str
+    op: str
+    id: Union[int, None] = None
+    data: Union[dict, None] = None
+
+
+class SyncDay(BaseModel):
+    work_id: int
+    work_date: str
+    detail: Detail
+
+
+class SyncRequest(BaseModel):
+    base_seq: int
+    changes: list[SyncChange] = []
+    days: list[SyncDay] = []
+
+
+class BatchCall(BaseModel):
+    path: str
+    params: dict = {}
+
+
+class BatchRequest(BaseModel):
+    requests: list[BatchCall]
+
+
 class CompleteReport(BaseModel):
     id: int
     completed_date: str
@@ -0,0 +1,352 @@
+"""検索
+
+- 入力補完: 各テーブルの名前列に、SQLite FTS5 の索引（{テーブル名}_fts）を作成する。
+- 全文検索: 明細（品名・処分先・備考）と工事（住所・備考）を1つの索引（report_search）にまとめる。
+
+索引はトリガーで同期する。索引の作成は migration.py で行う。
+"""
+import html
+import json
+
+from sqlalchemy import (
+    literal_column,
+    select,
+    text,
+    tuple_,
+)
+
+from tables import (
+    CarMaster,
+    CustomerMaster,
+    DestMaster,
+    ItemMaster,
+    LeaseMaster,
+    MachineMaster,
+    ReportHead,
+    StaffMaster,
+)
+
+
+# 検索対象: 種類 → (テーブル, 名前列)
+LOOKUP_SOURCES = {
+    'worksite': (ReportHead, ReportHead.worksite_name),
+    'customer': (CustomerMaster, CustomerMaster.name),
+    'staff': (StaffMaster, StaffMaster.name),
+    'car': (CarMaster, CarMaster.name),
+    'machine': (MachineMaster, MachineMaster.name),
+    'lease': (LeaseMaster, LeaseMaster.name),
+    'dest': (DestMaster, DestMaster.name),
+    'item': (ItemMaster, ItemMaster.name),
+}
+
+# 工事の状態での絞り込み
+WORKSITE_STATUS = ('open', 'completed', 'all')
+
+LOOKUP_MAX_LIMIT = 100
+
+
+def fts_table(model):
+    return f'{model.__tablename__}_fts'
+
+
+def create_lookup_index(conn):
+    """名前列のFTS5索引と、同期用のトリガーを作成し、既存データを登録する
+
+    Args:
+        conn (Connection): DB接続
+    """
+
+    for model, column in LOOKUP_SOURCES.values():
+        table = model.__tablename__
+        fts = fts_table(model)
+        name = column.key
+        # 外部コンテンツ型（名前は元テーブルから読む）。1～3文字の前方一致用の索引も作る
+        conn.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+            f"{name}, content='{table}', content_rowid='id', prefix='1 2 3')"))
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, {name}) VALUES (new.id, new.{name}); END"))
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {name}) VALUES ('delete', old.id, old.{name}); END"))
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {name} ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {name}) VALUES ('delete', old.id, old.{name}); "
+            f"INSERT INTO {fts}(rowid, {name}) VALUES (new.id, new.{name}); END"))
+        conn.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+
+
+def to_match_query(q):
+    """入力文字列を、語毎の前方一致(AND)のFTS5クエリに変換する
+
+    Args:
+        q (str): 入力文字列 ex.) 山田 解体
+    """
+
+    terms = ['"' + t.replace('"', '""') + '"*' for t in q.split()]
+    return ' '.join(terms)
+
+
+def lookup(session, kind, account_id, q=None, after=None, limit=20, status='open'):
+    """名前の前方一致で検索する。名前・IDの順に並べ、キーセットでページングする
+
+    Args:
+        session (Session): DBセッション
+        kind (str): 種類（LOOKUP_SOURCESのキー）
+        account_id (int): アカウント(Account.id)
+        q (str, optional): 検索文字列。省略時は全件
+        after (int, optional): 前のページの最後のID
+        limit (int): 件数
+        status (str): 工事の状態（worksiteのみ。WORKSITE_STATUS）
+
+    Returns:
+        dict:
+            items: [{'id', 'name'}]（worksiteは 'customer_name', 'completed' も含む）
+            next: 次のページを取得する場合の after。最後のページはNone
+    """
+
+    model, column = LOOKUP_SOURCES[kind]
+    columns = [model.id, column]
+    if model is ReportHead:
+        columns.extend([ReportHead.customer_name, ReportHead.completed_date])
+
+    stmt = select(*columns).where(model.account_id == account_id)
+    if q is not None and q.strip() != '':
+        fts = fts_table(model)
+        stmt = stmt.where(model.id.in_(
+            select(literal_column('rowid')).select_from(text(fts)).where(
+                text(f'{fts} MATCH :q').bindparams(q=to_match_query(q)))
+        ))
+    if model is ReportHead and status == 'open':
+        stmt = stmt.where(ReportHead.completed_date.is_(None))
+    elif model is ReportHead and status == 'completed':
+        stmt = stmt.where(ReportHead.completed_date.is_not(None))
+    if after is not None:
+        after_name = session.scalar(select(column).where(model.id == after))
+        if after_name is not None:
+            stmt = stmt.where(tuple_(column, model.id) > tuple_(after_name, after))
+
+    rows = session.execute(stmt.order_by(column, model.id).limit(limit + 1)).all()
+
+    items = list()
+    for row in rows[:limit]:
+        item = {'id': row[0], 'name': row[1]}
+        if model is ReportHead:
+            item['customer_name'] = row[2]
+            item['completed'] = row[3] is not None
+        items.append(item)
+
+    return dict(
+        items=items,
+        next=items[-1]['id'] if len(rows) > limit else None,
+    )
+
+
+# 全文検索の索引。rowid は明細が id*2、工事が id*2+1
+# trigram のため日本語の文中でも一致する（3文字未満の語は索引を使わずに比較する）
+SEARCH_TABLE = 'report_search'
+SEARCH_COLUMNS = ('name', 'dest', 'memo', 'address')
+SEARCH_MAX_LIMIT = 100
+
+# snippetの強調部分の目印（HTMLエスケープ後に<mark>に置き換える）
+_MARK_START = '\x02'
+_MARK_END = '\x03'
+
+
+def create_search_index(conn):
+    """明細・工事の全文検索の索引と、同期用のトリガーを作成し、既存データを登録する
+
+    Args:
+        conn (Connection): DB接続
+    """
+
+    t = SEARCH_TABLE
+    conn.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {t} USING fts5("
+        "name, dest, memo, address, report_head_id UNINDEXED, work_date UNINDEXED, tokenize='trigram')"))
+    create_search_triggers(conn)
+
+    columns = "rowid, name, dest, memo, address, report_head_id, work_date"
+    conn.execute(text(f"DELETE FROM {t}"))
+    conn.execute(text(
+        f"INSERT INTO {t}({columns}) "
+        "SELECT id * 2, name, dest, memo, NULL, report_head_id, work_date FROM report_detail"))
+    conn.execute(text(
+        f"INSERT INTO {t}({columns}) "
+        "SELECT id * 2 + 1, NULL, NULL, memo, address, id, NULL FROM report_head"))
+
+
+def create_search_triggers(conn):
+    """全文検索の索引を明細・工事と同期するトリガーを作成する（テーブルを作り直した場合も使う）
+
+    Args:
+        conn (Connection): DB接続
+    """
+
+    t = SEARCH_TABLE
+    detail_values = "new.id * 2, new.name, new.dest, new.memo, NULL, new.report_head_id, new.work_date"
+    head_values = "new.id * 2 + 1, NULL, NULL, new.memo, new.address, new.id, NULL"
+    columns = "rowid, name, dest, memo, address, report_head_id, work_date"
+    for table, values, rowid in (
+        ('report_detail', detail_values, 'old.id * 2'),
+        ('report_head', head_values, 'old.id * 2 + 1'),
+    ):
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {t}_{table}_ai AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {t}({columns}) VALUES ({values}); END"))
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {t}_{table}_ad AFTER DELETE ON {table} BEGIN "
+            f"DELETE FROM {t} WHERE rowid = {rowid}; END"))
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {t}_{table}_au AFTER UPDATE ON {table} BEGIN "
+            f"DELETE FROM {t} WHERE rowid = {rowid}; "
+            f"INSERT INTO {t}({columns}) VALUES ({values}); END"))
+
+
+def add_search_rows(session, head_id, details):
+    """アーカイブした明細を索引に登録する（report_detail から削除するとトリガーで索引からも消えるため）
+
+    Args:
+        session (Session): DBセッション
+        head_id (int): 工事(ReportHead.id)
+        details (list): 明細 [{'id', 'work_date', 'name', 'dest', 'memo'}]（work_dateはDBの値の文字列）
+    """
+
+    if not details:
+        return
+    session.execute(
+        text(f"INSERT INTO {SEARCH_TABLE}(rowid, name, dest, memo, address, report_head_id, work_date) "
+             "VALUES (:id * 2, :name, :dest, :memo, NULL, :report_head_id, :work_date)"),
+        [dict(d, report_head_id=head_id) for d in details])
+
+
+def delete_search_rows(session, detail_ids):
+    """明細を索引から削除する（アーカイブから戻す前に、挿入時のトリガーとの重複を避ける）
+
+    Args:
+        session (Session): DBセッション
+        detail_ids (list): 明細(ReportDetail.id)
+    """
+
+    if not detail_ids:
+        return
+    session.execute(
+        text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :rowid"),
+        [{'rowid': i * 2} for i in detail_ids])
+
+
+def highlight(snippet):
+    """snippetをHTMLエスケープし、一致部分を<mark>で囲む"""
+
+    return html.escape(snippet).replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+def short_snippet(values, terms, width=16):
+    """最初に語が見つかった列の前後を切り出し、一致部分を<mark>で囲む
+
+    Args:
+        values (list): 各列の値（SEARCH_COLUMNSの順）
+        terms (list): 検索語
+        width (int): 一致部分の前後の文字数
+    """
+
+    for value in values:
+        if value is None:
+            continue
+        for term in terms:
+            i = value.find(term)
+            if i < 0:
+                continue
+            start = max(0, i - width)
+            end = i + len(term) + width
+            return ('…' if start > 0 else '') + \
+                html.escape(value[start:i]) + '<mark>' + html.escape(term) + '</mark>' + \
+                html.escape(value[i + len(term):end]) + ('…' if end < len(value) else '')
+    return ''
+
+
+def search_reports(session, account_id, q, after=None, limit=20):
+    """明細・工事を全文検索する。一致度(bm25)順に並べ、キーセットでページングする
+
+    Args:
+        session (Session): DBセッション
+        account_id (int): アカウント(Account.id)
+        q (str): 検索文字列（空白区切りの語は全て含むものを検索する）
+        after (str, optional): 前のページのレスポンスの next
+        limit (int): 件数
+
+    Returns:
+        dict:
+            items: [{'source', 'id', 'work_id', 'worksite_name', 'work_date', 'type', 'snippet'}]
+                source は detail（明細）または head（工事）。snippetはHTML（一致部分が<mark>）
+            next: 次のページを取得する場合の after。最後のページはNone
+    """
+
+    t = SEARCH_TABLE
+    terms = q.split()
+    long_terms = [w for w in terms if len(w) >= 3]
+    short_terms = [w for w in terms if len(w) < 3]
+
+    params = dict(account_id=account_id, limit=limit + 1)
+    where = list()
+    if long_terms:
+        where.append(f"{t} MATCH :q")
+        params['q'] = ' '.join('"' + w.replace('"', '""') + '"' for w in long_terms)
+        rank = f"bm25({t})"
+        snippet = f"snippet({t}, -1, '{_MARK_START}', '{_MARK_END}', '…', 16)"
+    else:
+        # snippet() は MATCH がない場合は使えないため、列の値から作る（short_snippet）
+        rank = "0.0"
+        snippet = "json_array(" + ', '.join(f"{t}.{c}" for c in SEARCH_COLUMNS) + ")"
+    # 3文字未満の語は trigram の索引を使えないため、文字列で比較する
+    for i, w in enumerate(short_terms):
+        where.append('(' + ' OR '.join(f"instr({t}.{c}, :s{i}) > 0" for c in SEARCH_COLUMNS) + ')')
+        params[f's{i}'] = w
+    if after is not None:
+        after_rank, after_rowid = after.rsplit(':', 1)
+        where.append(f"({rank}, {t}.rowid) > (:after_rank, :after_rowid)")
+        params['after_rank'] = float(after_rank)
+        params['after_rowid'] = int(after_rowid)
+
+    stmt = text(
+        f"SELECT {t}.rowid, {rank} AS score, {snippet}, {t}.work_date, "
+        "report_head.id, report_head.worksite_name, report_detail.type "
+        f"FROM {t} "
+        f"JOIN report_head ON report_head.id = {t}.report_head_id "
+        f"LEFT JOIN report_detail ON report_detail.id = {t}.rowid / 2 AND {t}.rowid % 2 = 0 "
+        f"WHERE report_head.account_id = :account_id AND {' AND '.join(where)} "
+        f"ORDER BY score, {t}.rowid "
+        "LIMIT :limit"
+    )
+
+    rows = session.execute(stmt, params).all()
+
+    # アーカイブした明細は report_detail にないため、種別はアーカイブから取得する
+    archived = [(work_id, work_date, rowid // 2)
+                for rowid, _, _, work_date, work_id, _, type in rows[:limit] if rowid % 2 == 0 and type is None]
+    if archived:
+        from archive import archived_types  # archive は search を読み込むため、ここで読み込む
+        archived = archived_types(session, archived)
+
+    items = list()
+    for rowid, score, snippet_text, work_date, work_id, worksite_name, type in rows[:limit]:
+        is_detail = rowid % 2 == 0
+        if is_detail and type is None:
+            type = archived.get(rowid // 2)
+        items.append({
+            'source': 'detail' if is_detail else 'head',
+            'id': rowid // 2,
+            'work_id': work_id,
+            'worksite_name': worksite_name,
+            'work_date': work_date[:10] if work_date is not None else None,
+            'type': type,
+            'snippet': highlight(snippet_text) if long_terms else short_snippet(json.loads(snippet_text), short_terms),
+        })
+
+    next_after = None
+    if len(rows) > limit:
+        rowid, score = rows[limit - 1][:2]
+        next_after = f'{score!r}:{rowid}'
+
+    return dict(items=items, next=next_after)
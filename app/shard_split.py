@@ -0,0 +1,146 @@
+"""共通DBのアカウント毎のデータを、アカウント毎のDB（シャーディング）にコピーする
+
+シャーディング（環境変数 shard_dir）を有効にすると、マスタ・工事・明細はアカウントのDBから
+読み書きするため、それまで共通DB（db_path）に保存していたデータは見えなくなる。
+有効にする前に、このスクリプトでアカウント毎のDBにコピーする。
+
+- アカウントのDBが既にある場合は、そのアカウントはコピーしない（二重にコピーしない）
+- 行のID・変更履歴(change_log)の seq は元のままコピーする（端末の差分同期をそのまま続けられる）
+- 共通DBの行は削除しない（アカウント・ユーザ以外は、シャーディング時には使われない）
+
+使い方:
+    shard_dir=/path/to/shards python shard_split.py               # 全てのアカウント
+    shard_dir=/path/to/shards python shard_split.py --account 3   # Account.id 3 のみ
+"""
+import argparse
+import os
+
+from sqlalchemy import (
+    select,
+    text,
+)
+
+from db_common import (
+    DB_PATH,
+    SHARD_DIR,
+    get_engine,
+    shard_path,
+)
+from migration import migrate
+from search import SEARCH_TABLE
+from tables import (
+    GLOBAL_TABLES,
+    Account,
+    Base,
+    ChangeLog,
+)
+
+
+def _owned(table):
+    """共通DB(src)の行のうち、アカウント(:account_id)の行を選ぶ条件"""
+
+    if 'account_id' in table.c:
+        return "account_id = :account_id"
+    if table.name == 'trash_master':
+        return "dest_id IN (SELECT id FROM src.dest_master WHERE account_id = :account_id)"
+    return "report_head_id IN (SELECT id FROM src.report_head WHERE account_id = :account_id)"
+
+
+def split_account(account_id):
+    """アカウントの行を共通DBからアカウントのDBにコピーする
+
+    Args:
+        account_id (int): アカウント(Account.id)
+
+    Returns:
+        dict: {テーブル名: コピーした行数}。アカウントのDBが既にある場合はNone
+    """
+
+    if os.path.exists(shard_path(account_id)):
+        return None
+
+    # アカウントのDBとテーブル・索引・トリガーを作成する
+    engine = get_engine(account_id)
+    tables = [t for t in Base.metadata.sorted_tables if t.name not in GLOBAL_TABLES]
+    params = dict(account_id=account_id)
+    counts = dict()
+    try:
+        _copy(engine, tables, params, counts)
+    except Exception:
+        # 途中で失敗した場合は、やり直せるようにアカウントのDBを削除する
+        engine.dispose()
+        os.remove(shard_path(account_id))
+        raise
+    return counts
+
+
+def _copy(engine, tables, params, counts):
+    with engine.connect() as conn:
+        # ATTACH はトランザクションの外で行う
+        conn.exec_driver_sql("ATTACH DATABASE ? AS src", (DB_PATH,))
+        conn.commit()
+        try:
+            with conn.begin():
+                for table in tables:
+                    if table.name == ChangeLog.__tablename__:
+                        continue
+                    columns = ', '.join(c.name for c in table.c)
+                    # 挿入時のトリガーで、入力補完・全文検索の索引と変更履歴も登録される
+                    counts[table.name] = conn.execute(text(
+                        f"INSERT INTO main.{table.name} ({columns}) "
+                        f"SELECT {columns} FROM src.{table.name} WHERE {_owned(table)} ORDER BY rowid"),
+                        params).rowcount
+
+                # 変更履歴はトリガーで登録した分を消し、元の seq のままコピーする
+                conn.execute(text("DELETE FROM main.change_log"))
+                columns = ', '.join(c.name for c in ChangeLog.__table__.c)
+                counts[ChangeLog.__tablename__] = conn.execute(text(
+                    f"INSERT INTO main.change_log ({columns}) "
+                    f"SELECT {columns} FROM src.change_log WHERE account_id = :account_id ORDER BY seq"),
+                    params).rowcount
+
+                # アーカイブした明細は report_detail にないため、全文検索の索引を直接コピーする（archive.add_search_rows）
+                conn.execute(text(
+                    f"INSERT INTO main.{SEARCH_TABLE} (rowid, name, dest, memo, address, report_head_id, work_date) "
+                    f"SELECT rowid, name, dest, memo, address, report_head_id, work_date FROM src.{SEARCH_TABLE} "
+                    "WHERE rowid % 2 = 0 AND report_head_id IN ("
+                    "SELECT id FROM src.report_head WHERE account_id = :account_id AND archived_date IS NOT NULL)"),
+                    params)
+                # AUTOINCREMENT の採番も引き継ぐ（アーカイブした明細のIDを再利用しない）
+                names = ', '.join(f"'{t.name}'" for t in tables)
+                conn.execute(text(f"DELETE FROM main.sqlite_sequence WHERE name IN ({names})"))
+                conn.execute(text(
+                    "INSERT INTO main.sqlite_sequence (name, seq) "
+                    f"SELECT name, seq FROM src.sqlite_sequence WHERE name IN ({names})"))
+        finally:
+            conn.exec_driver_sql("DETACH DATABASE src")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--account', type=int, default=None, metavar='ACCOUNT_ID',
+                        help='コピーするアカウント(Account.id)。省略時は全てのアカウント')
+    args = parser.parse_args(argv)
+
+    if SHARD_DIR is None:
+        parser.error('環境変数 shard_dir を指定してください')
+
+    # 共通DBの列を最新にしてから、同じ列のままコピーする
+    migrate()
+    with get_engine().connect() as conn:
+        account_ids = conn.scalars(select(Account.id).order_by(Account.id)).all()
+    if args.account is not None:
+        if args.account not in account_ids:
+            parser.error(f'アカウントがありません: {args.account}')
+        account_ids = [args.account]
+
+    for account_id in account_ids:
+        counts = split_account(account_id)
+        if counts is None:
+            print(f'skipped: account={account_id} (already exists: {shard_path(account_id)})')
+            continue
+        print(f'copied: account={account_id} ' + ' '.join(f'{k}={v}' for k, v in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
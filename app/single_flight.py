@@ -0,0 +1,91 @@
+"""同じ集計の同時実行をまとめる（single-flight）
+
+集計の共有リンクが一斉に開かれた場合など、同じアカウント・同じ条件・同じデータの
+集計が同時に要求されたときは、実行中の1回の結果を待って共有する（結果は保存しない）。
+
+データのバージョンには、読み取るDB（スナップショットを含む）の変更履歴(change_log)の最後の seq を使う。
+途中で書き込みがあれば別の集計になるため、書き込み前の結果を返すことはない。
+
+使い方:
+    def compute(engine):
+        with Session(engine) as session:
+            return monthly_pivot(session, ...)    # 結果は待っている全てのリクエストで共有するため、変更しないこと
+
+    content = await single_flight(
+        'analytics/monthly', account_id, (start, end), lambda: get_read_engine(account_id, written_at), compute)
+"""
+import asyncio
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from sync import latest_seq
+
+
+# (処理名, アカウント, 条件, DB, バージョン) → 実行中の集計(asyncio.Task)
+_inflight = dict()
+# 処理名 → {'calls': 要求数, 'executed': 実行数, 'coalesced': 実行中の結果を待った数}
+_stats = dict()
+
+
+def _resolve(get_engine, account_id):
+    # DBの最後の seq を読むため、スレッドプールで実行する
+    engine = get_engine()
+    with Session(engine) as session:
+        return engine, latest_seq(session, account_id)
+
+
+def _retrieve(task):
+    # 待っているリクエストが全て切断された場合も、例外を取り出しておく
+    if not task.cancelled():
+        task.exception()
+
+
+async def single_flight(name, account_id, params, get_engine, func):
+    """同じ集計が実行中であればその結果を待ち、なければ func をスレッドプールで実行する
+
+    イベントループのスレッドから呼ぶこと（async のルート）
+
+    Args:
+        name (str): 処理名 ex.) analytics/monthly
+        account_id (int): アカウント(Account.id)
+        params (tuple): 集計の条件（ハッシュ可能な値）
+        get_engine (callable): 読み取るDBのエンジンを返す関数 ex.) lambda: get_read_engine(account_id, written_at)
+        func (callable): 集計 func(engine)。例外は待っている全てのリクエストに送出する
+
+    Returns:
+        object: func の戻り値（共有するため変更しないこと）
+    """
+
+    engine, version = await run_in_threadpool(_resolve, get_engine, account_id)
+    key = (name, account_id, params, str(engine.url), version)
+
+    s = _stats.setdefault(name, dict(calls=0, executed=0, coalesced=0))
+    s['calls'] += 1
+    task = _inflight.get(key)
+    if task is None:
+        s['executed'] += 1
+        # リクエストが切断されても、待っている他のリクエストのために最後まで実行する
+        task = asyncio.ensure_future(run_in_threadpool(func, engine))
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _inflight.pop(key, None))
+        task.add_done_callback(_retrieve)
+    else:
+        s['coalesced'] += 1
+
+    return await asyncio.shield(task)
+
+
+def stats():
+    """集計毎の要求数・実行数と、まとめた割合
+
+    Returns:
+        dict:
+            inflight: 実行中の集計の数
+            routes: {処理名: {'calls', 'executed', 'coalesced', 'coalesce_ratio'(coalesced / calls)}}
+    """
+
+    routes = dict()
+    for name, s in _stats.items():
+        routes[name] = dict(s, coalesce_ratio=s['coalesced'] / s['calls'] if s['calls'] else 0)
+    return dict(inflight=len(_inflight), routes=routes)
@@ -39,6 +39,109 @@ const callApiFromForm = (url, data = {}, type = 'GET', headers = {}) => {
 };
 
 
+// 工事名・マスタ名の入力補完（/lookup）。ulに検索結果を表示し、次のページがあれば「さらに表示」を追加する
+const fillLookupMenu = (ul, kind, q, onselect, params = {}, after = null) => {
+    const query = Object.assign({ q: q, limit: 20 }, params);
+    if (after !== null) {
+        query['after'] = after;
+    }
+    return callApiFromForm(`/lookup/${kind}`, query).done(function (data) {
+        if (after === null) {
+            ul.innerHTML = '';
+        }
+        $(ul).find('.lookup-more').remove();
+        data['items'].forEach(item => {
+            const li = document.createElement('li');
+            const button = document.createElement('button');
+            button.type = 'button';
+            button.className = 'dropdown-item';
+            button.innerText = item['name'];
+            button.onclick = () => onselect(item);
+            li.appendChild(button);
+            ul.appendChild(li);
+        });
+        if (data['next'] !== null) {
+            const li = document.createElement('li');
+            li.className = 'lookup-more';
+            const button = document.createElement('button');
+            button.type = 'button';
+            button.className = 'dropdown-item text-muted';
+            button.innerText = 'さらに表示';
+            button.onclick = (e) => {
+                // ドロップダウンを閉じずに続きを読み込む
+                e.stopPropagation();
+                fillLookupMenu(ul, kind, q, onselect, params, data['next']);
+            };
+            li.appendChild(button);
+            ul.appendChild(li);
+        }
+    });
+};
+
+
+// 同じタイミング（同じタスク内）で呼ばれたGETを POST /batch の1回の通信にまとめる。
+// callApi と同じく .done(data) / .fail(jqXHR) が使える（失敗時の jqXHR は status と responseJSON のみ）
+const MAX_BATCH_REQUESTS = 20;
+let pendingGets = [];
+
+const batchGet = (url, params = {}) => {
+    const deferred = $.Deferred();
+    pendingGets.push({ url: url, params: params, deferred: deferred });
+    if (pendingGets.length == 1) {
+        setTimeout(flushGets, 0);
+    }
+    return deferred.promise();
+};
+
+const flushGets = () => {
+    const calls = pendingGets;
+    pendingGets = [];
+    if (calls.length == 1) {
+        // 1件のみの場合はそのまま送る
+        callApiFromForm(calls[0].url, calls[0].params)
+            .done((data) => calls[0].deferred.resolve(data))
+            .fail((jqXHR) => calls[0].deferred.reject(jqXHR));
+        return;
+    }
+    for (let i = 0; i < calls.length; i += MAX_BATCH_REQUESTS) {
+        const chunk = calls.slice(i, i + MAX_BATCH_REQUESTS);
+        callApi('/batch', { requests: chunk.map(c => ({ path: c.url, params: c.params })) }, 'POST')
+            .done(function (data) {
+                data['responses'].forEach((r, j) => {
+                    if (r['status'] >= 200 && r['status'] < 300) {
+                        // 204 は $.ajax と同じく data なし
+                        chunk[j].deferred.resolve(r['status'] == 204 ? undefined : r['body']);
+                    } else {
+                        chunk[j].deferred.reject({ status: r['status'], responseJSON: r['body'] });
+                    }
+                });
+            })
+            .fail((jqXHR) => chunk.forEach(c => c.deferred.reject(jqXHR)));
+    }
+};
+
+// マスタ・日報の変更のイベント（/events）を受け取る。handlers は {イベント名: function(data)}
+// 切断中のイベントは届かないため、再接続した時は handlers.reload を呼ぶ
+const listenEvents = (handlers) => {
+    if (!window.EventSource) {
+        return null;
+    }
+    const source = new EventSource('/events');
+    let disconnected = false;
+    source.onerror = () => { disconnected = true; };
+    source.onopen = () => {
+        if (disconnected && handlers['reload'] !== undefined) {
+            handlers['reload']({});
+        }
+        disconnected = false;
+    };
+    Object.keys(handlers).forEach(name => {
+        source.addEventListener(name, (e) => handlers[name](JSON.parse(e.data)));
+    });
+    return source;
+};
+
+
 const postFormData = (url, data = {}, headers = {}) => {
     return $.ajax({
         url: url,
@@ -59,11 +162,13 @@ const togglePageButton = (current) => {
     const nav_home = document.querySelector('#nav-home');
     const nav_report = document.querySelector('#nav-report');
     const nav_report_summary = document.querySelector('#nav-report-summary');
+    const nav_report_dashboard = document.querySelector('#nav-report-dashboard');
     const nav_master = document.querySelector('#nav-master');
 
     nav_home.classList.remove('active');
     nav_report.classList.remove('active');
     nav_report_summary.classList.remove('active');
+    nav_report_dashboard.classList.remove('active');
     nav_master.classList.remove('active');
 
     switch (location.pathname) {
@@ -76,6 +181,9 @@ const togglePageButton = (current) => {
         case '/daily_report/summary':
             nav_report_summary.classList.toggle('active');
             break;
+        case '/daily_report/dashboard':
+            nav_report_dashboard.classList.toggle('active');
+            break;
         case '/master/top':
             nav_master.classList.toggle('active');
             break;
@@ -0,0 +1,391 @@
+"""オフライン端末向けの差分同期
+
+工事・明細・マスタへの書き込みは、トリガーで変更履歴(change_log)に記録する（書き込みと同じトランザクション）。
+変更履歴は追記のみで、行を削除・圧縮しない（端末の seq がいつのものでも差分を返せる）。
+端末は GET /sync で前回以降の差分を取得し、オフライン中の編集は POST /sync でまとめて送る。
+
+- 差分(changes_since): 行毎に最後の変更だけを返す。登録・更新は現在の行（列形式）、削除はIDのみ
+- 編集(apply_changes): 端末が最後に取得した seq(base_seq) より後にサーバ側で変更された行・日は競合として適用しない
+"""
+import contextlib
+import datetime
+
+from sqlalchemy import (
+    DateTime,
+    delete,
+    func,
+    insert,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+
+from app_utils import (
+    report_detail_rows,
+    to_columnar,
+)
+from tables import (
+    CarMaster,
+    ChangeLog,
+    CustomerMaster,
+    DestMaster,
+    ItemMaster,
+    LeaseMaster,
+    MachineMaster,
+    ReportDetail,
+    ReportHead,
+    StaffMaster,
+    TrashMaster,
+)
+
+
+# 同期対象: 種類 → テーブル
+SYNC_SOURCES = {
+    'work': ReportHead,
+    'detail': ReportDetail,
+    'staff': StaffMaster,
+    'car': CarMaster,
+    'lease': LeaseMaster,
+    'machine': MachineMaster,
+    'customer': CustomerMaster,
+    'dest': DestMaster,
+    'item': ItemMaster,
+    'trash': TrashMaster,
+}
+# POST /sync で行毎に編集できる種類（明細は日毎に置き換える）
+SYNC_WRITABLE = ('work', 'staff', 'car', 'lease', 'machine', 'customer', 'dest', 'item', 'trash')
+# 端末から変更できない列
+SYNC_READONLY_COLUMNS = ('id', 'account_id', 'reg_dtime', 'archived_date', 'quant_kg')
+
+OP_UPSERT = 'upsert'
+OP_DELETE = 'delete'
+
+SYNC_MAX_LIMIT = 5000
+
+_KINDS = {model.__tablename__: kind for kind, model in SYNC_SOURCES.items()}
+
+
+def _account_id_of(model, row):
+    """トリガー内で行のアカウントを求める式"""
+
+    if model is ReportDetail:
+        return f"(SELECT account_id FROM report_head WHERE id = {row}.report_head_id)"
+    if model is TrashMaster:
+        return f"(SELECT account_id FROM dest_master WHERE id = {row}.dest_id)"
+    return f"{row}.account_id"
+
+
+def _log_values(model, row, op):
+    head_id, work_date = (f"{row}.report_head_id", f"{row}.work_date") if model is ReportDetail else ("NULL", "NULL")
+    return f"{_account_id_of(model, row)}, '{model.__tablename__}', {row}.id, '{op}', {head_id}, {work_date}"
+
+
+_LOG_COLUMNS = "account_id, table_name, row_id, op, report_head_id, work_date"
+
+# 明細の変更履歴を記録しない工事（unlogged_details の間だけ行がある）
+_PAUSED_TABLE = 'change_log_paused'
+
+
+def create_change_log(conn):
+    """変更履歴を記録するトリガーを作成し、既存の行を登録済み(upsert)として記録する
+
+    Args:
+        conn (Connection): DB接続
+    """
+
+    create_change_log_triggers(conn)
+    for model in SYNC_SOURCES.values():
+        table = model.__tablename__
+        conn.execute(text(
+            f"INSERT INTO change_log({_LOG_COLUMNS}) "
+            f"SELECT {_log_values(model, table, OP_UPSERT)} FROM {table} ORDER BY id"))
+
+
+def create_change_log_triggers(conn):
+    """変更履歴を記録するトリガーを作成する（テーブルを作り直した場合も使う）
+
+    Args:
+        conn (Connection): DB接続
+    """
+
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {_PAUSED_TABLE} (report_head_id INTEGER PRIMARY KEY)"))
+    for model in SYNC_SOURCES.values():
+        table = model.__tablename__
+        for suffix, event, row, op in (
+            ('ai', 'INSERT', 'new', OP_UPSERT),
+            ('au', 'UPDATE', 'new', OP_UPSERT),
+            ('ad', 'DELETE', 'old', OP_DELETE),
+        ):
+            when = ""
+            if model is ReportDetail:
+                when = f"WHEN NOT EXISTS (SELECT 1 FROM {_PAUSED_TABLE} WHERE report_head_id = {row}.report_head_id) "
+            conn.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS change_log_{table}_{suffix} AFTER {event} ON {table} {when}BEGIN "
+                f"INSERT INTO change_log({_LOG_COLUMNS}) VALUES ({_log_values(model, row, op)}); END"))
+
+
+def drop_change_log_triggers(conn, model):
+    """テーブルの変更履歴のトリガーを削除する（create_change_log_triggers で作り直す場合）
+
+    Args:
+        conn (Connection): DB接続
+        model (Base): テーブル
+    """
+
+    for suffix in ('ai', 'au', 'ad'):
+        conn.execute(text(f"DROP TRIGGER IF EXISTS change_log_{model.__tablename__}_{suffix}"))
+
+
+@contextlib.contextmanager
+def unlogged_details(session, head_id):
+    """工事の明細の移動（アーカイブ・アーカイブから戻す）など、内容が変わらない書き込みを変更履歴に残さない
+
+    記録済みの変更履歴は消さず、この間だけトリガーが工事の明細を記録しないようにする。
+    失敗した場合はトランザクションごと取り消されるため、記録の停止も残らない
+
+    Args:
+        session (Session): DBセッション
+        head_id (int): 工事(ReportHead.id)
+    """
+
+    session.execute(text(f"INSERT INTO {_PAUSED_TABLE}(report_head_id) VALUES (:id)"), dict(id=head_id))
+    yield
+    session.execute(text(f"DELETE FROM {_PAUSED_TABLE} WHERE report_head_id = :id"), dict(id=head_id))
+
+
+def _to_value(v):
+    if isinstance(v, datetime.datetime):
+        return v.isoformat(sep=' ')
+    return v
+
+
+def changes_since(session, account_id, since=0, limit=1000):
+    """since より後の変更を取得する
+
+    Args:
+        session (Session): DBセッション
+        account_id (int): アカウント(Account.id)
+        since (int): 前回取得した seq。初回は0（全件）
+        limit (int): 変更履歴の件数
+
+    Returns:
+        dict:
+            seq: 次回の since
+            more: 続きがある場合True（seq を since にして続けて取得する）
+            changes: {種類: {'upsert': 現在の行（to_columnarの形式）, 'delete': [ID]}}
+    """
+
+    logs = session.execute(
+        select(
+            ChangeLog.seq,
+            ChangeLog.table_name,
+            ChangeLog.row_id,
+            ChangeLog.op,
+        ).where(
+            ChangeLog.account_id == account_id
+        ).where(
+            ChangeLog.seq > since
+        ).order_by(
+            ChangeLog.seq
+        ).limit(limit + 1)).all()
+    more = len(logs) > limit
+    logs = logs[:limit]
+
+    # 行毎に最後の変更のみ
+    latest = dict()
+    for _, table, row_id, op in logs:
+        latest.setdefault(table, dict())[row_id] = op
+
+    changes = dict()
+    for table, ops in latest.items():
+        kind = _KINDS[table]
+        model = SYNC_SOURCES[kind]
+        columns = [c for c in model.__table__.columns if c.key != 'account_id']
+        upsert_ids = [row_id for row_id, op in ops.items() if op == OP_UPSERT]
+        rows = list()
+        for i in range(0, len(upsert_ids), 500):
+            rows.extend(session.execute(
+                select(*columns).where(model.__table__.c.id.in_(upsert_ids[i:i + 500]))).all())
+        # 取得時にはもう削除されていた行は削除として返す
+        found = {row.id for row in rows}
+        changes[kind] = {
+            OP_UPSERT: to_columnar(
+                (tuple(_to_value(v) for v in row) for row in rows),
+                [c.key for c in columns],
+            ),
+            OP_DELETE: [row_id for row_id, op in ops.items() if op == OP_DELETE or row_id not in found],
+        }
+
+    return dict(
+        seq=logs[-1].seq if logs else since,
+        more=more,
+        changes=changes,
+    )
+
+
+def latest_seq(session, account_id):
+    """アカウントの最後の変更の seq（データのバージョン）。変更がなければ0
+
+    Args:
+        session (Session): DBセッション
+        account_id (int): アカウント(Account.id)
+    """
+
+    return session.scalar(select(func.max(ChangeLog.seq)).where(ChangeLog.account_id == account_id)) or 0
+
+
+def _owned(model, account_id):
+    """アカウントの行の条件（廃材処分費は処分先のアカウント）"""
+
+    if model is TrashMaster:
+        return TrashMaster.dest_id.in_(select(DestMaster.id).where(DestMaster.account_id == account_id))
+    return model.account_id == account_id
+
+
+def _to_columns(model, data):
+    """端末から送られた値を列の値に変換する。変更できない列・存在しない列はValueError"""
+
+    values = dict()
+    for key, v in data.items():
+        column = model.__table__.columns.get(key)
+        if column is None or key in SYNC_READONLY_COLUMNS:
+            raise ValueError(f'変更できない項目です: {key}')
+        if isinstance(column.type, DateTime) and isinstance(v, str):
+            v = datetime.datetime.fromisoformat(v)
+        values[key] = v
+    return values
+
+
+def _check_references(session, model, account_id, values):
+    """参照先の行（廃材処分費の処分先・品名）がアカウントの行か確認する。違う・ない場合はValueError
+
+    登録時だけでなく更新時も確認し、他のアカウントの処分先・品名に付け替えさせない
+    """
+
+    for key, v in values.items():
+        for fk in model.__table__.columns[key].foreign_keys:
+            target = fk.column.table
+            if 'account_id' not in target.c:
+                continue
+            if session.scalar(select(target.c.account_id).where(fk.column == v)) != account_id:
+                raise ValueError(f'参照先が見つかりません: {key}')
+
+
+def _changed_after(session, base_seq, *where):
+    return session.scalar(
+        select(func.count()).select_from(ChangeLog).where(ChangeLog.seq > base_seq).where(*where)) > 0
+
+
+def _current_row(session, model, row_id):
+    columns = [c for c in model.__table__.columns if c.key != 'account_id']
+    row = session.execute(select(*columns).where(model.__table__.c.id == row_id)).first()
+    if row is None:
+        return None
+    return {c.key: _to_value(v) for c, v in zip(columns, row)}
+
+
+def _apply_change(session, account_id, base_seq, change):
+    """1件の行の編集を適用する
+
+    Returns:
+        dict: {'status': 'ok'|'conflict'|'not_found', 'id', 'current'(競合時の現在の行)}
+    """
+
+    if change.kind not in SYNC_WRITABLE:
+        raise ValueError(f'編集できない種類です: {change.kind}')
+    if change.op not in (OP_UPSERT, OP_DELETE) or (change.op == OP_DELETE and change.id is None):
+        raise ValueError(f'op は {OP_UPSERT} または {OP_DELETE}（削除はidが必要）で指定してください')
+
+    model = SYNC_SOURCES[change.kind]
+    if change.id is not None:
+        if _changed_after(session, base_seq,
+                          ChangeLog.table_name == model.__tablename__, ChangeLog.row_id == change.id):
+            return dict(status='conflict', id=change.id, current=_current_row(session, model, change.id))
+
+    if change.op == OP_DELETE:
+        deleted = session.execute(
+            delete(model).where(model.id == change.id).where(_owned(model, account_id))).rowcount
+        return dict(status='ok' if deleted else 'not_found', id=change.id)
+
+    values = _to_columns(model, change.data or dict())
+    _check_references(session, model, account_id, values)
+    if change.id is not None:
+        updated = session.execute(
+            update(model).where(model.id == change.id).where(_owned(model, account_id)).values(**values)).rowcount
+        return dict(status='ok' if updated else 'not_found', id=change.id)
+
+    if model is TrashMaster:
+        # 処分先がアカウントを表すため必須
+        if values.get('dest_id') is None:
+            raise ValueError('処分先が見つかりません')
+    else:
+        values['account_id'] = account_id
+    # 同じ名前が登録済みの場合は競合
+    new_id = session.scalar(
+        sqlite_insert(model).values(**values).on_conflict_do_nothing().returning(model.id))
+    if new_id is None:
+        return dict(status='conflict', id=None, current=None)
+    return dict(status='ok', id=new_id)
+
+
+def _apply_day(session, account_id, base_seq, day):
+    """1日分の明細を置き換える
+
+    Returns:
+        dict: {'status': 'ok'|'conflict'|'not_found', 'work_id', 'work_date', 'count'}
+    """
+
+    from archive import restore_worksite  # archive は search を読み込むため、ここで読み込む
+
+    result = dict(work_id=day.work_id, work_date=day.work_date)
+    head = session.get(ReportHead, day.work_id)
+    if head is None or head.account_id != account_id:
+        return dict(result, status='not_found')
+    date = datetime.datetime.strptime(day.work_date, '%Y-%m-%d')
+    if _changed_after(session, base_seq,
+                      ChangeLog.report_head_id == head.id, ChangeLog.work_date == date):
+        return dict(result, status='conflict')
+
+    if head.archived_date is not None:
+        restore_worksite(session, head)
+    session.execute(
+        delete(ReportDetail).where(
+            ReportDetail.report_head_id == head.id
+        ).where(
+            ReportDetail.work_date == date
+        ))
+    rows = report_detail_rows(head.id, date, day.detail)
+    if rows:
+        session.execute(insert(ReportDetail), rows)
+    return dict(result, status='ok', count=len(rows))
+
+
+def apply_changes(session, account_id, request):
+    """端末の編集をまとめて適用する。編集毎にセーブポイントを使い、失敗した編集のみ取り消す
+
+    Args:
+        session (Session): DBセッション
+        account_id (int): アカウント(Account.id)
+        request (SyncRequest): base_seq と、行の編集(changes)・日毎の明細(days)
+
+    Returns:
+        dict:
+            changes: changes と同じ順の結果 [{'status', 'id', 'current'}]
+            days: days と同じ順の結果 [{'status', 'work_id', 'work_date', 'count'}]
+            status は ok / conflict / not_found / error（errorの場合は detail に理由）
+    """
+
+    results = dict(changes=list(), days=list())
+    for key, items, apply in (
+        ('changes', request.changes, _apply_change),
+        ('days', request.days, _apply_day),
+    ):
+        for item in items:
+            try:
+                with session.begin_nested():
+                    results[key].append(apply(session, account_id, request.base_seq, item))
+            except (ValueError, IntegrityError) as e:
+                results[key].append(dict(status='error', detail=str(e.orig if isinstance(e, IntegrityError) else e)))
+    return results
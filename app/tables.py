@@ -7,9 +7,11 @@ from typing import (
 )
 from sqlalchemy import (
     ForeignKey,
+    LargeBinary,
     String,
     DateTime,
     Column,
+    Index,
     Table,
 )
 from sqlalchemy.orm import (
@@ -336,6 +338,13 @@ class ReportHead(AccountBase, Base):
         nullable=True,
     )
     memo: Mapped[Optional[str]] = mapped_column(String(512), default=None)
+    # 明細をアーカイブ(report_archive)に移した日時。移していない場合はNULL
+    archived_date: Mapped[Optional[DateTime]] = mapped_column(DateTime, nullable=True, default=None)
+
+    __table_args__ = (
+        # 工事名のルートから工事IDを引く用
+        Index('ix_report_head_account_id_worksite_name', 'account_id', 'worksite_name'),
+    )
 
     def __repr__(self) -> str:
         return f"ReportHead(id={self.id!r}, customer_name={self.customer_name!r}, "\
@@ -349,6 +358,7 @@ class ReportHead(AccountBase, Base):
             'address': self.address,
             'completed_date': datetime.datetime.strftime(self.completed_date, '%Y-%m-%d') if self.completed_date is not None else None,
             'memo': self.memo if self.memo is not None else "",
+            'archived': self.archived_date is not None,
         }
 
 
@@ -367,6 +377,8 @@ class ReportDetail(Base):
     quant: Mapped[int] = mapped_column(default=0)
     memo: Mapped[Optional[str]] = mapped_column(String(512), default=None)
     unit_type: Mapped[int] = mapped_column(default=0)
+    # 廃材の数量をkgに換算した値（単位がなしの場合、廃材以外はNULL）
+    quant_kg: Mapped[Optional[int]] = mapped_column(default=None)
     reg_dtime: Mapped[DateTime] = mapped_column(
         DateTime,
         nullable=False,
@@ -376,6 +388,14 @@ class ReportDetail(Base):
 
     # __table_args__ = (UniqueConstraint(
     #     'report_head_id', 'work_date'),)
+    __table_args__ = (
+        # 工事毎の日付範囲の取得用。quant, costまで含め、日毎の合計はテーブルを読まずに集計する
+        Index('ix_report_detail_report_head_id_work_date_cost', 'report_head_id', 'work_date', 'quant', 'cost'),
+        # 人員・車両・重機の稼働集計用
+        Index('ix_report_detail_type_name_work_date', 'type', 'name', 'work_date'),
+        # アーカイブ（archive.py）で report_detail から消した明細のIDを再利用しない
+        {'sqlite_autoincrement': True},
+    )
 
     def __repr__(self) -> str:
         return f"ReportDetail(id={self.id!r}, report_head={self.report_head!r}, "\
@@ -395,14 +415,130 @@ class ReportDetail(Base):
             'cost': self.cost,
             'quant': self.quant,
             'unit_type': self.unit_type,
+            'quant_kg': self.quant_kg,
+            'memo': self.memo if self.memo is not None else "",
+        }
+
+    def to_dict_nohead(self):
+        return {
+            'id': self.id,
+            'work_date': datetime.datetime.strftime(self.work_date, '%Y-%m-%d'),
+            'type': self.type,
+            'name': self.name,
+            'dest': self.dest,
+            'cost': self.cost,
+            'quant': self.quant,
+            'unit_type': self.unit_type,
+            'quant_kg': self.quant_kg,
             'memo': self.memo if self.memo is not None else "",
         }
 
 
+class ReportArchive(Base):
+    """アーカイブした明細。工事・作業日毎に1行で、明細はMessagePackにまとめる（archive.py）"""
+    __tablename__ = 'report_archive'
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    report_head_id: Mapped[ReportHead] = mapped_column(
+        ForeignKey('report_head.id')
+    )
+    work_date: Mapped[DateTime] = mapped_column(DateTime, nullable=False)
+    details: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('report_head_id', 'work_date'),
+    )
+
+    def __repr__(self) -> str:
+        return f"ReportArchive(id={self.id!r}, report_head_id={self.report_head_id!r}, "\
+            f"work_date={self.work_date!r})"
+
+
+class ReportArchiveTotal(Base):
+    """アーカイブした明細の集計。工事・作業日・種別・名前・処分先毎の合計で、アーカイブ時に作成する（archive.py）
+
+    アカウント全体の集計(analytics.py)は、明細を展開せずにこの表を report_detail と合わせて集計する。
+    合計はSQLのSUMと同じく、全てNULLの場合はNULL
+    """
+    __tablename__ = 'report_archive_total'
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    report_head_id: Mapped[ReportHead] = mapped_column(
+        ForeignKey('report_head.id')
+    )
+    work_date: Mapped[DateTime] = mapped_column(DateTime, nullable=False)
+    type: Mapped[int] = mapped_column(nullable=False)
+    name: Mapped[Optional[str]] = mapped_column(String(256))
+    dest: Mapped[Optional[str]] = mapped_column(String(256))
+    # 数量の合計
+    quant: Mapped[Optional[int]]
+    # kgに換算した数量の合計
+    quant_kg: Mapped[Optional[int]]
+    # kgに換算できない（単位がなし）明細の数量の合計
+    unweighed: Mapped[Optional[int]]
+    # 費用（数量 × 単価）の合計
+    total: Mapped[Optional[int]]
+
+    __table_args__ = (
+        Index('ix_report_archive_total_report_head_id_work_date', 'report_head_id', 'work_date'),
+        # 人員・車両・重機の稼働集計用（report_detail と同じ）
+        Index('ix_report_archive_total_type_name_work_date', 'type', 'name', 'work_date'),
+    )
+
+    def __repr__(self) -> str:
+        return f"ReportArchiveTotal(id={self.id!r}, report_head_id={self.report_head_id!r}, "\
+            f"work_date={self.work_date!r}, type={self.type!r}, name={self.name!r})"
+
+
+class ChangeLog(Base):
+    """工事・明細・マスタの変更履歴。書き込みと同じトランザクションでトリガーが記録する（sync.py）"""
+    __tablename__ = 'change_log'
+    # 再利用されない連番（AUTOINCREMENT）。アカウント毎に見ても増加する
+    seq: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    account_id: Mapped[Optional[int]]
+    table_name: Mapped[str] = mapped_column(String(64))
+    row_id: Mapped[int]
+    # upsert（登録・更新）または delete
+    op: Mapped[str] = mapped_column(String(8))
+    # 明細のみ。日毎の同期の競合検出用
+    report_head_id: Mapped[Optional[int]]
+    work_date: Mapped[Optional[DateTime]] = mapped_column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # 差分の取得用
+        Index('ix_change_log_account_id_seq', 'account_id', 'seq'),
+        # 競合検出用
+        Index('ix_change_log_table_name_row_id', 'table_name', 'row_id'),
+        Index('ix_change_log_report_head_id_work_date', 'report_head_id', 'work_date'),
+        {'sqlite_autoincrement': True},
+    )
+
+
+# シャーディング時も共通DBに保存するテーブル（db_common.SHARD_DIR）
+GLOBAL_TABLES = ('account', 'user', 'association_table')
+
+
+def _create_tables(engine, tables):
+    from migration import migrate
+
+    Base.metadata.create_all(engine, tables=tables)
+    # create_allは既存テーブルのインデックスを作成しないため、追加分をここで作成する
+    for table in tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    migrate(engine)
+
 
 def create_all_tables():
-    engine = get_engine()
-    Base.metadata.create_all(engine)
+    _create_tables(get_engine(), Base.metadata.sorted_tables)
+
+
+def create_shard_tables(engine):
+    """アカウント毎のDBに、共通DB以外のテーブルを作成する
+
+    Args:
+        engine (Engine): アカウントのDB
+    """
+
+    _create_tables(engine, [t for t in Base.metadata.sorted_tables if t.name not in GLOBAL_TABLES])
 
 
 if __name__ == '__main__':
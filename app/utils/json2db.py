@@ -4,7 +4,10 @@ import os
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 
-from db_common import get_engine
+from db_common import (
+    SHARD_DIR,
+    get_engine,
+)
 from schemas import (
     MAP_MASTER,
 )
@@ -13,22 +16,64 @@ from app_utils import get_password_hash
 
 DATA_FILE_PATH = os.path.join(os.path.dirname(__file__), 'master_data')
 
+# account_id を持たず、他のマスタを参照するマスタ: {参照する列: 参照先のマスタ種別}
+# 参照先と同じアカウントのDBに登録する
+REFERENCED_MASTERS = {
+    'trash': {'dest_id': 'dest', 'item_id': 'item'},
+}
 
-def register_init_data(master_type):
+
+def load_init_data(master_type):
 
     with open(f'{DATA_FILE_PATH}/{master_type}.json', encoding="utf-8") as f:
-        data = json.load(f)
+        return json.load(f)
 
-    reg_data = [MAP_MASTER[master_type](**d) for d in data]
 
-    with Session(get_engine()) as session:
-        try:
-            session.add_all(reg_data)
-            session.commit()
-        except Exception as e:
-            print(type(e))
-            print(e)
-            session.rollback()
+def init_data_ids(master_type):
+    """初期データのID（空のDBに登録した場合の連番）→ (アカウント, 登録先のDBでのID)
+
+    シャーディング時はアカウント毎のDBに登録するため、IDはアカウント毎に1からの連番になる
+    """
+
+    ids = dict()
+    counts = dict()
+    for i, d in enumerate(load_init_data(master_type), start=1):
+        account_id = d.get('account_id')
+        counts[account_id] = counts.get(account_id, 0) + 1
+        ids[i] = (account_id, counts[account_id] if SHARD_DIR is not None else i)
+    return ids
+
+
+def register_init_data(master_type):
+
+    data = load_init_data(master_type)
+
+    refs = REFERENCED_MASTERS.get(master_type, dict())
+    ref_ids = {col: init_data_ids(ref_type) for col, ref_type in refs.items()}
+
+    # シャーディング時はアカウント毎のDBに登録する
+    reg_data = dict()
+    for d in data:
+        account_id = d.get('account_id')
+        if refs:
+            # 参照先のマスタのアカウントのDBに、そのDBでの参照先のIDで登録する
+            owners = {ref_ids[col][d[col]][0] for col in refs}
+            if len(owners) != 1:
+                print(f'{master_type}: 異なるアカウントのマスタを参照しているため登録しません {d}')
+                continue
+            account_id = owners.pop()
+            d = dict(d, **{col: ref_ids[col][d[col]][1] for col in refs})
+        reg_data.setdefault(account_id, []).append(MAP_MASTER[master_type](**d))
+
+    for account_id, account_data in reg_data.items():
+        with Session(get_engine(account_id)) as session:
+            try:
+                session.add_all(account_data)
+                session.commit()
+            except Exception as e:
+                print(type(e))
+                print(e)
+                session.rollback()
 
 
 def register_user_account():
@@ -0,0 +1,195 @@
+"""書き込みの単一ライターキュー
+
+sqliteは同時に1つの接続しか書き込めないため、同時に保存すると "database is locked" になることがある。
+環境変数 write_queue=1 の場合、書き込みを1つの専用スレッドに集め、キューに溜まった分を
+1トランザクションでまとめてコミットする（グループコミット）。
+各書き込みはセーブポイント内で実行するため、1件の失敗は他の書き込みに影響しない。
+
+使い方:
+    def write(session):
+        session.add(...)
+        session.flush()
+        return new.id    # コミット後にセッションは閉じるため、ORMオブジェクトではなく値を返す
+
+    new_id = await run_write(write, account_id)
+"""
+import asyncio
+import concurrent.futures
+import os
+import queue
+import threading
+import time
+
+from fastapi import (
+    HTTPException,
+    status,
+)
+from sqlalchemy.orm import Session
+
+from db_common import get_engine
+
+
+WRITE_QUEUE_ENABLED = os.getenv('write_queue', '0') == '1'
+# キューに入れられる書き込みの数。超えた場合は503を返す
+WRITE_QUEUE_SIZE = int(os.getenv('write_queue_size', '256'))
+# 1トランザクションでまとめてコミットする書き込みの最大数
+GROUP_COMMIT_MAX = int(os.getenv('group_commit_max', '32'))
+
+_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+_writer = None
+_writer_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats = dict(
+    submitted=0,
+    rejected=0,
+    committed=0,
+    failed=0,
+    transactions=0,
+    max_depth=0,
+    max_group=0,
+    commit_seconds=0.0,
+)
+
+
+async def run_write(func, account_id=None):
+    """書き込みを実行し、func の戻り値を返す。func内の例外はそのまま送出する
+
+    Args:
+        func (callable): 書き込み処理 func(session)。コミットしないこと
+        account_id (int, optional): アカウント(Account.id)。get_engine と同じ
+    """
+
+    if not WRITE_QUEUE_ENABLED:
+        with Session(get_engine(account_id)) as session:
+            _begin(session)
+            result = func(session)
+            session.commit()
+        return result
+
+    future = concurrent.futures.Future()
+    try:
+        _queue.put_nowait((account_id, func, future))
+    except queue.Full:
+        with _stats_lock:
+            _stats['rejected'] += 1
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="混み合っています。しばらくしてから再度保存してください",
+            headers={'Retry-After': '1'},
+        )
+    with _stats_lock:
+        _stats['submitted'] += 1
+        _stats['max_depth'] = max(_stats['max_depth'], _queue.qsize())
+    _start_writer()
+
+    return await asyncio.wrap_future(future)
+
+
+def stats():
+    """キューの状態
+
+    Returns:
+        dict:
+            enabled: 単一ライターモードか
+            depth: キューで待っている書き込みの数
+            submitted, rejected, committed, failed: 受け付けた・満杯で断った・コミットした・失敗した書き込みの数
+            transactions: コミットしたトランザクションの数
+            max_depth, max_group: キューの最大の長さ、1トランザクションの最大の書き込み数
+            avg_group: 1トランザクションの平均の書き込み数
+            commit_seconds: トランザクションの実行時間の合計
+    """
+
+    with _stats_lock:
+        s = dict(_stats)
+    s['enabled'] = WRITE_QUEUE_ENABLED
+    s['depth'] = _queue.qsize()
+    s['avg_group'] = s['committed'] / s['transactions'] if s['transactions'] else 0
+    return s
+
+
+def _in_transaction(session):
+    return session.connection().connection.dbapi_connection.in_transaction
+
+
+def _begin(session):
+    """トランザクションを明示的に開始する
+
+    pysqlite はDML以外の文ではトランザクションを開始しないため、そのままでは
+    SAVEPOINT がトランザクションを開始し、RELEASE で書き込み毎にコミットされてしまう。
+    BEGIN IMMEDIATE で開始し、セーブポイントを含めて1回のコミットにする（書き込みのロックも先に取る）
+    """
+
+    session.connection().exec_driver_sql('BEGIN IMMEDIATE')
+    if not _in_transaction(session):
+        raise RuntimeError('トランザクションを開始できませんでした')
+
+
+def _start_writer():
+    global _writer
+
+    with _writer_lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=_write_loop, name='write_queue', daemon=True)
+            _writer.start()
+
+
+def _write_loop():
+    while True:
+        jobs = [_queue.get()]
+        while len(jobs) < GROUP_COMMIT_MAX:
+            try:
+                jobs.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        # アカウント（DB）毎に、受け付けた順で1トランザクションにまとめる
+        groups = dict()
+        for account_id, func, future in jobs:
+            groups.setdefault(account_id, []).append((func, future))
+        for account_id, group in groups.items():
+            _commit_group(account_id, group)
+
+
+def _commit_group(account_id, group):
+    start = time.perf_counter()
+    done = list()
+    failed = 0
+    try:
+        with Session(get_engine(account_id)) as session:
+            # 書き込みを実行する前に開始する。開始できなければ、どの書き込みも実行せずに失敗にする
+            _begin(session)
+            for func, future in group:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    with session.begin_nested():
+                        result = func(session)
+                except Exception as e:
+                    future.set_exception(e)
+                    failed += 1
+                    continue
+                done.append((future, result))
+            # 全ての書き込みが1つのトランザクションに入っていること（コミットはこの1回のみ）
+            if done and not _in_transaction(session):
+                raise RuntimeError('グループコミット前にトランザクションが終了しています')
+            session.commit()
+    except Exception as e:
+        # コミットできなかった場合は、まとめた書き込みを全て失敗にする
+        for future, _ in done:
+            future.set_exception(e)
+        for _, future in group:
+            if not future.done():
+                future.set_exception(e)
+        failed = len(group)
+        done = list()
+
+    for future, result in done:
+        future.set_result(result)
+
+    with _stats_lock:
+        _stats['committed'] += len(done)
+        _stats['failed'] += failed
+        _stats['transactions'] += 1
+        _stats['max_group'] = max(_stats['max_group'], len(group))
+        _stats['commit_seconds'] += time.perf_counter() - start
@@ -0,0 +1,113 @@
+"""アカウント全体の集計（/analytics/*）のベンチマーク
+
+一時DBに明細を --rows 件（既定500万件）登録し、monthly_pivot と resource_utilization の実行時間を計測する。
+
+使い方:
+    python bench/analytics_bench.py --rows 5000000 --worksites 2000 --months 24
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+ACCOUNT_ID = 1
+
+
+def setup_db(rows, worksites, months, resources, chunk=200000):
+    """明細を一括登録した一時DBを作成する"""
+
+    os.environ['db_path'] = os.path.join(tempfile.mkdtemp(prefix='drw_analytics_'), 'db.sqlite')
+    sys.path.insert(0, APP_DIR)
+
+    from db_common import get_engine
+    from tables import create_all_tables
+
+    create_all_tables()
+    engine = get_engine()
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO account (id, account_id, account_pwd, fullname, reg_dtime) VALUES (?, 'bench', 'x', 'bench', CURRENT_TIMESTAMP)",
+            (ACCOUNT_ID,))
+        cur.executemany(
+            "INSERT INTO report_head (id, customer_name, worksite_name, address, account_id, reg_dtime) VALUES (?, 'customer', ?, 'address', ?, CURRENT_TIMESTAMP)",
+            ((i + 1, f'work{i}', ACCOUNT_ID) for i in range(worksites)))
+
+        start = datetime.date(2024, 1, 1)
+        days = months * 30
+        dates = [(start + datetime.timedelta(days=d)).strftime('%Y-%m-%d 00:00:00.000000') for d in range(days)]
+        rnd = random.Random(0)
+        inserted = 0
+        while inserted < rows:
+            n = min(chunk, rows - inserted)
+            cur.executemany(
+                "INSERT INTO report_detail (report_head_id, work_date, type, name, cost, quant, unit_type, reg_dtime) VALUES (?, ?, ?, ?, ?, ?, 0, CURRENT_TIMESTAMP)",
+                ((rnd.randint(1, worksites), dates[rnd.randrange(days)], rnd.randrange(8), f'name{rnd.randrange(resources)}',
+                  rnd.randint(1000, 30000), rnd.randint(1, 5))
+                 for _ in range(n)))
+            inserted += n
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5000000)
+    parser.add_argument('--worksites', type=int, default=2000)
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--resources', type=int, default=100, help='種別毎の人員・車両・重機の数')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None, help='結果JSONの保存先')
+    args = parser.parse_args(argv)
+
+    t = time.perf_counter()
+    setup_db(args.rows, args.worksites, args.months, args.resources)
+    print(f'setup: {args.rows} rows in {time.perf_counter() - t:.1f}s')
+
+    from sqlalchemy.orm import Session
+    from analytics import monthly_pivot, parse_month, resource_utilization
+    from db_common import get_engine
+
+    month_from = parse_month('2024-01')
+    month_to = parse_month((datetime.date(2024, 1, 1) + datetime.timedelta(days=args.months * 30 - 1)).strftime('%Y-%m'))
+    # 稼働集計は1か月分
+    date_from = datetime.datetime(2024, 3, 1)
+    date_to = datetime.datetime(2024, 3, 31)
+
+    def measure(func):
+        times = list()
+        for _ in range(args.repeat):
+            with Session(get_engine()) as session:
+                t = time.perf_counter()
+                res = func(session)
+                times.append(time.perf_counter() - t)
+        return res, dict(min_s=min(times), max_s=max(times))
+
+    res, monthly = measure(lambda session: monthly_pivot(session, ACCOUNT_ID, month_from, month_to))
+    monthly['groups'] = res['details']['length']
+    res, utilization = measure(lambda session: resource_utilization(session, ACCOUNT_ID, date_from, date_to))
+    utilization['resources'] = len(res['resources'])
+
+    result = dict(
+        rows=args.rows,
+        worksites=args.worksites,
+        months=args.months,
+        monthly=monthly,
+        utilization=utilization,
+    )
+    print(json.dumps(result, indent=4))
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
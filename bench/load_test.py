@@ -0,0 +1,294 @@
+"""実際の画面操作の流れに沿ったHTTP負荷試験
+
+サインイン画面(CSRF取得) → /token/account/{account_id} ログイン → /daily_report/top
+→ 廃材単価の参照 → 1日分の日報登録 → 日報呼出 → 集計 の順にリクエストを送り、
+ルート毎のレイテンシ(p50/p95/p99)、エラー率、全体のスループットを計測する。
+結果はJSONで保存し、--compare で過去の結果と比較できる。
+
+使い方:
+    # アプリをプロセス内で起動して計測（一時DBにサンプルデータを登録する）
+    python bench/load_test.py --concurrency 10 --iterations 20
+
+    # 起動済みのサーバに対して計測
+    python bench/load_test.py --base-url http://localhost:8000 --account company01 --user user01 --password test
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+RESULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+RE_CSRF_TOKEN = re.compile(r"const csrf_token = '([^']+)'|'X-CSRF-Token': '([^']+)'")
+
+
+def percentile(values, p):
+    """最近傍法でパーセンタイルを求める
+
+    Args:
+        values (list): 昇順ソート済みの値
+        p (float): パーセンタイル(0-100)
+    """
+
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))
+    return values[k]
+
+
+def find_csrf_token(html):
+    m = RE_CSRF_TOKEN.search(html)
+    if m is None:
+        return None
+    return m.group(1) or m.group(2)
+
+
+def build_report(worker, iteration):
+    """1日分の日報(全種別を含む)を作成する"""
+
+    staffs = [dict(name=f'staff{i:02}', cost=11000 + i * 1000, quant=1) for i in range(8)]
+    cars = [dict(name=f'car{i:02}', cost=8000, quant=1 + i % 2) for i in range(3)]
+    machines = [dict(name=f'machine{i:02}', cost=25000, quant=1) for i in range(3)]
+    leases = [dict(name=f'lease{i:02}', cost=3000, quant=1) for i in range(2)]
+    transports = [dict(name=f'transport{i:02}', cost=15000, quant=1) for i in range(2)]
+    trashes = [dict(item=f'item{i:02}', dest=f'dest{i % 3:02}', cost=1100 + i * 100, quant=2, unit_type=i % 3) for i in range(5)]
+    valuables = [dict(name='scrap', cost=-5000, quant=1)]
+    others = [dict(name='misc', cost=2000, quant=1)]
+    return {
+        'head': {
+            'customer': f'loadtest customer {worker}',
+            'address': 'loadtest address',
+            'memo': f'iteration {iteration}',
+        },
+        'detail': {
+            'staffs': staffs,
+            'cars': cars,
+            'machines': machines,
+            'leases': leases,
+            'transports': transports,
+            'trashes': trashes,
+            'valuables': valuables,
+            'others': others,
+        },
+    }
+
+
+class Recorder:
+    """ルート毎のレイテンシとエラーを記録する"""
+
+    def __init__(self):
+        self.samples = dict()
+
+    async def request(self, client, route, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            res = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.add(route, time.perf_counter() - start, False)
+            raise e
+        self.add(route, time.perf_counter() - start, res.status_code < 400)
+        return res
+
+    def add(self, route, elapsed, ok):
+        self.samples.setdefault(route, []).append((elapsed, ok))
+
+    def summary(self, duration):
+        routes = dict()
+        total = 0
+        total_errors = 0
+        for route, samples in self.samples.items():
+            latencies = sorted(s[0] * 1000 for s in samples)
+            errors = sum(1 for s in samples if not s[1])
+            total += len(samples)
+            total_errors += errors
+            routes[route] = {
+                'count': len(samples),
+                'errors': errors,
+                'error_rate': errors / len(samples),
+                'throughput': len(samples) / duration,
+                'mean_ms': statistics.fmean(latencies),
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+                'max_ms': latencies[-1],
+            }
+        return {
+            'requests': total,
+            'errors': total_errors,
+            'error_rate': total_errors / total if total else 0,
+            'duration_s': duration,
+            'throughput': total / duration if duration else 0,
+            'routes': routes,
+        }
+
+
+async def run_flow(client, rec, args, worker, iteration):
+    """画面操作1回分のリクエストを順に送る"""
+
+    # CSRFトークン取得（サインイン画面）
+    res = await rec.request(client, 'GET /sign_in', 'GET', '/sign_in')
+    headers = {'X-CSRF-Token': find_csrf_token(res.text)}
+
+    res = await rec.request(
+        client, 'POST /token/account/{account_id}', 'POST', f'/token/account/{args.account}',
+        data={'username': args.user, 'password': args.password}, headers=headers)
+    if res.status_code >= 400:
+        return
+
+    res = await rec.request(client, 'GET /daily_report/top', 'GET', '/daily_report/top')
+    headers = {'X-CSRF-Token': find_csrf_token(res.text)}
+
+    for dest_id, item_id in args.trash_pairs:
+        await rec.request(
+            client, 'GET /master/trash/{dest_id}/{item_id}', 'GET', f'/master/trash/{dest_id}/{item_id}')
+
+    work_name = f'{args.worksite_prefix}{worker:03}'
+    work_date = (datetime.date(2024, 1, 1) + datetime.timedelta(days=iteration)).strftime('%Y-%m-%d')
+    if worker not in args.work_ids:
+        # 未登録の工事は工事名で登録する（工事を登録してIDのルートにリダイレクトされる）
+        res = await rec.request(
+            client, 'POST /daily_report/{work_name}/work_date/{work_date}', 'POST',
+            f'/daily_report/{work_name}/work_date/{work_date}',
+            json=build_report(worker, iteration), headers=headers, follow_redirects=True)
+    else:
+        res = await rec.request(
+            client, 'POST /daily_report/{work_id}/day/{work_date}', 'POST',
+            f'/daily_report/{args.work_ids[worker]}/day/{work_date}',
+            json=build_report(worker, iteration), headers=headers)
+    if res.status_code != 200:
+        return
+    work_id = args.work_ids[worker] = res.json()['work_id']
+
+    await rec.request(
+        client, 'GET /daily_report/{work_id}/day/{work_date}', 'GET',
+        f'/daily_report/{work_id}/day/{work_date}')
+
+    await rec.request(
+        client, 'GET /daily_report/{work_id}/summary', 'GET',
+        f'/daily_report/{work_id}/summary')
+
+
+async def run_worker(transport, rec, args, worker):
+    async with httpx.AsyncClient(transport=transport, base_url=args.base_url or 'http://testserver',
+                                 timeout=args.timeout) as client:
+        for i in range(args.iterations):
+            try:
+                await run_flow(client, rec, args, worker, i)
+            except httpx.HTTPError:
+                # 記録済みなので次の周回へ
+                pass
+            client.cookies.clear()
+
+
+async def run(args):
+    transport = None
+    if args.base_url is None:
+        import main
+        transport = httpx.ASGITransport(app=main.app)
+
+    rec = Recorder()
+    start = time.perf_counter()
+    await asyncio.gather(*(run_worker(transport, rec, args, w) for w in range(args.concurrency)))
+    return rec.summary(time.perf_counter() - start)
+
+
+def setup_inprocess_db():
+    """プロセス内実行用に一時DBを作成し、サンプルデータを登録する"""
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix='drw_loadtest_'), 'db.sqlite')
+    os.environ['db_path'] = db_path
+    sys.path.insert(0, APP_DIR)
+
+    from tables import create_all_tables
+    from utils.json2db import register_all_data
+    create_all_tables()
+    register_all_data()
+    return db_path
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(result, baseline=None):
+    print(f"requests={result['requests']} errors={result['errors']} "
+          f"throughput={result['throughput']:.1f} req/s duration={result['duration_s']:.2f}s")
+    print(f"{'route':<55} {'count':>6} {'err%':>6} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for route, r in result['routes'].items():
+        line = f"{route:<55} {r['count']:>6} {r['error_rate'] * 100:>6.1f} "\
+            f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f}"
+        if baseline is not None and route in baseline['routes']:
+            base = baseline['routes'][route]['p95_ms']
+            line += f"  p95 {(r['p95_ms'] - base) / base * 100:+.1f}%"
+        print(line)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default=None, help='計測対象のURL。省略時はプロセス内で起動する')
+    parser.add_argument('--concurrency', type=int, default=10, help='同時実行ユーザ数')
+    parser.add_argument('--iterations', type=int, default=10, help='1ユーザあたりの操作回数')
+    parser.add_argument('--account', default='company01')
+    parser.add_argument('--user', default='user01')
+    parser.add_argument('--password', default='test')
+    parser.add_argument('--trash', default='1:1,1:2,2:1', help='参照する廃材単価 dest_id:item_id のカンマ区切り')
+    parser.add_argument('--worksite-prefix', default='loadtest-')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--output', default=None, help='結果JSONの保存先。省略時は bench/results/ 配下')
+    parser.add_argument('--compare', default=None, help='比較対象の結果JSON')
+    args = parser.parse_args(argv)
+    args.trash_pairs = [tuple(int(x) for x in p.split(':')) for p in args.trash.split(',') if p]
+    # ユーザ毎の工事ID（初回の登録で設定する）
+    args.work_ids = dict()
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.base_url is None:
+        setup_inprocess_db()
+
+    result = asyncio.run(run(args))
+    result['commit'] = git_commit()
+    result['timestamp'] = datetime.datetime.now().isoformat(timespec='seconds')
+    result['params'] = {
+        'base_url': args.base_url,
+        'concurrency': args.concurrency,
+        'iterations': args.iterations,
+    }
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_summary(result, baseline)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULT_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        output = os.path.join(RESULT_DIR, f"loadtest-{result['commit'] or 'unknown'}-{stamp}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=4, ensure_ascii=False)
+    print(f'saved: {output}')
+
+    return 1 if result['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,327 @@
+"""よく呼ばれるヘルパー関数のマイクロベンチマーク
+
+get_master_data / get_name_only_master_data / UNIT_TYPE の検索 / ItemType.value_of /
+tables.py の to_dict() / create_access_token・get_decoded_token と、
+最大のマスタ・集計レスポンスのエンコード時間(json / orjson)、100行の日報のJSON / MessagePack の
+サイズとエンコード・デコード時間を実運用に近い件数で計測する。
+
+--save で結果をベースラインとして保存し、以降の実行ではベースラインとの比較を行う。
+いずれかの計測値が --threshold (%) を超えて遅くなった場合は終了コード1を返す。
+ベースラインは計測したマシンに依存するため、同じマシン上の比較に使うこと。
+
+使い方:
+    python bench/micro_bench.py --save          # ベースライン保存
+    python bench/micro_bench.py --threshold 15  # ベースラインと比較
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'micro_bench.json')
+
+# 実運用に近い件数
+N_MASTER = 200
+N_DEST = 20
+N_ITEM = 50
+N_TRASH = N_DEST * N_ITEM
+N_WORK = 1000
+N_DETAIL = 100
+N_SUMMARY_DAYS = 365
+
+BENCHMARKS = dict()
+# 計測対象データのサイズ(bytes)。結果と一緒に表示する
+SIZES = dict()
+
+
+def benchmark(name, number):
+    """計測対象の登録
+
+    Args:
+        name (str): 計測名
+        number (int): 1回の計測で実行する回数
+    """
+
+    def deco(func):
+        BENCHMARKS[name] = (func, number)
+        return func
+    return deco
+
+
+def setup_db():
+    """get_master_data('trash') が参照するDBを一時ファイルで用意する"""
+
+    os.environ['db_path'] = os.path.join(tempfile.mkdtemp(prefix='drw_bench_'), 'db.sqlite')
+    sys.path.insert(0, APP_DIR)
+
+    from sqlalchemy.orm import Session
+    from db_common import get_engine
+    from tables import Account, DestMaster, ItemMaster, create_all_tables
+
+    create_all_tables()
+    with Session(get_engine()) as session:
+        session.add(Account(id=1, account_id='bench', account_pwd='x', fullname='bench'))
+        session.add_all([DestMaster(name=f'dest{i}', account_id=1) for i in range(N_DEST)])
+        session.add_all([ItemMaster(name=f'item{i}', account_id=1) for i in range(N_ITEM)])
+        session.commit()
+
+
+def make_fixtures():
+    import tables
+
+    staffs = [tables.StaffMaster(id=i, name=f'staff{i}', cost=10000 + i, memo=None, account_id=1) for i in range(N_MASTER)]
+    customers = [tables.CustomerMaster(id=i, name=f'customer{i}', memo='memo', account_id=1) for i in range(N_MASTER)]
+    dests = [tables.DestMaster(id=i, name=f'dest{i}', account_id=1) for i in range(N_DEST)]
+    items = [tables.ItemMaster(id=i, name=f'item{i}', account_id=1) for i in range(N_ITEM)]
+    trashes = [
+        tables.TrashMaster(id=i, dest=dests[i % N_DEST], item=items[i // N_DEST], cost=1000 + i, unit_type=i % 3)
+        for i in range(N_TRASH)
+    ]
+    works = [
+        tables.ReportHead(
+            id=i, customer_name=f'customer{i % N_MASTER}', worksite_name=f'work{i}', address='address',
+            memo=None, account_id=1,
+            completed_date=datetime.datetime(2024, 1, 1) if i % 2 else None)
+        for i in range(N_WORK)
+    ]
+    details = [
+        tables.ReportDetail(
+            id=i, report_head=works[0], work_date=datetime.datetime(2024, 1, 1), type=i % 8,
+            name=f'name{i}', dest=None, cost=1000, quant=1, unit_type=0, memo=None)
+        for i in range(N_DETAIL)
+    ]
+    # get_summary_with_workid のレスポンス（1年分、全種別）
+    summary = {
+        'head': works[0].to_dict(),
+        'details': [
+            {
+                'date': (datetime.date(2024, 1, 1) + datetime.timedelta(days=i)).strftime('%Y-%m-%d'),
+                'type': t,
+                'quant': 3,
+                'total': 30000,
+            }
+            for i in range(N_SUMMARY_DAYS) for t in range(8)
+        ],
+    }
+    return dict(staffs=staffs, customers=customers, trashes=trashes, works=works, details=details, summary=summary)
+
+
+def make_day_report(n):
+    """n行の日報（POST /daily_report/{work_id}/day/{work_date} のボディ）"""
+
+    keys = ['staffs', 'cars', 'machines', 'leases', 'transports', 'trashes', 'valuables', 'others']
+    detail = {k: [] for k in keys}
+    for i in range(n):
+        k = keys[i % len(keys)]
+        if k == 'trashes':
+            detail[k].append(dict(item=f'item{i}', dest=f'dest{i % 5}', cost=1100, quant=2, unit_type=i % 3))
+        else:
+            detail[k].append(dict(name=f'{k}{i}', cost=10000 + i, quant=1))
+    return dict(head=dict(customer='customer', address='address', memo='memo'), detail=detail)
+
+
+def dumps_stdlib(content):
+    # starlette.responses.JSONResponse.render と同じ設定
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def register_benchmarks(fx):
+    import orjson
+
+    from app_utils import (
+        create_access_token,
+        get_decoded_token,
+        get_master_data,
+        get_name_only_master_data,
+        to_columnar,
+    )
+    from schemas import ItemType, UNIT_TYPE
+
+    @benchmark(f'get_master_data[staff x{N_MASTER}]', 200)
+    def _():
+        get_master_data(fx['staffs'], 'staff', account_id=1)
+
+    @benchmark(f'get_master_data[work x{N_WORK}]', 20)
+    def _():
+        get_master_data(fx['works'], 'work', account_id=1)
+
+    @benchmark(f'get_master_data[trash x{N_TRASH}]', 10)
+    def _():
+        get_master_data(fx['trashes'], 'trash', account_id=1)
+
+    @benchmark(f'get_name_only_master_data[x{N_MASTER}]', 500)
+    def _():
+        get_name_only_master_data(fx['customers'])
+
+    unit_types = [t.unit_type for t in fx['trashes']]
+
+    @benchmark(f'UNIT_TYPE lookup[x{N_TRASH}]', 50)
+    def _():
+        # get_master_data('trash') 内のループと同じ検索
+        for v in unit_types:
+            for u in UNIT_TYPE:
+                if v == u['id']:
+                    unit_type = u['name']
+            else:
+                unit_type = UNIT_TYPE[0]['name']
+
+    types = [d.type for d in fx['details']]
+
+    @benchmark(f'ItemType.value_of[x{N_DETAIL}]', 500)
+    def _():
+        for t in types:
+            ItemType.value_of(t)
+
+    @benchmark(f'StaffMaster.to_dict[x{N_MASTER}]', 200)
+    def _():
+        [x.to_dict() for x in fx['staffs']]
+
+    @benchmark(f'TrashMaster.to_dict[x{N_TRASH}]', 10)
+    def _():
+        [x.to_dict() for x in fx['trashes']]
+
+    @benchmark(f'ReportHead.to_dict[x{N_WORK}]', 20)
+    def _():
+        [x.to_dict() for x in fx['works']]
+
+    @benchmark(f'ReportDetail.to_dict[x{N_DETAIL}]', 100)
+    def _():
+        [x.to_dict() for x in fx['details']]
+
+    # レスポンスのエンコード（JSONResponse(json.dumps) と ORJSONResponse + 事前JSON化）
+    payloads = {
+        f'master[work x{N_WORK}]': get_master_data(fx['works'], 'work', account_id=1),
+        f'master[trash x{N_TRASH}]': get_master_data(fx['trashes'], 'trash', account_id=1),
+        f'summary[x{N_SUMMARY_DAYS * 8}]': fx['summary'],
+    }
+    for label, payload in payloads.items():
+        plain = orjson.loads(orjson.dumps(payload))
+
+        benchmark(f'encode {label} json', 20)(lambda plain=plain: dumps_stdlib(plain))
+        benchmark(f'encode {label} orjson', 20)(lambda payload=payload: orjson.dumps(payload))
+
+    # ?layout=columnar（列変換 + エンコード）
+    summary_rows = [tuple(d.values()) for d in fx['summary']['details']]
+
+    @benchmark(f'encode summary[x{N_SUMMARY_DAYS * 8}] columnar orjson', 20)
+    def _():
+        orjson.dumps(dict(
+            head=fx['summary']['head'],
+            details=to_columnar(summary_rows, ['date', 'type', 'quant', 'total'], dictionary_keys=['date', 'type']),
+        ))
+
+    # 100行の日報: JSON(orjson) と MessagePack のサイズとエンコード・デコード時間
+    import msgpack
+    from api_response import packb
+    from schemas import Report
+
+    day_report = make_day_report(100)
+    day_report_json = orjson.dumps(day_report)
+    day_report_msgpack = packb(day_report)
+    SIZES['day report[x100] json'] = len(day_report_json)
+    SIZES['day report[x100] msgpack'] = len(day_report_msgpack)
+
+    benchmark('day report[x100] encode json', 500)(lambda: orjson.dumps(day_report))
+    benchmark('day report[x100] encode msgpack', 500)(lambda: packb(day_report))
+    benchmark('day report[x100] decode json', 500)(lambda: orjson.loads(day_report_json))
+    benchmark('day report[x100] decode msgpack', 500)(lambda: msgpack.unpackb(day_report_msgpack))
+    benchmark('day report[x100] decode+validate msgpack', 100)(
+        lambda: Report.model_validate(msgpack.unpackb(day_report_msgpack)))
+
+    @benchmark('create_access_token', 1000)
+    def _():
+        create_access_token(user_uuid=1, account_uuid=1, token_key='bench_key')
+
+    token = create_access_token(user_uuid=1, account_uuid=1, token_key='bench_key')
+
+    @benchmark('get_decoded_token', 1000)
+    def _():
+        get_decoded_token(token, key='bench_key')
+
+
+def run(names=None, repeat=5):
+    """登録済みのベンチマークを実行し、1回あたりの実行時間(us)を返す
+
+    Args:
+        names (list, optional): 実行する計測名（部分一致）。省略時は全て
+        repeat (int, optional): 繰り返し回数。最小値を採用する
+    """
+
+    result = dict()
+    for name, (func, number) in BENCHMARKS.items():
+        if names and not any(n in name for n in names):
+            continue
+        times = timeit.repeat(func, number=number, repeat=repeat)
+        result[name] = min(times) / number * 1e6
+    return result
+
+
+def compare(result, baseline, threshold):
+    """ベースラインとの比較結果を表示し、閾値を超えたものを返す"""
+
+    regressions = list()
+    print(f"{'benchmark':<40} {'us/op':>12} {'baseline':>12} {'diff':>8}")
+    for name, value in result.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f'{name:<40} {value:>12.2f} {"-":>12} {"-":>8}')
+            continue
+        diff = (value - base) / base * 100
+        mark = ''
+        if diff > threshold:
+            mark = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:<40} {value:>12.2f} {base:>12.2f} {diff:>+7.1f}%{mark}')
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='names', action='append', help='実行する計測名（部分一致、複数指定可）')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=float(os.getenv('BENCH_THRESHOLD', 20)),
+                        help='退行とみなす遅延率(%%)。環境変数 BENCH_THRESHOLD でも指定可')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save', action='store_true', help='結果をベースラインとして保存する')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_db()
+    register_benchmarks(make_fixtures())
+    result = run(args.names, args.repeat)
+
+    baseline = dict()
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+
+    regressions = compare(result, baseline, args.threshold)
+    for name, size in SIZES.items():
+        print(f'{name:<40} {size:>12} bytes')
+
+    if args.save:
+        baseline.update(result)
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(dict(
+                saved=datetime.datetime.now().isoformat(timespec='seconds'),
+                results=baseline,
+            ), f, indent=4, ensure_ascii=False)
+        print(f'saved: {args.baseline}')
+        return 0
+
+    if regressions:
+        print(f'{len(regressions)} benchmark(s) slower than baseline by more than {args.threshold}%')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+import os
+import re
+import sys
+import tempfile
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app')
+
+# main.py は読み込み時にDBのパスを決めるため、先に一時DBを指定する
+os.environ.setdefault('db_path', os.path.join(tempfile.mkdtemp(), 'db.sqlite'))
+sys.path.insert(0, APP_DIR)
+
+
+@pytest.fixture(scope='session')
+def app():
+    from tables import create_all_tables
+    from utils.json2db import register_all_data
+
+    create_all_tables()
+    register_all_data()
+
+    import main
+    yield main.app
+
+    # main.py が作成したトークンの鍵を残さない
+    token_key = os.path.join(APP_DIR, 'token.key')
+    if os.path.exists(token_key):
+        os.remove(token_key)
+
+
+@pytest.fixture
+def client(app):
+    from fastapi.testclient import TestClient
+
+    return TestClient(app)
+
+
+def csrf_header(client, path):
+    """画面に埋め込まれたCSRFトークンのヘッダ"""
+
+    m = re.search(r"const csrf_token = '([^']+)'|'X-CSRF-Token': '([^']+)'", client.get(path).text)
+    return {'X-CSRF-Token': m.group(1) or m.group(2)}
+
+
+def login(client, account='company01', username='user01', password='test'):
+    """初期データのユーザでアカウントにログインする"""
+
+    r = client.post(f'/token/account/{account}', data={'username': username, 'password': password},
+                    headers=csrf_header(client, '/sign_in'))
+    assert r.status_code == 200, r.text
@@ -0,0 +1,60 @@
+from sqlalchemy import (
+    select,
+    text,
+)
+
+from conftest import (
+    csrf_header,
+    login,
+)
+
+
+def account_ids():
+    from db_common import get_engine
+
+    with get_engine().connect() as conn:
+        return dict(conn.execute(text('select account_id, id from account')).all())
+
+
+def members(account_uuid):
+    from db_common import get_engine
+    from tables import association_table
+
+    with get_engine().connect() as conn:
+        return set(conn.scalars(
+            select(association_table.c.user_id).where(association_table.c.account_id == account_uuid)))
+
+
+def new_user(client, username):
+    r = client.post('/user/create', json={'username': username, 'password': 'Abcdefg1!x'},
+                    headers=csrf_header(client, '/sign_up'))
+    assert r.status_code == 201, r.text
+    return client.get(f'/user/{username}').json()['user']['id']
+
+
+def test_add_users_to_other_account_is_forbidden(client):
+    ids = account_ids()
+    uid = new_user(client, 'outsider01')
+    # アカウントAでログインし、アカウントBにユーザを追加しようとする
+    login(client, 'company01')
+    h = csrf_header(client, '/daily_report/top')
+
+    r = client.post(f"/account/{ids['company02']}/users/add", json={'uuids': [uid]}, headers=h)
+    assert r.status_code == 403
+    r = client.post(f"/account/{ids['company02']}/user/add", json={'uuid': uid}, headers=h)
+    assert r.status_code == 403
+    assert uid not in members(ids['company02'])
+
+    # 自分のアカウントには追加できる
+    r = client.post(f"/account/{ids['company01']}/users/add", json={'uuids': [uid]}, headers=h)
+    assert r.status_code == 200
+    assert r.json()['added'] == [uid]
+
+
+def test_add_users_without_token_is_forbidden(client):
+    ids = account_ids()
+    h = csrf_header(client, '/sign_in')
+    client.cookies.delete('token')
+
+    r = client.post(f"/account/{ids['company02']}/users/add", json={'uuids': [1]}, headers=h)
+    assert r.status_code == 403
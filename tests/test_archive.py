@@ -0,0 +1,85 @@
+from sqlalchemy import text
+
+from conftest import (
+    csrf_header,
+    login,
+)
+
+
+def report():
+    d = dict(name='a', cost=100, quant=2)
+    return {
+        'head': {'customer': 'c', 'address': 'a', 'memo': 'm'},
+        'detail': {
+            'staffs': [dict(name='s1', cost=10000)], 'cars': [d], 'machines': [d], 'leases': [d], 'transports': [d],
+            'trashes': [dict(item='i', dest='d', cost=1000, quant=500, unit_type=1),
+                        dict(item='j', dest='e', cost=10, quant=3, unit_type=0)],
+            'valuables': [d], 'others': [d],
+        },
+    }
+
+
+def save(client, h, worksite, date):
+    r = client.post(f'/daily_report/{worksite}/work_date/{date}', json=report(), headers=h)
+    assert r.status_code == 200, r.text
+
+
+def work_id(worksite):
+    from db_common import get_engine
+
+    with get_engine().connect() as conn:
+        return conn.execute(text('select id from report_head where worksite_name = :name'), dict(name=worksite)).scalar()
+
+
+def archive(client, h, worksite):
+    import archive
+
+    r = client.post('/master/work/complete', json={'id': work_id(worksite), 'completed_date': '2023-06-30'}, headers=h)
+    assert r.status_code == 200, r.text
+    assert work_id(worksite) in archive.archive_completed(days=30)
+
+
+def test_archived_worksite_keeps_analytics(client):
+    login(client)
+    h = csrf_header(client, '/daily_report/top')
+    save(client, h, 'archive01', '2023-05-01')
+    save(client, h, 'archive01', '2023-05-02')
+    save(client, h, 'archive02', '2023-05-02')
+
+    paths = ['/analytics/monthly?from=2023-05&to=2023-06',
+             '/analytics/utilization?from=2023-05-01&to=2023-05-31',
+             '/analytics/waste?from=2023-05-01&to=2023-05-31',
+             f'/daily_report/{work_id("archive01")}/summary']
+    before = {p: client.get(p).json() for p in paths}
+    archive(client, h, 'archive01')
+
+    for p in paths:
+        after = client.get(p).json()
+        if 'head' in after:
+            for key in ('completed_date', 'archived'):
+                after['head'].pop(key)
+                before[p]['head'].pop(key)
+        assert after == before[p], p
+
+
+def test_archived_detail_ids_are_not_reused(client):
+    from sqlalchemy.orm import Session
+
+    from archive import archived_details
+    from db_common import get_engine
+
+    login(client)
+    h = csrf_header(client, '/daily_report/top')
+    save(client, h, 'archive03', '2023-05-03')
+    save(client, h, 'archive04', '2023-05-03')
+    # 最も大きいIDの明細がアーカイブに移っても、新しい明細は別のIDになる
+    save(client, h, 'archive03', '2023-05-04')
+    archive(client, h, 'archive03')
+    save(client, h, 'archive04', '2023-05-04')
+
+    with Session(get_engine()) as session:
+        ids = session.scalars(text(
+            'select id from report_detail where report_head_id = :id and work_date >= :date'),
+            dict(id=work_id('archive04'), date='2023-05-04')).all()
+        archived_ids = [d['id'] for d in archived_details(session, work_id('archive03'))]
+    assert ids and min(ids) > max(archived_ids)
@@ -0,0 +1,24 @@
+import pytest
+
+from conftest import login
+
+
+STATS_PATHS = ['/single_flight/stats', '/write_queue/stats', '/events/stats']
+
+
+@pytest.mark.parametrize('path', STATS_PATHS)
+def test_stats_are_forbidden_to_other_accounts(client, monkeypatch, path):
+    import main
+
+    monkeypatch.setattr(main, 'STATS_ACCOUNTS', ['company02'])
+    login(client, 'company01')
+    assert client.get(path).status_code == 403
+
+
+@pytest.mark.parametrize('path', STATS_PATHS)
+def test_stats_for_stats_account(client, monkeypatch, path):
+    import main
+
+    monkeypatch.setattr(main, 'STATS_ACCOUNTS', ['company01'])
+    login(client, 'company01')
+    assert client.get(path).status_code == 200
@@ -0,0 +1,63 @@
+from sqlalchemy import text
+
+from conftest import (
+    csrf_header,
+    login,
+)
+from test_archive import (
+    archive,
+    save,
+)
+
+
+def scalar(sql, **params):
+    from db_common import get_engine
+
+    with get_engine().connect() as conn:
+        return conn.execute(text(sql), params).scalar()
+
+
+def trash_of(account):
+    from db_common import get_engine
+
+    with get_engine().connect() as conn:
+        return conn.execute(text(
+            'select t.id, t.dest_id from trash_master t join dest_master d on d.id = t.dest_id '
+            'where d.account_id = :account order by t.id'), dict(account=account)).first()
+
+
+def test_update_trash_to_other_account_dest_is_rejected(client):
+    login(client, 'company01')
+    h = csrf_header(client, '/daily_report/top')
+    account = scalar("select id from account where account_id = 'company01'")
+    other_dest = scalar("select min(d.id) from dest_master d join account a on a.id = d.account_id "
+                        "where a.account_id != 'company01'")
+    trash_id, dest_id = trash_of(account)
+    seq = client.get('/sync').json()['seq']
+    r = client.post('/sync', json={'base_seq': seq, 'changes': [
+        {'kind': 'trash', 'op': 'upsert', 'id': trash_id, 'data': {'dest_id': other_dest}},
+        {'kind': 'trash', 'op': 'upsert', 'id': trash_id, 'data': {'dest_id': None}},
+    ]}, headers=h)
+    assert r.status_code == 200, r.text
+    assert [c['status'] for c in r.json()['changes']] == ['error', 'error']
+    assert scalar('select dest_id from trash_master where id = :id', id=trash_id) == dest_id
+
+
+def test_archive_keeps_change_log_append_only(client):
+    login(client)
+    h = csrf_header(client, '/daily_report/top')
+    save(client, h, 'sync01', '2023-05-10')
+    seq = client.get('/sync').json()['seq']
+    last_seq = scalar('select max(seq) from change_log')
+    count = scalar('select count(*) from change_log')
+
+    archive(client, h, 'sync01')
+    save(client, h, 'sync01', '2023-05-11')  # アーカイブから戻して登録する
+
+    # 履歴は削除されず（seq に欠番がない）、アーカイブ・戻した明細の移動は記録しない
+    assert scalar('select count(*) from change_log where seq <= :seq', seq=last_seq) == count
+    assert scalar('select count(*) from change_log') == scalar('select max(seq) from change_log')
+    changes = client.get(f'/sync?since={seq}').json()['changes']
+    dates = set(changes['detail']['upsert']['columns']['work_date'])
+    assert dates == {'2023-05-11 00:00:00'}
+    assert changes['detail']['delete'] == []